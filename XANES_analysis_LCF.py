@@ -9,29 +9,61 @@ from larch.xafs import xftf
 from larch.io import create_athena, read_athena, extract_athenagroup
 # linear combination fitting
 from larch.math import lincombo_fit
+# linear combination fitting of many spectra with the same standards
+from xas_lcf import batch_lcf, combinatorial_lcf
+
+# cache for reusing the results of pre_edge, autobk and xftf
+from xas_cache import ResultCache, process_with_cache
+
+# athena projects read lazily, only the groups used are decoded
+from xas_athena import read_athena_lazy
+
+# normalised standards saved once and loaded as ready arrays
+from xas_standards import StandardsLibrary
+
+# mu added to the group in place
+from xas_groups import add_mu
 
 # additional libraries
-from numpy import log
 import matplotlib.pyplot as plt
 
+# fourier transform parameters used in the tutorial
+XFTF_DEFAULTS = {'kweight': 0.5, 'kmin': 3.0, 'kmax': 12.871, 'dk': 1,
+                 'kwindow': 'Hanning'}
+
+# pre_edge and autobk use the larch defaults, e0 is found from the data
+PRE_EDGE_DEFAULTS = {'e0': None}
+AUTOBK_DEFAULTS = {'e0': None}
+
+# results are saved here and reused when the script is run again
+results_cache = ResultCache('XAFSExamples/cache')
+
+# standards library, built from the project the first time the script is run
+standards_library = StandardsLibrary('XAFSExamples/standards')
+
  #######################################################
 # |         Athena recalculates everything so we      | #
 # |      need to create a function that calculates    | #
 # V               all for each new group              V #
  #######################################################
 
-def calc_with_defaults(xafs_group):
+# the results can be reused from a cache (see xas_cache.py) when the same
+# data is processed again with the same parameters
+def calc_with_defaults(xafs_group, cache=None):
     # calculate mu and normalise with background extraction
     # should let the user specify the colums for i0, it, mu, iR. 
     if not hasattr(xafs_group, 'mu'):
-        xafs_group = get_mu(xafs_group)    
-    # calculate pre-edge and post edge and add them to group
-    pre_edge(xafs_group)
-    # perform background removal
-    autobk(xafs_group) # using defaults so no additional parameters are passed
-    # calculate fourier transform
-    xftf(xafs_group, kweight=0.5, kmin=3.0, kmax=12.871, dk=1, kwindow='Hanning')
-    return xafs_group
+        xafs_group = add_mu(xafs_group)    
+    def process(a_group):
+        # calculate pre-edge and post edge and add them to group
+        pre_edge(a_group, **PRE_EDGE_DEFAULTS)
+        # perform background removal
+        autobk(a_group, **AUTOBK_DEFAULTS) # using defaults
+        # calculate fourier transform
+        xftf(a_group, **XFTF_DEFAULTS)
+    params = {'pre_edge': PRE_EDGE_DEFAULTS, 'autobk': AUTOBK_DEFAULTS,
+              'xftf': XFTF_DEFAULTS}
+    return process_with_cache(xafs_group, params, process, cache)
 
  #######################################################
 # |       The code for plotting Nmu vs E repeats      | #
@@ -39,14 +71,20 @@ def calc_with_defaults(xafs_group):
 # V            to reduce duplicated code              V #
  #######################################################
 # plot mu vs flat normalised mu for selected groups
+# standards in the library are plotted from it, without extracting and
+# normalising them again
 def plot_NxmuE_E_athena_prj(athena_project, group_keys, group_names,
                             title = "Normalised Mu vs E", xlimits = None,
-                            ylimits = None):    
+                            ylimits = None, library = None,
+                            edge = ('Au', 'L3')):    
     # plot mu vs flat normalised mu for selected groups
     for group_key in group_keys:
-        gr_0 = extract_athenagroup(athena_project._athena_groups[group_key])
-        # recalculate normalisation
-        calc_with_defaults(gr_0)
+        if library is not None and library.has(edge[0], edge[1], group_key):
+            gr_0 = library.group(edge[0], edge[1], group_key)
+        else:
+            gr_0 = extract_athenagroup(athena_project._athena_groups[group_key])
+            # recalculate normalisation
+            calc_with_defaults(gr_0, results_cache)
         plt.plot(gr_0.energy, gr_0.flat, label=group_names[group_key])
 
     # set plot format
@@ -64,7 +102,8 @@ def plot_NxmuE_E_athena_prj(athena_project, group_keys, group_names,
 
 # https://vimeo.com/340216087 08:29 open cyanobacteria project 
 project_name = 'XAFSExamples/Au+Cyanobacteria/cyanobacteria.prj'
-cianobacteria_project = read_athena(project_name)
+# the groups are decoded when they are plotted or fitted
+cianobacteria_project = read_athena_lazy(project_name)
 #vars(cianobacteria_project)
 
 # https://vimeo.com/340216087 10:40 plot readings of sample 
@@ -90,9 +129,20 @@ plt.show()
 # get the group keys for first last 9 groups
 group_keys = list(cianobacteria_project._athena_groups.keys())[8:17]
 
+# add the standards to the library if they are not there yet
+if not all(standards_library.has('Au', 'L3', group_key)
+           for group_key in group_keys):
+    standards_library.add_project(cianobacteria_project, group_keys,
+                                  labels=group_names, element='Au', edge='L3',
+                                  process=lambda a_group: calc_with_defaults(
+                                      a_group, results_cache),
+                                  source=project_name)
+    standards_library.save()
+
 plt = plot_NxmuE_E_athena_prj(cianobacteria_project, group_keys, group_names,
                               title = "Au Standards",
-                              xlimits = [11860,12000])
+                              xlimits = [11860,12000],
+                              library = standards_library)
 plt.show()
 
 # https://vimeo.com/340216087 15:05 compare readings to standars 
@@ -130,14 +180,14 @@ intermidate_state_key = 'd_7_03'
 # get the intermediate group
 mid_group = gr_0 = extract_athenagroup(cianobacteria_project._athena_groups[intermidate_state_key])
 # recalculate normalisation
-calc_with_defaults(mid_group)
+calc_with_defaults(mid_group, results_cache)
 
 # get the list of standard groups
 components = {}
 for group_key in standard_keys:
     components[group_key] = extract_athenagroup(cianobacteria_project._athena_groups[group_key])
     # recalculate normalisation
-    calc_with_defaults(components[group_key])
+    calc_with_defaults(components[group_key], results_cache)
     
 # perform linear combination fitting
 comb = lincombo_fit(mid_group,list(components.values()),[0.5,0.5])
@@ -155,7 +205,7 @@ plt.show()
 # https://vimeo.com/340216087 23:50 add another group 
 standard_keys = ['hqlr','tscd', 'qhxp'] #Au Foil, Au3Cl, and Au sulphide
 components['qhxp'] = extract_athenagroup(cianobacteria_project._athena_groups['qhxp'])
-calc_with_defaults(components['qhxp'])
+calc_with_defaults(components['qhxp'], results_cache)
    
 # perform linear combination fitting
 comb = lincombo_fit(mid_group,list(components.values()),[0.333,0.333,0.333])
@@ -170,3 +220,40 @@ plt.plot(mid_group.energy, mid_group.flat, label="7.03",color="blue")
 plt.plot(comb.xdata, comb.ydata, label="LCF result",color="r")
 plt.legend() # needed for showing legends of last two lines
 plt.show()
+
+# instead of adding standards by hand, try all the combinations of up to 3 of
+# the 9 standards and show the best ones by reduced chi-square
+all_standards = standards_library.groups('Au', 'L3')
+
+best_combinations = combinatorial_lcf(mid_group, all_standards,
+                                      max_standards=3, top=5, workers=4)
+for rank in range(len(best_combinations.best)):
+    print(best_combinations.best[rank][0], best_combinations.combination(rank))
+best_combinations.write_csv('XAFSExamples/Au+Cyanobacteria/lcf_combinations.csv')
+
+# linear combination fitting of all the readings with the same standards
+# the standards are interpolated once and all the readings are fitted together
+reading_keys = list(cianobacteria_project._athena_groups.keys())[0:8]
+readings = []
+for group_key in reading_keys:
+    a_group = extract_athenagroup(cianobacteria_project._athena_groups[group_key])
+    readings.append(calc_with_defaults(a_group, results_cache))
+reading_times = [float(group_names[group_key]) for group_key in reading_keys]
+
+lcf_series = batch_lcf(readings,
+                       standards_library.groups('Au', 'L3', standard_keys),
+                       times=reading_times,
+                       labels=[group_names[key] for key in reading_keys])
+# fractions and fit statistics of each reading
+lcf_series.write_csv('XAFSExamples/Au+Cyanobacteria/lcf_time_series.csv')
+
+for index, group_key in enumerate(standard_keys):
+    plt.plot(lcf_series.times, lcf_series.weights[:, index], marker='o',
+             label=group_names[group_key])
+plt.xscale('log')
+plt.xlabel("Time")
+plt.ylabel("fraction")
+plt.title("LCF of the readings")
+plt.grid(linestyle=':', linewidth=1)
+plt.legend()
+plt.show()
@@ -0,0 +1,51 @@
+# benchmark for finding the energy shifts of many spectra
+# spectra are shifted by random amounts and the shifts are found with
+# xas_align (interpolation onto the common grid, derivatives and FFT cross
+# correlation of the whole stack). Needs larch for importing xas_align.
+#
+# usage:
+#   python benchmarks/bench_align.py [sizes]
+# example:
+#   python benchmarks/bench_align.py 100 1000 10000
+
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+# make the scripts in the repository root importable
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from xas_align import derivative_stack, find_shifts
+from synthetic_spectra import energy_grid, synthetic_mu
+
+E0 = 7112.0
+STEP = 0.05
+
+def run_benchmark(sizes):
+    energy = energy_grid(E0)
+    grid = np.arange(E0 - 30, E0 + 70 + STEP / 2, STEP)
+    rng = np.random.default_rng(1)
+    print("{:>10} {:>12} {:>12} {:>14}".format("spectra", "grid (s)",
+                                               "shifts (s)", "max error (eV)"))
+    for size in sizes:
+        mu_stack = synthetic_mu(energy, size)
+        shifts = rng.uniform(-3, 3, size)
+        shifts[0] = 0.0
+        energies = [energy + shift for shift in shifts]
+
+        start = time.perf_counter()
+        derivatives = derivative_stack(energies, mu_stack, grid)
+        grid_time = time.perf_counter() - start
+        start = time.perf_counter()
+        found = find_shifts(derivatives[0], derivatives, STEP)
+        shift_time = time.perf_counter() - start
+        # the shift found moves each spectrum back onto the reference
+        error = np.max(np.abs(found + shifts))
+        print("{:>10} {:12.3f} {:12.3f} {:14.4f}".format(size, grid_time,
+                                                       shift_time, error))
+
+if __name__ == "__main__":
+    sizes = [int(arg) for arg in sys.argv[1:]] or [100, 1000]
+    run_benchmark(sizes)
@@ -0,0 +1,95 @@
+# benchmark for reading a few groups from a large athena project
+# compares larch read_athena (whole project) with xas_athena.read_athena_lazy
+# (index of the project and then only the groups used). Needs larch.
+#
+# usage:
+#   python benchmarks/bench_athena.py [number of groups] [groups used]
+
+import sys
+import gzip
+import time
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+# make the scripts in the repository root importable
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from larch.io import read_athena
+from xas_athena import read_athena_lazy
+from synthetic_spectra import energy_grid, synthetic_mu
+
+# write_project
+# synthetic project in the perl format written by larch and athena
+def write_project(file_name, n_groups):
+    energy = energy_grid()
+    mu_stack = synthetic_mu(energy, n_groups)
+    x_text = ','.join("'%s'" % value for value in energy)
+    with gzip.open(file_name, 'wt') as project_file:
+        project_file.write("# Athena project file -- Demeter version 0.9.21\n"
+                           "# synthetic project for bench_athena.py\n")
+        for index, mu in enumerate(mu_stack):
+            label = "sample_%05d.dat" % index
+            project_file.write("\n$old_group = 'g%05d';\n" % index)
+            project_file.write("@args = ('datagroup', 'g%05d', 'is_xmu', '1', "
+                               "'label', '%s', 'npts', '%d');\n" %
+                               (index, label, len(energy)))
+            project_file.write("@x = (" + x_text + ");\n")
+            project_file.write("@y = (" +
+                               ','.join("'%s'" % value for value in mu) +
+                               ");\n")
+            project_file.write("[record] # \n")
+        project_file.write("\n@journal = ();\n\n1;\n")
+
+# same_groups
+# check the lazy project gives the groups of read_athena: same group names,
+# and for the groups used the same labels and energy and mu arrays
+def same_groups(project, lazy_project, names, lazy_groups):
+    if list(project._athena_groups.keys()) != lazy_project.keys():
+        return False
+    for name in names:
+        a_group = getattr(project, name)
+        lazy_group = lazy_groups[name]
+        if getattr(a_group, 'label', None) != getattr(lazy_group, 'label', None):
+            return False
+        for array_name in ('energy', 'mu'):
+            values = getattr(a_group, array_name)
+            lazy_values = getattr(lazy_group, array_name)
+            if len(values) != len(lazy_values) or \
+                    not np.allclose(values, lazy_values):
+                return False
+    return True
+
+def run_benchmark(n_groups, n_used):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_name = Path(temp_dir) / 'bench.prj'
+        write_project(file_name, n_groups)
+        size = file_name.stat().st_size / 1024**2
+        print("project with " + str(n_groups) + " groups, %.1f MB" % size)
+
+        start = time.perf_counter()
+        project = read_athena(str(file_name))
+        full_time = time.perf_counter() - start
+
+        lazy_project = read_athena_lazy(file_name)
+        names = lazy_project.keys()[-n_used:]
+        lazy_groups = lazy_project.extract(names)
+
+        print("{:>24} {:>10}".format("reader", "time (s)"))
+        print("{:>24} {:10.3f}".format("read_athena", full_time))
+        print("{:>24} {:10.3f}".format("lazy index",
+                                      lazy_project.index_time))
+        print("{:>24} {:10.3f}".format("lazy extract " + str(n_used),
+                                      lazy_project.extract_time))
+        same = same_groups(project, lazy_project, names, lazy_groups)
+        print("same groups: " + str(same))
+
+if __name__ == "__main__":
+    n_groups = 500
+    n_used = 3
+    if len(sys.argv) > 1:
+        n_groups = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        n_used = int(sys.argv[2])
+    run_benchmark(n_groups, n_used)
@@ -0,0 +1,83 @@
+# benchmark for the batch reduction of spectra on a shared energy grid
+# compares xas_batch.batch_reduce on the whole stack with reducing the
+# spectra one at a time (with the same functions, and with larch autobk and
+# xftf when larch is installed).
+#
+# usage:
+#   python benchmarks/bench_batch.py [sizes] [--loop-max N]
+# example:
+#   python benchmarks/bench_batch.py 100 1000 5000
+
+import sys
+import time
+from pathlib import Path
+
+# make the scripts in the repository root importable
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from xas_batch import batch_reduce
+from synthetic_spectra import energy_grid, synthetic_mu
+
+AUTOBK_PARAMS = {'rbkg': 1.0, 'kweight': 2}
+XFTF_PARAMS = {'kmin': 2, 'kmax': 15, 'dk': 3, 'kweight': 2}
+
+def time_batch(energy, mu_stack):
+    start = time.perf_counter()
+    batch_reduce(energy, mu_stack, AUTOBK_PARAMS, XFTF_PARAMS)
+    return time.perf_counter() - start
+
+# reduce the spectra one at a time with the batch functions
+def time_loop(energy, mu_stack):
+    start = time.perf_counter()
+    for mu in mu_stack:
+        batch_reduce(energy, mu[None, :], AUTOBK_PARAMS, XFTF_PARAMS)
+    return time.perf_counter() - start
+
+# reduce the spectra one at a time with larch, None if larch is missing
+def time_larch(energy, mu_stack):
+    try:
+        import larch
+        from larch.xafs import pre_edge, autobk, xftf
+    except ImportError:
+        return None
+    my_larch = larch.Interpreter()
+    start = time.perf_counter()
+    for mu in mu_stack:
+        a_group = larch.Group(energy=energy, mu=mu)
+        pre_edge(a_group, _larch=my_larch)
+        autobk(a_group, _larch=my_larch, **AUTOBK_PARAMS)
+        xftf(a_group, _larch=my_larch, **XFTF_PARAMS)
+    return time.perf_counter() - start
+
+def format_time(value):
+    if value is None:
+        return "{:>12}".format("-")
+    return "{:12.3f}".format(value)
+
+def run_benchmark(sizes, loop_max):
+    energy = energy_grid()
+    print("{:>8} {:>12} {:>12} {:>12} {:>8}".format(
+        "spectra", "batch (s)", "loop (s)", "larch (s)", "speedup"))
+    for size in sizes:
+        mu_stack = synthetic_mu(energy, size)
+        batch_time = time_batch(energy, mu_stack)
+        # time at most loop_max spectra in the loops and scale the result
+        n_loop = min(size, loop_max)
+        loop_time = time_loop(energy, mu_stack[:n_loop]) * size / n_loop
+        larch_time = time_larch(energy, mu_stack[:n_loop])
+        if larch_time is not None:
+            larch_time = larch_time * size / n_loop
+        reference = larch_time if larch_time is not None else loop_time
+        print("{:8d} {} {} {} {:8.1f}".format(
+            size, format_time(batch_time), format_time(loop_time),
+            format_time(larch_time), reference / batch_time))
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    loop_max = 200
+    if '--loop-max' in args:
+        position = args.index('--loop-max')
+        loop_max = int(args[position + 1])
+        del args[position:position + 2]
+    sizes = [int(size) for size in args] or [100, 1000, 5000]
+    run_benchmark(sizes, loop_max)
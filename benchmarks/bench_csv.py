@@ -0,0 +1,73 @@
+# benchmark for writing energy and normalised mu csv files
+# compares xas_csv.write_csv_columns with the previous save_e_nmu, which built
+# a dictionary for each row and wrote it with write_csv_data, and checks that
+# both write the same file.
+#
+# usage:
+#   python benchmarks/bench_csv.py [points per spectrum] [number of spectra]
+
+import sys
+import csv
+import time
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+# make the scripts in the repository root importable
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from xas_csv import write_csv_columns
+from synthetic_spectra import energy_grid, synthetic_mu
+
+# previous implementation of write_csv_data and save_e_nmu
+def legacy_write_csv_data(values, filename):
+    fieldnames = []
+    for item in values.keys():
+        for key in values[item].keys():
+            if not key in fieldnames:
+                fieldnames.append(key)
+    with open(filename, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        writer.writeheader()
+        for key in values.keys():
+            writer.writerow(values[key])
+
+def legacy_save_e_nmu(energy, norm, filename):
+    export = {}
+    for n_index, value in enumerate(energy):
+        export[n_index] = {'energy':value, 'norm':norm[n_index]}
+    legacy_write_csv_data(export, filename)
+
+def save_e_nmu(energy, norm, filename):
+    write_csv_columns({'energy': energy, 'norm': norm}, filename)
+
+def run_benchmark(n_points, n_spectra):
+    energy = energy_grid(n_points=n_points)
+    norm_stack = synthetic_mu(energy, n_spectra)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_dir = Path(temp_dir)
+        times = {}
+        for name, writer in [('legacy', legacy_save_e_nmu),
+                             ('columns', save_e_nmu)]:
+            start = time.perf_counter()
+            for index, norm in enumerate(norm_stack):
+                writer(energy, norm, temp_dir / (name + str(index) + ".csv"))
+            times[name] = time.perf_counter() - start
+        same = all((temp_dir / ("legacy" + str(index) + ".csv")).read_bytes() ==
+                   (temp_dir / ("columns" + str(index) + ".csv")).read_bytes()
+                   for index in range(n_spectra))
+    print("{} spectra of {} points".format(n_spectra, n_points))
+    print("  legacy save_e_nmu: {:8.3f} s".format(times['legacy']))
+    print("  write_csv_columns: {:8.3f} s".format(times['columns']))
+    print("  speedup: {:.1f}, same output: {}".format(
+        times['legacy'] / times['columns'], same))
+
+if __name__ == "__main__":
+    n_points = 10000
+    n_spectra = 20
+    if len(sys.argv) > 1:
+        n_points = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        n_spectra = int(sys.argv[2])
+    run_benchmark(n_points, n_spectra)
@@ -0,0 +1,187 @@
+# benchmark for grouping file names
+# compares the single pass grouping in xas_file_groups with the previous
+# pairwise SequenceMatcher implementation on synthetic file names like
+#   223752_sample1_insitu_ramp_He_12.dat
+#
+# usage:
+#   python benchmarks/bench_file_groups.py [sizes] [--legacy-max N]
+# example:
+#   python benchmarks/bench_file_groups.py 1000 10000 100000
+
+import sys
+import time
+import logging
+import tempfile
+from pathlib import Path
+from difflib import SequenceMatcher
+
+# make the scripts in the repository root importable
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from xas_file_groups import group_file_names
+
+# synthetic_file_names
+# names for several samples and gases, with unpadded scan numbers as written
+# by the beamline, returned in sorted order as glob would give them
+def synthetic_file_names(n_files, scans_per_run=1000):
+    gases = ['He', 'H2', 'O2', 'CO']
+    file_names = []
+    run = 0
+    while len(file_names) < n_files:
+        sample = run // len(gases) + 1
+        gas = gases[run % len(gases)]
+        for scan in range(1, scans_per_run + 1):
+            if len(file_names) == n_files:
+                break
+            file_names.append("223752_sample" + str(sample) + "_insitu_ramp_" +
+                              gas + "_" + str(scan) + ".dat")
+        run += 1
+    return sorted(file_names)
+
+# get_file_groups and get_common below are the previous implementation,
+# copied without changes from xas_read_files.py before the grouping was moved
+# to xas_file_groups.py. It reads the file names from a directory, so the
+# benchmark writes empty files with the synthetic names. It can fail on large
+# runs (a pattern is removed twice), which is reported instead of the result.
+def get_file_groups(source_dir, filename_pattern, group_files):
+    #i_counter = 0
+    files_list = []
+    for filepath in sorted(source_dir.glob(filename_pattern)):
+        #i_counter += 1
+        files_list.append(filepath)
+    log_message = "Found " + str(len(files_list)) + \
+        " files to process with pattern: " + \
+        filename_pattern + \
+        "in dir: " + str(source_dir) + " Group: " +str(group_files)
+    logging.info(log_message)
+    pattern_current = ""
+    file_groups = {}
+
+    if group_files:
+        for index, a_file in enumerate(files_list):
+            file_name = a_file.name
+            if index < len(files_list)-1:
+                another_file = files_list[index+1].name
+                common_pattern = get_common(file_name, another_file)
+                if pattern_current == "":
+                    pattern_current = common_pattern
+                    if pattern_current in file_groups:
+                        file_groups[pattern_current] += [file_name, another_file]
+                    else:
+                        file_groups[pattern_current] = [file_name, another_file]
+                elif pattern_current == common_pattern:
+                    file_groups[pattern_current].append(another_file)
+                else:
+                    pattern_current = ""
+            else:
+                another_file = ""
+
+        patterns_found = file_groups.keys()
+        patterns_remove = []
+
+        # mark redundant patterns to remove
+        for pattern_check in file_groups:
+            for pattern_other in patterns_found:
+                if pattern_other != pattern_check:
+                    # use sets to ignore duplicates
+                    set_check = set(file_groups[pattern_check])
+                    set_other = set(file_groups[pattern_other])
+                    if pattern_other in pattern_check:
+                        #merge check into other and remove check
+                        file_groups[pattern_other] = list(set_other.union(set_check))
+                        patterns_remove.append(pattern_check)
+                    elif pattern_other in pattern_check:
+                        #merge other into check and remove other
+                        patterns_remove.append(pattern_other)
+                        file_groups[pattern_check] = list(set_other.union(set_check))
+    
+        # remove redundant patterns
+        if len(patterns_remove) > 0:
+            for pattern_rem in patterns_remove:
+                file_groups.pop(pattern_rem)
+    else:
+        file_groups['unique'] = []
+        for file in files_list:
+            file_groups['unique'].append(file.name)
+        
+    for pattern in file_groups: 
+        log_message = str(len(file_groups[pattern])) + " files to process with pattern " + pattern + "\nFiles: " + str(file_groups[pattern])
+        logging.info(log_message)
+    return file_groups
+
+
+# get the common pattern between the two strings
+def get_common(file_1, file_2):
+    common_pattern = ""
+    seqMatch = SequenceMatcher(None, file_1, file_2)
+    match = seqMatch.find_longest_match(0, len(file_1), 0, len(file_2))
+    if (match.size!=0): 
+        common_pattern = file_1[match.a: match.a + match.size]
+    else: 
+         log_message = 'No longest common sub-string found'
+         logging.info(log_message)
+    return common_pattern
+
+# legacy_group_file_names
+# run the previous implementation on empty files with the given names
+# output:
+#  - the groups, None if it failed
+#  - the time taken, without writing the files
+#  - the error, None if it worked
+def legacy_group_file_names(file_names):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        source_dir = Path(temp_dir)
+        for file_name in file_names:
+            (source_dir / file_name).touch()
+        start = time.perf_counter()
+        try:
+            groups = get_file_groups(source_dir, '*', True)
+        except Exception as error:
+            return None, time.perf_counter() - start, error
+        return groups, time.perf_counter() - start, None
+
+# compare groups ignoring the order of the files in each group
+def same_groups(groups_1, groups_2):
+    if list(groups_1.keys()) != list(groups_2.keys()):
+        return False
+    for pattern in groups_1:
+        if set(groups_1[pattern]) != set(groups_2[pattern]):
+            return False
+    return True
+
+def time_call(function, argument):
+    start = time.perf_counter()
+    result = function(argument)
+    return result, time.perf_counter() - start
+
+def run_benchmark(sizes, legacy_max):
+    print("{:>8} {:>8} {:>12} {:>12} {:>8}".format(
+        "files", "groups", "new (s)", "legacy (s)", "same"))
+    for size in sizes:
+        file_names = synthetic_file_names(size)
+        groups, new_time = time_call(group_file_names, file_names)
+        if size <= legacy_max:
+            legacy_groups, legacy_time, error = legacy_group_file_names(
+                file_names)
+            legacy_text = "{:12.3f}".format(legacy_time)
+            if error is None:
+                same_text = str(same_groups(groups, legacy_groups))
+            else:
+                same_text = "legacy " + type(error).__name__
+        else:
+            legacy_text = "{:>12}".format("skipped")
+            same_text = "-"
+        print("{:8d} {:8d} {:12.3f} {} {:>8}".format(
+            size, len(groups), new_time, legacy_text, same_text))
+
+if __name__ == "__main__":
+    # the grouping functions log every missing match, keep the output clean
+    logging.disable(logging.INFO)
+    args = sys.argv[1:]
+    legacy_max = 100000
+    if '--legacy-max' in args:
+        position = args.index('--legacy-max')
+        legacy_max = int(args[position + 1])
+        del args[position:position + 2]
+    sizes = [int(size) for size in args] or [1000, 10000, 100000]
+    run_benchmark(sizes, legacy_max)
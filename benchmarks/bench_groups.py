@@ -0,0 +1,80 @@
+# benchmark for adding mu to large groups and copying them
+# compares the dictionary round trip (group2dict and dict2group), a deep copy
+# (larch copy_group) and xas_groups (add_mu in place and clone_group sharing
+# the arrays). Memory is the size of the new allocations (tracemalloc).
+# Needs larch.
+#
+# usage:
+#   python benchmarks/bench_groups.py [points per array] [number of arrays]
+
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+
+# make the scripts in the repository root importable
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import larch
+from larch.utils import group2dict, dict2group, copy_group
+from xas_groups import add_mu, clone_group, group_nbytes
+
+# make a group with energy, i0, it and other columns
+def make_group(n_points, n_arrays):
+    rng = np.random.default_rng(0)
+    xafs_group = larch.Group(filename='bench.dat',
+                             energy=np.linspace(6900, 8000, n_points),
+                             i0=rng.uniform(1.e5, 2.e5, n_points),
+                             it=rng.uniform(1.e4, 2.e4, n_points))
+    for index in range(n_arrays):
+        setattr(xafs_group, 'column_%d' % index, rng.normal(size=n_points))
+    return xafs_group
+
+def dict_get_mu(xafs_group):
+    xafs_dict = group2dict(xafs_group)
+    xafs_dict['mu'] = np.log(abs(xafs_group.i0 / xafs_group.it))
+    return dict2group(xafs_dict)
+
+def dict_copy_group(xafs_group):
+    new_group = dict2group(group2dict(xafs_group).copy())
+    new_group.filename = new_group.filename + "_copy"
+    return new_group
+
+# time and memory allocated by a function of the group
+def measure(function, xafs_group, repeat=5):
+    tracemalloc.start()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function(xafs_group)
+    elapsed = (time.perf_counter() - start) / repeat
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, result
+
+def run_benchmark(n_points, n_arrays):
+    print("group with " + str(n_arrays + 3) + " arrays of " + str(n_points) +
+          " points, %.1f MB" % (group_nbytes(make_group(n_points, n_arrays))
+                                / 1024**2))
+    print("{:>26} {:>10} {:>12}".format("operation", "time (ms)",
+                                        "memory (MB)"))
+    cases = [("get_mu dict round trip", dict_get_mu),
+             ("add_mu in place", add_mu),
+             ("copy dict round trip", dict_copy_group),
+             ("larch copy_group", copy_group),
+             ("clone_group", clone_group)]
+    for name, function in cases:
+        xafs_group = make_group(n_points, n_arrays)
+        elapsed, peak, _ = measure(function, xafs_group)
+        print("{:>26} {:10.3f} {:12.2f}".format(name, elapsed * 1000,
+                                                peak / 1024**2))
+
+if __name__ == "__main__":
+    n_points = 1000000
+    n_arrays = 10
+    if len(sys.argv) > 1:
+        n_points = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        n_arrays = int(sys.argv[2])
+    run_benchmark(n_points, n_arrays)
@@ -0,0 +1,64 @@
+# benchmark for loading data files
+# compares xas_loader.load_columns with a line by line python parser (as
+# done by larch read_ascii) and with larch read_ascii when larch is installed.
+#
+# usage:
+#   python benchmarks/bench_loader.py [number of files]
+
+import sys
+import time
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+# make the scripts in the repository root importable
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from xas_loader import load_columns
+from synthetic_spectra import write_data_files, DATA_COLUMNS
+
+# python_parser
+# line by line parsing of all the columns
+def python_parser(file_path, data_columns):
+    rows = []
+    with open(file_path) as data_file:
+        for line in data_file:
+            if line.startswith('#'):
+                continue
+            rows.append([float(word) for word in line.split()])
+    data = np.array(rows).transpose()
+    return {name: data[index] for name, index in data_columns.items()}
+
+def larch_reader(file_path, data_columns):
+    import larch
+    xafsdat = larch.io.read_ascii(str(file_path))
+    return {name: xafsdat.data[index] for name, index in data_columns.items()}
+
+def time_reader(reader, file_paths):
+    start = time.perf_counter()
+    for file_path in file_paths:
+        reader(file_path, DATA_COLUMNS)
+    return time.perf_counter() - start
+
+def run_benchmark(n_files):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_paths = write_data_files(Path(temp_dir), n_files)
+        readers = [('load_columns', load_columns),
+                   ('python parser', python_parser)]
+        try:
+            import larch
+            readers.append(('larch read_ascii', larch_reader))
+        except ImportError:
+            pass
+        print("{:>18} {:>10} {:>14}".format("reader", "time (s)", "ms per file"))
+        for name, reader in readers:
+            elapsed = time_reader(reader, file_paths)
+            print("{:>18} {:10.3f} {:14.3f}".format(
+                name, elapsed, 1000 * elapsed / n_files))
+
+if __name__ == "__main__":
+    n_files = 1000
+    if len(sys.argv) > 1:
+        n_files = int(sys.argv[1])
+    run_benchmark(n_files)
@@ -0,0 +1,88 @@
+# benchmark for the memory used by many processed spectra
+# compares keeping larch groups (with the columns read from the file and the
+# arrays of pre_edge, autobk and xftf) with keeping xas_record.SpectrumRecord
+# records, and the size of each when pickled (as sent back by the pool
+# workers). Memory is the size of the allocations (tracemalloc). Needs larch.
+#
+# usage:
+#   python benchmarks/bench_record.py [number of spectra]
+
+import sys
+import time
+import pickle
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+
+# make the scripts in the repository root importable
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import larch
+from xas_record import SpectrumRecord
+from synthetic_spectra import energy_grid, synthetic_mu
+
+# processed group as made by xas_read_files: data table, columns and the
+# arrays set by the larch functions
+def make_group(index, energy, mu):
+    n_k, n_r = 321, 326
+    xafs_group = larch.Group(path='data/sample_%05d.dat' % index,
+                             filename='sample_%05d.dat' % index,
+                             label='sample_%05d' % index,
+                             header=['energy time i0 it ir mu mur'],
+                             array_labels=['energy', 'time', 'i0', 'it',
+                                           'ir', 'mu', 'mur'],
+                             e0=7112.0, edge_step=1.0)
+    xafs_group.data = np.vstack([energy, energy, mu, mu, mu, mu, mu])
+    for name, row in (('energy', 0), ('time', 1), ('i0', 2), ('it', 3),
+                      ('ir', 4), ('mu', 5), ('mue', 6)):
+        setattr(xafs_group, name, xafs_group.data[row])
+    for name in ('bkg', 'pre_edge', 'post_edge', 'norm', 'flat', 'dmude'):
+        setattr(xafs_group, name, mu.copy())
+    xafs_group.k = np.arange(n_k) * 0.05
+    xafs_group.chi = np.sin(xafs_group.k)
+    xafs_group.kwin = np.ones(n_k)
+    xafs_group.r = np.arange(n_r) * 0.0307
+    for name in ('chir_mag', 'chir_re', 'chir_im'):
+        setattr(xafs_group, name, np.cos(xafs_group.r))
+    return xafs_group
+
+# memory allocated by a list of spectra made by a function
+def measure(function, energy, mu_stack):
+    tracemalloc.start()
+    start = time.perf_counter()
+    spectra = [function(index, energy, mu)
+               for index, mu in enumerate(mu_stack)]
+    elapsed = time.perf_counter() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return spectra, current, elapsed
+
+def run_benchmark(n_spectra):
+    energy = energy_grid()
+    mu_stack = synthetic_mu(energy, n_spectra)
+    groups, group_bytes, group_time = measure(make_group, energy, mu_stack)
+    del groups
+    records, record_bytes, record_time = measure(
+        lambda index, energy, mu: SpectrumRecord.from_group(
+            make_group(index, energy, mu)), energy, mu_stack)
+    group_pickle = len(pickle.dumps(make_group(0, energy, mu_stack[0])))
+    record_pickle = len(pickle.dumps(records[0]))
+
+    print(str(n_spectra) + " spectra of " + str(len(energy)) + " points")
+    print("{:>16} {:>12} {:>14} {:>14}".format("kept as", "memory (MB)",
+                                               "per spectrum", "pickled (kB)"))
+    print("{:>16} {:12.1f} {:14.0f} {:14.1f}".format(
+        "larch groups", group_bytes / 1024**2, group_bytes / n_spectra,
+        group_pickle / 1024))
+    print("{:>16} {:12.1f} {:14.0f} {:14.1f}".format(
+        "records", record_bytes / 1024**2, record_bytes / n_spectra,
+        record_pickle / 1024))
+    print("time to make: groups %.2f s, records (from groups) %.2f s" %
+          (group_time, record_time))
+
+if __name__ == "__main__":
+    n_spectra = 2000
+    if len(sys.argv) > 1:
+        n_spectra = int(sys.argv[1])
+    run_benchmark(n_spectra)
@@ -0,0 +1,288 @@
+# benchmark suite of the reduction pipeline
+# synthetic data files in the 7 column layout of xas_processing.ini are
+# written for each dataset size and the stages of the processing done by
+# xas_read_files, calc_with_defaults and the LCF script are timed:
+#
+#   grouping       xas_file_groups.get_file_groups
+#   loading        xas_loader.load_columns (and larch read_ascii, --read-ascii)
+#   normalisation  larch pre_edge
+#   background     larch autobk (xas_read_files parameters)
+#   fft            larch xftf (xas_read_files parameters)
+#   merge          xas_merge.RunningMerge of each pattern
+#   plotting       xas_plots.PlotRenderer (at most --plots spectra)
+#   csv            xas_csv.write_csv_columns of energy and norm
+#   athena         xas_athena.write_athena_project
+#   lcf            xas_lcf.batch_lcf with three synthetic standards
+#
+# the spectra are made with fixed seeds, so the results of the processing
+# (mean e0, edge step, |chi(R)| peak, merge and LCF weights) are the same in
+# every run and are checked against the baseline too. Needs larch.
+#
+# usage:
+#   python benchmarks/bench_suite.py [sizes] [--save-baseline] [--baseline FILE]
+#                                    [--tolerance RATIO] [--plots N] [--read-ascii]
+# example:
+#   python benchmarks/bench_suite.py 10 100 1000 --save-baseline
+#   python benchmarks/bench_suite.py 10 100 1000      # compare with the baseline
+
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+from pathlib import Path
+from contextlib import contextmanager
+
+import numpy as np
+
+# make the scripts in the repository root importable
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import larch
+from larch.xafs import pre_edge, autobk, xftf
+
+from xas_file_groups import get_file_groups
+from xas_loader import load_columns
+from xas_merge import RunningMerge
+from xas_plots import PlotRenderer, plot_data
+from xas_csv import write_csv_columns
+from xas_athena import write_athena_project
+from xas_lcf import batch_lcf
+from synthetic_spectra import (energy_grid, synthetic_mu, write_data_files,
+                               DATA_COLUMNS)
+
+# processing parameters of xas_read_files
+AUTOBK_PARAMS = {'rbkg': 1.0, 'kweight': 2}
+XFTF_PARAMS = {'kmin': 2, 'kmax': 15, 'dk': 3, 'kweight': 2}
+
+# stages in the order they are run
+STAGES = ['grouping', 'loading', 'read_ascii', 'normalisation', 'background',
+          'fft', 'merge', 'plotting', 'csv', 'athena', 'lcf']
+
+DEFAULT_BASELINE = Path(__file__).resolve().parent / 'baseline.json'
+
+# differences smaller than this are timing noise (s)
+MIN_DIFFERENCE = 0.005
+
+# relative difference of the results accepted
+RESULT_RTOL = 1.e-6
+
+@contextmanager
+def timed(timings, name):
+    start = time.perf_counter()
+    yield
+    timings[name] = time.perf_counter() - start
+
+# standards for the LCF: the synthetic spectrum with the edge moved
+def make_standards():
+    energy = energy_grid()
+    standards = []
+    for index, shift in enumerate([-2.0, 0.0, 3.0]):
+        mu = synthetic_mu(energy, 1, e0=7112.0 + shift, noise=0.0,
+                          seed=100 + index)[0]
+        standard = larch.Group(energy=energy, mu=mu,
+                               label='standard_' + str(index))
+        pre_edge(standard)
+        standards.append(standard)
+    return standards
+
+# run_size
+# write the files of a dataset and time each stage
+# output:
+#  - dictionary of stage times (s) and dictionary of result values
+def run_size(n_files, work_dir, max_plots=20, read_ascii=False):
+    data_dir = work_dir / 'data'
+    data_dir.mkdir()
+    # two samples, so the grouping finds two patterns
+    n_first = n_files // 2
+    write_data_files(data_dir, n_first, "223752_sample1_insitu_ramp_He_",
+                     seed=1)
+    write_data_files(data_dir, n_files - n_first,
+                     "223753_sample2_insitu_ramp_H2_", seed=2)
+    timings = {}
+
+    with timed(timings, 'grouping'):
+        file_groups = get_file_groups(data_dir, '*.dat', True)
+    file_names = [name for pattern in file_groups
+                  for name in file_groups[pattern]]
+
+    with timed(timings, 'loading'):
+        groups = [load_columns(data_dir / name, DATA_COLUMNS).group()
+                  for name in file_names]
+    if read_ascii:
+        with timed(timings, 'read_ascii'):
+            for name in file_names:
+                larch.io.read_ascii(str(data_dir / name))
+    for xafs_group in groups:
+        xafs_group.label = xafs_group.filename[:-4]
+
+    with timed(timings, 'normalisation'):
+        for xafs_group in groups:
+            pre_edge(xafs_group)
+    with timed(timings, 'background'):
+        for xafs_group in groups:
+            autobk(xafs_group, **AUTOBK_PARAMS)
+    with timed(timings, 'fft'):
+        for xafs_group in groups:
+            xftf(xafs_group, **XFTF_PARAMS)
+
+    by_name = {xafs_group.filename: xafs_group for xafs_group in groups}
+    merges = []
+    with timed(timings, 'merge'):
+        for pattern in file_groups:
+            merge = RunningMerge()
+            for name in file_groups[pattern]:
+                merge.add(by_name[name])
+            merges.append(merge.result())
+
+    plot_dir = work_dir / 'plots'
+    with timed(timings, 'plotting'):
+        renderer = PlotRenderer()
+        for xafs_group in groups[:max_plots]:
+            renderer.render(plot_data(xafs_group, plot_dir))
+
+    csv_dir = work_dir / 'csv'
+    with timed(timings, 'csv'):
+        for xafs_group in groups:
+            write_csv_columns({'energy': xafs_group.energy,
+                               'norm': xafs_group.norm},
+                              csv_dir / (xafs_group.label + "_EvNm.csv"))
+
+    with timed(timings, 'athena'):
+        write_athena_project(work_dir / 'bench.prj', groups)
+
+    standards = make_standards()
+    with timed(timings, 'lcf'):
+        lcf_result = batch_lcf(groups, standards)
+
+    results = {
+        'files': len(groups),
+        'patterns': len(file_groups),
+        'e0_mean': float(np.mean([a_group.e0 for a_group in groups])),
+        'edge_step_mean': float(np.mean([a_group.edge_step
+                                         for a_group in groups])),
+        'chir_peak_mean': float(np.mean([np.max(a_group.chir_mag)
+                                         for a_group in groups])),
+        'merge_mu_mean': float(np.mean([np.mean(merged.mu)
+                                        for merged in merges])),
+        'lcf_weights_mean': [float(value)
+                             for value in lcf_result.weights.mean(axis=0)],
+        'lcf_redchi_mean': float(np.mean(lcf_result.redchi)),
+    }
+    return timings, results
+
+def environment():
+    return {'python': platform.python_version(),
+            'numpy': np.__version__,
+            'larch': getattr(larch, '__version__', ''),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpus': os.cpu_count()}
+
+# compare
+# compare the times and results with the baseline
+# output:
+#  - list of lines describing the differences, empty if none
+def compare(report, baseline, tolerance):
+    lines = []
+    for size, timings in report['timings'].items():
+        base_timings = baseline['timings'].get(size)
+        if base_timings is None:
+            continue
+        for name, value in timings.items():
+            base_value = base_timings.get(name)
+            if base_value is None:
+                continue
+            if value > base_value * tolerance and \
+                    value - base_value > MIN_DIFFERENCE:
+                lines.append("slower  %6s files %-14s %8.3f s (baseline %8.3f s, x%.2f)"
+                             % (size, name, value, base_value,
+                                value / base_value))
+            elif value * tolerance < base_value and \
+                    base_value - value > MIN_DIFFERENCE:
+                lines.append("faster  %6s files %-14s %8.3f s (baseline %8.3f s, x%.2f)"
+                             % (size, name, value, base_value,
+                                value / base_value))
+    for size, results in report['results'].items():
+        base_results = baseline['results'].get(size)
+        if base_results is None:
+            continue
+        for name, value in results.items():
+            if name not in base_results:
+                continue
+            if not np.allclose(value, base_results[name], rtol=RESULT_RTOL,
+                               atol=0.0):
+                lines.append("changed %6s files %-14s %s (baseline %s)"
+                             % (size, name, value, base_results[name]))
+    return lines
+
+def print_timings(report):
+    sizes = list(report['timings'])
+    print("{:>14}".format("stage") +
+          "".join("{:>12}".format(size + " files") for size in sizes))
+    for name in STAGES:
+        if not any(name in report['timings'][size] for size in sizes):
+            continue
+        print("{:>14}".format(name) +
+              "".join("{:12.3f}".format(report['timings'][size][name])
+                      if name in report['timings'][size] else "{:>12}".format("")
+                      for size in sizes))
+
+def run_suite(sizes, baseline_file, save_baseline=False, tolerance=1.25,
+              max_plots=20, read_ascii=False):
+    report = {'environment': environment(), 'timings': {}, 'results': {}}
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            timings, results = run_size(size, Path(temp_dir), max_plots,
+                                        read_ascii)
+        report['timings'][str(size)] = timings
+        report['results'][str(size)] = results
+    print_timings(report)
+
+    if save_baseline:
+        with open(baseline_file, 'w') as json_file:
+            json.dump(report, json_file, indent=1)
+        print("baseline saved in " + str(baseline_file))
+        return 0
+    if not Path(baseline_file).exists():
+        print("no baseline in " + str(baseline_file) +
+              ", save one with --save-baseline")
+        return 0
+    with open(baseline_file) as json_file:
+        baseline = json.load(json_file)
+    if baseline.get('environment') != report['environment']:
+        print("baseline saved with a different environment: " +
+              str(baseline.get('environment')))
+    differences = compare(report, baseline, tolerance)
+    for line in differences:
+        print(line)
+    if not differences:
+        print("same as the baseline (tolerance x%.2f)" % tolerance)
+    # exit code 1 when slower or with different results
+    return int(any(not line.startswith('faster') for line in differences))
+
+if __name__ == "__main__":
+    sizes = []
+    baseline_file = DEFAULT_BASELINE
+    save_baseline = False
+    tolerance = 1.25
+    max_plots = 20
+    read_ascii = False
+    args = sys.argv[1:]
+    while args:
+        arg = args.pop(0)
+        if arg == '--save-baseline':
+            save_baseline = True
+        elif arg == '--baseline':
+            baseline_file = Path(args.pop(0))
+        elif arg == '--tolerance':
+            tolerance = float(args.pop(0))
+        elif arg == '--plots':
+            max_plots = int(args.pop(0))
+        elif arg == '--read-ascii':
+            read_ascii = True
+        else:
+            sizes.append(int(arg))
+    sys.exit(run_suite(sizes or [10, 100], baseline_file, save_baseline,
+                       tolerance, max_plots, read_ascii))
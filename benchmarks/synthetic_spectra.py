@@ -0,0 +1,75 @@
+# synthetic xafs spectra for the benchmarks
+# spectra of an Fe K edge with an arctan-like edge, pre-edge and post-edge
+# slopes and EXAFS oscillations of two shells, with small changes of
+# amplitude and noise between spectra as in a time resolved run.
+
+from pathlib import Path
+
+import numpy as np
+
+# conversion of energy (eV) above the edge to k (1/A)
+ETOK = 0.2624682843
+
+# energy_grid
+# typical transmission scan: coarse pre-edge, fine XANES and steps of
+# constant k above the edge
+def energy_grid(e0=7112.0, n_points=None):
+    pre_edge = np.arange(e0 - 200, e0 - 20, 5.0)
+    xanes = np.arange(e0 - 20, e0 + 30, 0.5)
+    k_values = np.arange(np.sqrt(ETOK * 30), 16.0, 0.05)
+    exafs = e0 + k_values**2 / ETOK
+    energy = np.concatenate([pre_edge, xanes, exafs])
+    if n_points is not None:
+        # resample to a given number of points covering the same range
+        energy = np.linspace(energy[0], energy[-1], n_points)
+    return energy
+
+# synthetic_mu
+# stack of mu(E) for a run of spectra on the same energy grid
+# output:
+#  - array (n_spectra, n_energy)
+def synthetic_mu(energy, n_spectra, e0=7112.0, noise=1.e-3, seed=0):
+    rng = np.random.default_rng(seed)
+    k = np.sqrt(np.clip(ETOK * (energy - e0), 0, None))
+    # two shells, Fe-O at 2.0 A and Fe-Fe at 3.0 A
+    chi = 0.6 * np.sin(2 * k * 2.0 + 0.3) * np.exp(-2 * 0.005 * k**2) + \
+        0.3 * np.sin(2 * k * 3.0 + 1.1) * np.exp(-2 * 0.008 * k**2)
+    chi = chi * np.exp(-k / 20) / np.maximum(k, 1.0)
+    edge = 0.5 + np.arctan((energy - e0) / 1.5) / np.pi
+    # white line just above the edge
+    white_line = 0.4 * np.exp(-((energy - e0 - 8) / 4)**2)
+    mu = 0.15 + 2.e-4 * (energy - e0) + \
+        edge * (1 + chi - 2.e-7 * np.clip(energy - e0, 0, None)**2) + white_line
+    scale = rng.uniform(0.95, 1.05, (n_spectra, 1))
+    shift = rng.uniform(-0.02, 0.02, (n_spectra, 1))
+    return mu[None, :] * scale + shift + \
+        rng.normal(0, noise, (n_spectra, len(energy)))
+
+# column layout of xas_processing.ini
+DATA_COLUMNS = {'energy': 0, 'time': 1, 'i0': 2, 'it': 3, 'ir': 4, 'mu': 5,
+                'mur': 6}
+
+# write_data_files
+# synthetic files in the 7 column layout of xas_processing.ini
+# input:
+#  - directory of the files
+#  - number of files
+#  - start of the file names, the files are numbered from 1
+#  - seed of the noise and changes between spectra
+# output:
+#  - list of file paths
+def write_data_files(data_dir, n_files,
+                     prefix="223752_sample1_insitu_ramp_He_", seed=0):
+    energy = energy_grid()
+    mu_stack = synthetic_mu(energy, n_files, seed=seed)
+    file_paths = []
+    for index, mu in enumerate(mu_stack):
+        i0 = np.full(len(energy), 1.e5)
+        it = i0 * np.exp(-mu)
+        table = np.column_stack([energy, np.arange(len(energy)) * 0.1, i0, it,
+                                 it * 0.5, mu, mu * 0.98])
+        file_path = Path(data_dir) / (prefix + str(index + 1) + ".dat")
+        np.savetxt(file_path, table, fmt='%.6f',
+                   header="synthetic spectrum\nenergy time i0 it ir mu mur")
+        file_paths.append(file_path)
+    return file_paths
@@ -0,0 +1,99 @@
+# import check of the scripts and modules of the repository
+# each module of the repository is imported, and the names other scripts
+# take from it (from xas_pipeline import XafsPipeline...) are looked up, so a
+# change removing a function or class still used somewhere is found without
+# running the scripts. Scripts doing their processing when imported (eg:
+# xafs_processing_2.py) are not imported, only the names they use are
+# checked. Modules with side effects when imported (xas_read_files sets up
+# the processing log) are not imported either, the names used from them are
+# looked up in their source. Needs larch.
+#
+# usage:
+#   python check_imports.py
+# the missing modules and names are listed and the exit code is 1 if any
+
+import ast
+import sys
+import importlib
+import traceback
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent
+
+# scripts checked for the names they import from the repository modules
+SCRIPT_DIRS = [ROOT, ROOT / 'benchmarks']
+
+# modules starting a program or setting up logging when imported, they are
+# not imported
+NOT_IMPORTED = {'xas_viewer', 'xas_read_files'}
+
+# modules of the repository used by the scripts
+def local_modules():
+    return {path.stem for path in ROOT.glob('xas_*.py')}
+
+# names imported from each repository module by a script
+# output:
+#  - dict of module name: list of (script, name)
+def imported_names(modules):
+    used = {}
+    for directory in SCRIPT_DIRS:
+        for script in sorted(directory.glob('*.py')):
+            tree = ast.parse(script.read_text(encoding='utf-8'),
+                             filename=str(script))
+            for node in ast.walk(tree):
+                if (isinstance(node, ast.ImportFrom) and node.level == 0
+                        and node.module in modules):
+                    for alias in node.names:
+                        used.setdefault(node.module, []).append(
+                            (script.relative_to(ROOT), alias.name))
+    return used
+
+# names defined at the top level of a module, from its source
+def defined_names(module_name):
+    tree = ast.parse((ROOT / (module_name + '.py')).read_text(encoding='utf-8'))
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef,
+                             ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, (ast.Assign, ast.AnnAssign)):
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            for target in targets:
+                names.update(name.id for name in ast.walk(target)
+                             if isinstance(name, ast.Name))
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            names.update((alias.asname or alias.name).split('.')[0]
+                         for alias in node.names)
+    return names
+
+def check_imports():
+    sys.path.insert(0, str(ROOT))
+    modules = local_modules()
+    problems = []
+    for module_name in sorted(modules - NOT_IMPORTED):
+        try:
+            importlib.import_module(module_name)
+        except Exception:
+            problems.append(module_name + ': import failed\n'
+                            + traceback.format_exc(limit=1))
+    for module_name, names in sorted(imported_names(modules).items()):
+        if module_name in NOT_IMPORTED:
+            available = defined_names(module_name)
+        else:
+            module = sys.modules.get(module_name)
+            if module is None:
+                continue
+            available = set(dir(module))
+        for script, name in names:
+            if name != '*' and name not in available:
+                problems.append(str(script) + ': ' + name + ' not found in '
+                                + module_name)
+    return problems
+
+if __name__ == '__main__':
+    problems = check_imports()
+    for problem in problems:
+        print(problem)
+    if problems:
+        sys.exit(1)
+    print('imports ok')
@@ -7,9 +7,8 @@
 
 # larch function for reading ascii data (usually txt)
 from larch.io import read_ascii
-# larch function for converting a group to a dictionary and
-# a dictionary into a group
-from larch.utils import group2dict, dict2group
+# adding mu and copying groups without copying their arrays
+from xas_groups import add_mu, clone_group
 # larch function for normalisation and flattening
 from larch.xafs import pre_edge
 # larch function for post-edge background substraction
@@ -18,8 +17,6 @@ from larch.xafs import autobk
 from larch.wxlib import plotlabels as plab
 # larch function for fourier transform
 from larch.xafs import xftf
-# logarithm function from numpy
-from numpy import log
 # ploting library
 import matplotlib.pyplot as plt
 
@@ -32,24 +29,14 @@ SUP = str.maketrans("0123456789", "⁰¹²³⁴⁵⁶⁷⁸⁹")
 # could need indicating which arrays to use
 # for calculation
 def get_mu(xafs_group):
-    # calculate mu
-    mu_e = log(abs(xafs_group.i0/xafs_group.it))
-    # get a dictionary from te group
-    xafs_dict = group2dict(xafs_group)
-    # add mu to the dictionary
-    xafs_dict['mu'] = mu_e
-    xafs_group = dict2group(xafs_dict)
-    return xafs_group
+    # calculate mu and add it to the group in place
+    return add_mu(xafs_group)
 
 # custom function for creating a copy of a
-# group
+# group, the copy shares the arrays of the group
+# until they are changed (see xas_groups.py)
 def copy_group(xafs_group):
-    # get a dictionary from te group
-    xafs_dict = group2dict(xafs_group).copy()
-    #xafs_dict['filename']=xafs_dict['filename']+"_copy"
-    new_group = dict2group(xafs_dict)
-    new_group.filename = new_group.filename+"_copy" 
-    return new_group
+    return clone_group(xafs_group, suffix="_copy")
 
 # custom function for printing group properties
 # needs fixing as groups can change depending
@@ -7,9 +7,8 @@
 
 # larch function for reading ascii data (usually txt)
 from larch.io import read_ascii
-# larch function for converting a group to a dictionary and
-# a dictionary into a group
-from larch.utils import group2dict, dict2group
+# adding mu and copying groups without copying their arrays
+from xas_groups import add_mu, clone_group
 # larch function for normalisation and flattening
 from larch.xafs import pre_edge
 # larch function for post-edge background substraction
@@ -21,12 +20,26 @@ from larch.xafs import xftf
 
 # import the larch.io libraries for managing athena files
 from larch.io import create_athena, read_athena, extract_athenagroup
-# import the larch.io function for merging groups interpolating if necessary
-from larch.io import merge_groups
+# athena projects written one group at a time
+from xas_athena import AthenaWriter
+# merging groups interpolating if necessary, same result as larch.io
+# merge_groups without keeping a copy of every interpolated group
+from xas_merge import merge_streaming
 
 
-# logarithm function from numpy
-from numpy import log
+# cache for reusing the results of pre_edge, autobk and xftf
+from xas_cache import ResultCache, process_with_cache
+
+# pre_edge, autobk and xftf running again only the steps affected by a change
+# of parameters
+from xas_pipeline import XafsPipeline
+
+# autobk and xftf for a grid of parameter values
+from xas_sweep import parameter_sweep
+
+# energy alignment and common e0 for all the groups of a project
+from xas_align import align_groups
+
 # ploting library
 import matplotlib.pyplot as plt
 
@@ -35,28 +48,29 @@ import matplotlib.pyplot as plt
 SUB = str.maketrans("0123456789", "₀₁₂₃₄₅₆₇₈₉")
 SUP = str.maketrans("0123456789", "⁰¹²³⁴⁵⁶⁷⁸⁹")
 
+# fourier transform parameters used in the tutorial
+XFTF_DEFAULTS = {'kweight': 0.5, 'kmin': 3.0, 'kmax': 12.871, 'dk': 1,
+                 'kwindow': 'Hanning'}
+
+# pre_edge and autobk use the larch defaults, e0 is found from the data
+PRE_EDGE_DEFAULTS = {'e0': None}
+AUTOBK_DEFAULTS = {'e0': None}
+
+# results are saved here and reused when the script is run again
+results_cache = ResultCache('XAFSExamples/cache')
+
 # custom function for calculating mu,
 # could need indicating which arrays to use
 # for calculation
 def get_mu(xafs_group):
-    # calculate mu
-    mu_e = log(abs(xafs_group.i0/xafs_group.it))
-    # get a dictionary from te group
-    xafs_dict = group2dict(xafs_group)
-    # add mu to the dictionary
-    xafs_dict['mu'] = mu_e
-    xafs_group = dict2group(xafs_dict)
-    return xafs_group
+    # calculate mu and add it to the group in place
+    return add_mu(xafs_group)
 
 # custom function for creating a copy of a
-# group
+# group, the copy shares the arrays of the group
+# until they are changed (see xas_groups.py)
 def copy_group(xafs_group):
-    # get a dictionary from te group
-    xafs_dict = group2dict(xafs_group).copy()
-    #xafs_dict['filename']=xafs_dict['filename']+"_copy"
-    new_group = dict2group(xafs_dict)
-    new_group.filename = new_group.filename+"_copy" 
-    return new_group
+    return clone_group(xafs_group, suffix="_copy")
 
 # custom function for printing group properties
 # needs fixing as groups can change depending
@@ -80,18 +94,23 @@ def print_contents(xafs_group):
 # V    mu, pre_edge, autobk and xftf for a group      V #
  #######################################################
 
-def calc_with_defaults(xafs_group):
+# the results can be reused from a cache (see xas_cache.py) when the same
+# data is processed again with the same parameters
+def calc_with_defaults(xafs_group, cache=None):
     # calculate mu and normalise with background extraction
     # should let the user specify the colums for i0, it, mu, iR. 
     if not hasattr(xafs_group, 'mu'):
         xafs_group = get_mu(xafs_group)    
-    # calculate pre-edge and post edge and add them to group
-    pre_edge(xafs_group, group=fe_xafs)
-    # perform background removal
-    autobk(xafs_group) # using defaults so no additional parameters are passed
-    # calculate fourier transform
-    xftf(xafs_group, kweight=0.5, kmin=3.0, kmax=12.871, dk=1, kwindow='Hanning')
-    return xafs_group
+    def process(a_group):
+        # calculate pre-edge and post edge and add them to group
+        pre_edge(a_group, **PRE_EDGE_DEFAULTS)
+        # perform background removal
+        autobk(a_group, **AUTOBK_DEFAULTS) # using defaults
+        # calculate fourier transform
+        xftf(a_group, **XFTF_DEFAULTS)
+    params = {'pre_edge': PRE_EDGE_DEFAULTS, 'autobk': AUTOBK_DEFAULTS,
+              'xftf': XFTF_DEFAULTS}
+    return process_with_cache(xafs_group, params, process, cache)
 
  #######################################################
 # |       Restore state of previous session           | #
@@ -104,21 +123,20 @@ fe_xafs = read_ascii('XAFSExamples/Fe_standards/Fe_lepidocrocite.000')
 # calculate mu and normalise with background extraction
 fe_xafs = get_mu(fe_xafs)
 
-# calculate pre-edge and post edge and add them to group
-pre_edge(fe_xafs, group=fe_xafs)
-
-# perform background removal
-autobk(fe_xafs) # using defaults so no additional parameters are passed
-
-# calculate fourier transform
-xftf(fe_xafs, kweight=0.5, kmin=3.0, kmax=12.871, dk=1, kwindow='Hanning')
+# calculate pre-edge and post edge, perform background removal (using
+# defaults) and calculate fourier transform. The pipeline keeps the results of
+# each step, so when a parameter is changed only the steps after it are
+# calculated again
+fe_pipeline = XafsPipeline(fe_xafs, xftf=XFTF_DEFAULTS)
+fe_pipeline.run()
 
 # create copy of initial group
 fe_xafs_copy = copy_group(fe_xafs)
 
 # redo calculations with modified bacground parameter
-autobk(fe_xafs_copy, rbkg=0.2)
-xftf(fe_xafs_copy, kweight=0.5, kmin=3.0, kmax=12.871, dk=1, kwindow='Hanning')
+fe_copy_pipeline = XafsPipeline(fe_xafs_copy, autobk={'rbkg': 0.2},
+                                xftf=XFTF_DEFAULTS)
+fe_copy_pipeline.run()
 
 # plot magnitudes in r-space to see we are at the same point where we left in
 # session 1
@@ -139,8 +157,8 @@ plt.show()
 # https://vimeo.com/340215763 00:50
 # change rbkg to a larger number and redo calculations
 # with modified bacground parameter
-autobk(fe_xafs_copy, rbkg=2.0)
-xftf(fe_xafs_copy, kweight=0.5, kmin=3.0, kmax=12.871, dk=1, kwindow='Hanning')
+# (only autobk and xftf run again)
+fe_copy_pipeline.update(rbkg=2.0)
 
 # plot magnitude in r-space to see results of change
 plt.plot(fe_xafs_copy.r, fe_xafs_copy.chir_mag,label=fe_xafs_copy.filename)
@@ -172,8 +190,7 @@ plt.show()
 # https://vimeo.com/340215763 02:50
 # change rbkg to a larger number and redo calculations
 # with modified bacground parameter
-autobk(fe_xafs_copy, rbkg=0.7)
-xftf(fe_xafs_copy, kweight=0.5, kmin=3.0, kmax=12.871, dk=1, kwindow='Hanning')
+fe_copy_pipeline.update(rbkg=0.7)
 
 # plot magnitude in r-space to see results of change
 plt.plot(fe_xafs_copy.r, fe_xafs_copy.chir_mag,label=fe_xafs_copy.filename)
@@ -193,8 +210,7 @@ plt.show()
 # https://vimeo.com/340215763 05:50
 # change rbkg to a larger number and redo calculations
 # with modified bacground parameter
-autobk(fe_xafs_copy, rbkg=1.2)
-xftf(fe_xafs_copy, kweight=0.5, kmin=3.0, kmax=12.871, dk=1, kwindow='Hanning')
+fe_copy_pipeline.update(rbkg=1.2)
 
 # plot magnitude in r-space to see results of change
 plt.plot(fe_xafs_copy.r, fe_xafs_copy.chir_mag,label=fe_xafs_copy.filename)
@@ -206,6 +222,23 @@ plt.legend()
 plt.xlim(0,6)
 plt.show()
 
+# Instead of trying one value at a time, autobk and xftf can be run for a grid
+# of values. The normalisation is done only once, and for each point the size
+# of the peaks below 1 A (relative to the peaks after 1 A) shows if rbkg leaves
+# spurious peaks. With workers > 1 the points are calculated on a process pool.
+rbkg_values = [0.2 + 0.1*index for index in range(19)]
+rbkg_sweep = parameter_sweep(fe_xafs, {'rbkg': rbkg_values,
+                                       'xftf.kweight': [1, 2, 3]},
+                             xftf_params=XFTF_DEFAULTS)
+for kw_index, kweight in enumerate([1, 2, 3]):
+    plt.plot(rbkg_values, rbkg_sweep.metric[:, kw_index],
+             label="kw=" + str(kweight))
+plt.xlabel('rbkg')
+plt.ylabel('peak below 1 A / peak after 1 A')
+plt.grid(linestyle=':', linewidth=1) #show and format grid
+plt.legend()
+plt.show()
+
 # k-weight
 # All the parameters can also influence data analysis. For instance looking 
 # again at the initial group, we can analise how kweight affects the analyis. First
@@ -263,8 +296,10 @@ plt.show()
 
 # Changing the kweight also affects the shape of the fourier transform. The
 # following diagram shows the fourier transforms when k-weight is 1 and 2
+# (only the fourier transform runs again, and results already calculated for a
+# k-weight are reused)
 
-xftf(fe_xafs, kweight=1.0, kmin=3.0, kmax=12.871, dk=1, kwindow='Hanning')
+fe_pipeline.update('xftf', kweight=1.0)
 # https://vimeo.com/340215763 15:40
 # plot magnitude in r-space
 plt.plot(fe_xafs.r, fe_xafs.chir_mag,label=fe_xafs.filename+" kw=1")
@@ -273,7 +308,7 @@ plt.ylabel(plab.chirmag.format(3))
 plt.grid(linestyle=':', linewidth=1) #show and format grid
 plt.legend()
 plt.xlim(0,6)
-xftf(fe_xafs, kweight=2.0, kmin=3.0, kmax=12.871, dk=1, kwindow='Hanning')
+fe_pipeline.update('xftf', kweight=2.0)
 # https://vimeo.com/340215763 15:40
 # plot magnitude in r-space
 plt.plot(fe_xafs.r, fe_xafs.chir_mag,label=fe_xafs.filename+" kw=2")
@@ -289,17 +324,17 @@ plt.show()
 # be replicated as follows
 plt.subplot(3, 1, 1)
 plt.xlim(0,6)
-xftf(fe_xafs, kweight=1.0, kmin=3.0, kmax=12.871, dk=1, kwindow='Hanning')
+fe_pipeline.update('xftf', kweight=1.0)
 plt.plot(fe_xafs.r, fe_xafs.chir_mag, 'b', label=fe_xafs.filename+" kw=1")
 plt.legend()
 plt.subplot(3, 1, 2)
 plt.xlim(0,6)
-xftf(fe_xafs, kweight=2.0, kmin=3.0, kmax=12.871, dk=1, kwindow='Hanning')
+fe_pipeline.update('xftf', kweight=2.0)
 plt.plot(fe_xafs.r, fe_xafs.chir_mag, 'r', label=fe_xafs.filename+" kw=2")
 plt.legend()
 plt.subplot(3, 1, 3)
 plt.xlim(0,6)
-xftf(fe_xafs, kweight=3.0, kmin=3.0, kmax=12.871, dk=1, kwindow='Hanning')
+fe_pipeline.update('xftf', kweight=3.0)
 plt.plot(fe_xafs.r, fe_xafs.chir_mag, 'g', label=fe_xafs.filename+" kw=3")
 plt.legend()
 plt.show()
@@ -313,8 +348,8 @@ fe_200 = read_ascii('XAFSExamples/Fe_standards/Fe_lepidocrocite.200')
 
 # calculate mu and normalise with background extraction
 # using defaults
-fe_100 = calc_with_defaults(fe_100)
-fe_200 = calc_with_defaults(fe_200)
+fe_100 = calc_with_defaults(fe_100, results_cache)
+fe_200 = calc_with_defaults(fe_200, results_cache)
 
 # save as an athena project
 
@@ -331,12 +366,12 @@ vars(fe_project)
 fe_project = read_athena(project_name)
 vars(fe_project)
 gr_0 = extract_athenagroup(fe_project.Fe_lepidocrocite_000)
-gr_0 = calc_with_defaults(gr_0)
+gr_0 = calc_with_defaults(gr_0, results_cache)
 #vars(gr_0)
 gr_1 = fe_project.Fe_lepidocrocite_100
-gr_1 = calc_with_defaults(gr_1)
+gr_1 = calc_with_defaults(gr_1, results_cache)
 gr_2 = fe_project.Fe_lepidocrocite_200
-gr_2 = calc_with_defaults(gr_2)
+gr_2 = calc_with_defaults(gr_2, results_cache)
 plt.plot(gr_0.energy, gr_0.mu, label= gr_0.label + ' $\mu$')
 plt.plot(gr_1.energy, gr_1.mu, label= gr_1.label + ' $\mu$')
 plt.plot(gr_2.energy, gr_2.mu, label= gr_2.label + ' $\mu$')
@@ -435,23 +470,20 @@ plt.legend()
 plt.show()
 
 # Alignment 
-# Pending to find how alignment of various readings is performed in Larch
+# the energy shift of each reading relative to the first group is found from
+# the cross correlation of the derivatives of mu (see xas_align.py)
 
 # Setting values for a group
 
-# Using the group_names property of the project and a loop allows setting values
-# accross groups easily, for instance to set E0 to the value of the first group
-# can be done as follows.
+# align_groups also sets E0 to the value of the first group for all the
+# groups, and only the groups which changed are processed again (on 4
+# processes)
 
 # https://vimeo.com/340215763 47:03
-common_e0 = 0.0
-for group_x in fe_project._athena_groups:
-    if common_e0 == 0.0:
-        common_e0 = fe_project._athena_groups[group_x].e0
-    else:
-        fe_project._athena_groups[group_x].e0 = common_e0
-    autobk(fe_project._athena_groups[group_x], e0 = common_e0)
-    xftf(fe_project._athena_groups[group_x], kweight=0.5, kmin=3.0, kmax=12.871, dk=1, kwindow='Hanning')
+alignment = align_groups(fe_project._athena_groups.values(), reference=0,
+                         workers=4, xftf_params=XFTF_DEFAULTS)
+for label, eshift in zip(alignment.labels, alignment.eshifts):
+    print(label, "energy shift: %.3f eV" % eshift)
 
 # Plot again to show that the change has removed the shift in the k space
 
@@ -473,9 +505,10 @@ plt.show()
 # continue working on the average.
 
 # https://vimeo.com/340215763 54:00
-# use the larch.io function for merging groups 
+# merge the groups one at a time, the groups are taken from the project
+# without building a list with all of them
 
-fe_merge = merge_groups(list(fe_project._athena_groups.values()))
+fe_merge = merge_streaming(fe_project._athena_groups.values())
 autobk(fe_merge)
 xftf(fe_merge, kweight=0.5, kmin=3.0, kmax=12.871, dk=1, kwindow='Hanning')
 
@@ -511,13 +544,11 @@ plt.show()
 
 # name the group
 fe_merge.label = "Lepidocrocite"
-# add to the project
-fe_project2 = create_athena(project_name)
-for a_group in list(fe_project._athena_groups.values()):
-    fe_project2.add_group(a_group)
-# save the project
-fe_project2.add_group(fe_merge)
-fe_project2.save()
+# add to the project, each group is saved in the file when it is added
+with AthenaWriter(project_name) as fe_project2:
+    for a_group in fe_project._athena_groups.values():
+        fe_project2.add_group(a_group)
+    fe_project2.add_group(fe_merge)
 
 # https://vimeo.com/340215763 55:00
 plt.plot(gr_0.energy, gr_0.flat, 'b', label=gr_0.label) # plot flattened and normalised energy
@@ -0,0 +1,178 @@
+# energy alignment of the groups of a project against a reference
+# readings of the same sample are shifted in energy by small changes of the
+# monochromator calibration. The shift of each group is found from the cross
+# correlation of its derivative spectrum with the derivative of the reference:
+#
+#   - mu of all the groups is interpolated onto a fine common grid around e0
+#   - the derivatives are cross correlated with the reference with one FFT of
+#     the whole stack, the shift is the position of the maximum (refined with
+#     a parabola through the 3 points around it)
+#
+# the shifts are applied to the energy of the groups, e0 is set to a common
+# value and only the groups which changed are processed again (pre_edge,
+# autobk and xftf), on a process pool.
+#
+#   result = align_groups(groups, reference=0, workers=4,
+#                         xftf_params=XFTF_DEFAULTS)
+#   result.eshifts      # energy shift added to each group
+#   result.changed      # indexes of the groups processed again
+
+import logging
+import multiprocessing
+
+import numpy as np
+
+import larch
+from larch.xafs import pre_edge, autobk, xftf
+
+# attributes of a group which are not sent back from the workers
+INPUT_ATTRIBUTES = ['energy', 'mu']
+
+# derivative_stack
+# derivative of mu of each group on a common uniform grid
+# input:
+#  - list of energy arrays and list of mu arrays (one per group)
+#  - the common grid
+# output:
+#  - array (n_groups, n_grid)
+def derivative_stack(energies, mus, grid):
+    stack = np.empty((len(mus), len(grid)))
+    for index, (energy, mu) in enumerate(zip(energies, mus)):
+        stack[index] = np.interp(grid, energy, mu)
+    return np.gradient(stack, grid, axis=1)
+
+# find_shifts
+# shift of each spectrum relative to the reference from the cross
+# correlation of their derivatives
+# input:
+#  - derivative of the reference (n_grid)
+#  - derivatives of the spectra (n_spectra, n_grid)
+#  - step of the grid and largest shift searched (eV)
+# output:
+#  - energy shift to add to each spectrum to align it (n_spectra)
+def find_shifts(reference, derivatives, step, max_shift=10.0):
+    n_grid = derivatives.shape[1]
+    # remove the mean and scale, so all spectra weigh the same
+    reference = (reference - reference.mean()) / max(reference.std(), 1e-300)
+    derivatives = derivatives - derivatives.mean(axis=1, keepdims=True)
+    derivatives = derivatives / np.maximum(derivatives.std(axis=1,
+                                                           keepdims=True),
+                                           1e-300)
+    # zero padding to avoid the circular wrap around of the correlation
+    nfft = 1 << int(np.ceil(np.log2(2 * n_grid)))
+    correlation = np.fft.irfft(np.fft.rfft(derivatives, nfft, axis=1) *
+                               np.conj(np.fft.rfft(reference, nfft))[None, :],
+                               nfft, axis=1)
+    # lags from -max_lag to max_lag points
+    max_lag = min(int(max_shift / step), n_grid - 2)
+    lags = np.arange(-max_lag, max_lag + 1)
+    correlation = correlation[:, lags % nfft]
+    peak = np.argmax(correlation, axis=1)
+    # sub-step position of the maximum from a parabola through 3 points
+    inner = np.clip(peak, 1, len(lags) - 2)
+    rows = np.arange(len(correlation))
+    left = correlation[rows, inner - 1]
+    middle = correlation[rows, inner]
+    right = correlation[rows, inner + 1]
+    curvature = left - 2 * middle + right
+    offset = np.where(curvature < 0,
+                      0.5 * (left - right) / np.where(curvature < 0,
+                                                      curvature, -1.0), 0.0)
+    offset = np.where(inner == peak, offset, 0.0)
+    # a spectrum whose features are at higher energy than the reference
+    # correlates at a positive lag and is moved down in energy
+    return -(lags[inner] + offset) * step
+
+# reduce_task
+# pre_edge, autobk and xftf of one aligned group, run on the pool
+# input (as a single tuple):
+#  - index of the group, energy and mu
+#  - parameters of pre_edge, autobk and xftf (with the common e0)
+# output:
+#  - index and the attributes set by the larch functions
+def reduce_task(task):
+    index, energy, mu, pre_edge_params, autobk_params, xftf_params = task
+    xafs_group = larch.Group(energy=energy, mu=mu)
+    pre_edge(xafs_group, **pre_edge_params)
+    autobk(xafs_group, **autobk_params)
+    xftf(xafs_group, **xftf_params)
+    return index, {name: value for name, value in vars(xafs_group).items()
+                   if name not in INPUT_ATTRIBUTES and
+                   not name.startswith('__')}
+
+class AlignmentResult:
+    # shifts found for the groups and the groups processed again
+    def __init__(self, labels, eshifts, e0, changed):
+        self.labels = labels
+        self.eshifts = eshifts
+        self.e0 = e0
+        self.changed = changed
+
+    # one row per group, eg: for write_csv_data
+    def rows(self):
+        return {index: {'id': index, 'label': label,
+                        'eshift': self.eshifts[index],
+                        'changed': index in self.changed}
+                for index, label in enumerate(self.labels)}
+
+# align_groups
+# align the groups to a reference, set a common e0 and process again the
+# groups which changed
+# input:
+#  - list of larch groups with energy and mu (eg: project._athena_groups
+#    values), normalised with pre_edge if they have no e0
+#  - index of the reference group
+#  - range of the common grid relative to the e0 of the reference, and step
+#  - largest shift searched (eV)
+#  - common e0, None for the e0 of the reference
+#  - shifts and e0 changes smaller than this (eV) are not applied
+#  - number of processes for pre_edge, autobk and xftf
+#  - parameters for pre_edge, autobk and xftf
+# output:
+#  - AlignmentResult, the groups are changed in place
+def align_groups(xafs_groups, reference=0, emin=-30.0, emax=70.0, step=0.05,
+                 max_shift=10.0, e0=None, tolerance=1.e-3, workers=1,
+                 pre_edge_params=None, autobk_params=None, xftf_params=None):
+    xafs_groups = list(xafs_groups)
+    for xafs_group in xafs_groups:
+        if not hasattr(xafs_group, 'e0'):
+            pre_edge(xafs_group, **(pre_edge_params or {}))
+    reference_e0 = xafs_groups[reference].e0
+    grid = np.arange(reference_e0 + emin, reference_e0 + emax + step / 2, step)
+    derivatives = derivative_stack([a_group.energy for a_group in xafs_groups],
+                                   [a_group.mu for a_group in xafs_groups],
+                                   grid)
+    eshifts = find_shifts(derivatives[reference], derivatives, step,
+                          max_shift)
+    eshifts[np.abs(eshifts) < tolerance] = 0.0
+    if e0 is None:
+        e0 = float(reference_e0)
+
+    tasks = []
+    for index, xafs_group in enumerate(xafs_groups):
+        if eshifts[index] == 0.0 and abs(xafs_group.e0 - e0) < tolerance:
+            continue
+        xafs_group.energy = np.asarray(xafs_group.energy) + eshifts[index]
+        # total shift applied to the group
+        xafs_group.eshift = getattr(xafs_group, 'eshift', 0.0) + \
+            float(eshifts[index])
+        tasks.append((index, xafs_group.energy, xafs_group.mu,
+                      dict(pre_edge_params or {}, e0=e0),
+                      dict(autobk_params or {}, e0=e0), dict(xftf_params or {})))
+    log_message = "Aligned " + str(len(xafs_groups)) + " groups, " + \
+        str(len(tasks)) + " changed"
+    logging.info(log_message)
+
+    if workers > 1 and len(tasks) > 1:
+        with multiprocessing.Pool(processes=workers) as pool:
+            outputs = pool.map(reduce_task, tasks)
+    else:
+        outputs = [reduce_task(task) for task in tasks]
+    for index, attributes in outputs:
+        for name, value in attributes.items():
+            setattr(xafs_groups[index], name, value)
+
+    labels = [getattr(a_group, 'label', str(index))
+              for index, a_group in enumerate(xafs_groups)]
+    return AlignmentResult(labels, eshifts, e0,
+                           [index for index, _ in outputs])
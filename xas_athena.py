@@ -0,0 +1,510 @@
+# lazy reading of athena projects
+# larch read_athena decompresses the whole project, parses the arrays of every
+# group and runs pre_edge on all of them, even if only a few groups are used.
+# Here the project is read once when it is opened, only to find where each
+# group (record) starts and ends in the uncompressed text, and the arrays of a
+# group are decoded when the group is used.
+#
+# gzip files can not be read from an arbitrary position, so while the index is
+# built a copy of the decompressor is kept every CHECKPOINT_BYTES of
+# uncompressed text. A group is read by continuing from the checkpoint before
+# it, so at most CHECKPOINT_BYTES are decompressed before the group text.
+#
+#   project = read_athena_lazy('XAFSExamples/Au+Cyanobacteria/cyanobacteria.prj')
+#   project.keys()             # no arrays decoded yet
+#   gr_0 = project['qhxp']     # decodes only this group
+#
+# the groups are decoded by larch read_athena, so they are the same groups
+# (same names and attributes) given by read_athena for the whole project.
+#
+# projects are written by AthenaWriter with the same text as larch
+# AthenaProject.save, but each group is compressed and written to the file
+# when it is added instead of keeping all the groups until the project is
+# saved. Groups can also be written to shards (in parallel, eg: by the workers
+# processing the files) which are added to the project without decompressing
+# them, as a gzip file can be made of several gzip files one after the other.
+#
+#   with AthenaWriter('result/sample1/sample1.prj') as project:
+#       project.add_group(a_group)
+#       project.add_shard(shard_name, n_groups)   # from write_athena_shard
+#
+# a project growing during an experiment is updated with append_athena_project,
+# which only writes the new groups and the end of the project.
+
+import os
+import re
+import gzip
+import time
+import zlib
+import shutil
+import logging
+import platform
+import tempfile
+from fnmatch import fnmatch
+from pathlib import Path
+
+import numpy as np
+
+from larch import __version__ as larch_version
+from larch.io import read_athena, create_athena
+from larch.io.athena_project import format_dict
+from larch.utils import fix_varname
+
+from xas_csv import format_values
+
+# uncompressed bytes between decompressor checkpoints
+CHECKPOINT_BYTES = 4 * 1024**2
+
+# compressed bytes read from the file at a time
+READ_CHUNK = 256 * 1024
+
+# gzip header and trailer (zlib wbits for gzip)
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# label of a group in the @args line
+LABEL_ARG = re.compile(rb"'label'\s*,\s*'((?:[^'\\]|\\.)*)'")
+
+# old_group name
+OLD_GROUP = re.compile(rb"'((?:[^'\\]|\\.)*)'")
+
+class AthenaRecord:
+    # position of a group in the uncompressed project text
+    # input:
+    #  - name of the group as given by read_athena
+    #  - athena hash key of the group ($old_group)
+    #  - label of the group
+    #  - start and end of the record text
+    def __init__(self, name, old_group, label, start, end):
+        self.name = name
+        self.old_group = old_group
+        self.label = label
+        self.start = start
+        self.end = end
+
+# group_name
+# name given by larch read_athena to a group with the given label
+def group_name(label):
+    if label.startswith(' '):
+        label = 'd_' + label.strip()
+    name = fix_varname(label)
+    if name.startswith('_'):
+        name = 'd' + name
+    return name
+
+class ProjectText:
+    # uncompressed text of a project file (gzip or plain text), read with
+    # iter_chunks and read_range
+    def __init__(self, file_name, checkpoint_bytes=CHECKPOINT_BYTES):
+        self.file_name = Path(file_name)
+        self.checkpoint_bytes = checkpoint_bytes
+        with open(self.file_name, 'rb') as raw_file:
+            self.gzipped = raw_file.read(2) == b'\x1f\x8b'
+        # (compressed position, uncompressed position, decompressor)
+        self.checkpoints = []
+
+    # decompressed chunks of the text from a checkpoint
+    # output:
+    #  - generator of (uncompressed position, bytes)
+    def iter_chunks(self, checkpoint=None, save_checkpoints=False):
+        if checkpoint is None:
+            position, uncompressed, decompressor = 0, 0, None
+        else:
+            position, uncompressed, decompressor = checkpoint
+            if decompressor is not None:
+                decompressor = decompressor.copy()
+        next_checkpoint = uncompressed
+        with open(self.file_name, 'rb') as raw_file:
+            raw_file.seek(position)
+            while True:
+                if self.gzipped and (decompressor is None or decompressor.eof):
+                    # first member, or next member of concatenated gzip files
+                    decompressor = zlib.decompressobj(GZIP_WBITS)
+                if save_checkpoints and uncompressed >= next_checkpoint:
+                    self.checkpoints.append((position, uncompressed,
+                                             decompressor.copy()
+                                             if self.gzipped else None))
+                    next_checkpoint = uncompressed + self.checkpoint_bytes
+                chunk = raw_file.read(READ_CHUNK)
+                if not chunk:
+                    break
+                position += len(chunk)
+                if not self.gzipped:
+                    yield uncompressed, chunk
+                    uncompressed += len(chunk)
+                    continue
+                data = decompressor.decompress(chunk)
+                # the rest of the chunk is the start of the next member
+                while decompressor.eof and decompressor.unused_data:
+                    unused_data = decompressor.unused_data
+                    decompressor = zlib.decompressobj(GZIP_WBITS)
+                    data += decompressor.decompress(unused_data)
+                if data:
+                    yield uncompressed, data
+                    uncompressed += len(data)
+
+    # read the uncompressed text between two positions, starting from the
+    # last checkpoint before the start
+    def read_range(self, start, end):
+        checkpoint = None
+        for a_checkpoint in self.checkpoints:
+            if a_checkpoint[1] > start:
+                break
+            checkpoint = a_checkpoint
+        parts = []
+        for chunk_start, data in self.iter_chunks(checkpoint):
+            chunk_end = chunk_start + len(data)
+            if chunk_end <= start:
+                continue
+            parts.append(data[max(0, start - chunk_start):end - chunk_start])
+            if chunk_end >= end:
+                break
+        return b''.join(parts)
+
+class LazyAthenaProject:
+    # athena project indexed when it is opened, groups are decoded when used
+    # input:
+    #  - name of the project file
+    #  - arguments for read_athena when groups are decoded
+    def __init__(self, file_name, do_preedge=True, do_bkg=False, do_fft=False,
+                 checkpoint_bytes=CHECKPOINT_BYTES):
+        self.file_name = Path(file_name)
+        self.read_args = {'do_preedge': do_preedge, 'do_bkg': do_bkg,
+                          'do_fft': do_fft}
+        self.text = ProjectText(file_name, checkpoint_bytes)
+        self.header = b''
+        self.records = {}
+        # groups already decoded
+        self.decoded = {}
+        self.index_time = 0.0
+        self.extract_time = 0.0
+        start_time = time.perf_counter()
+        self.build_index()
+        self.index_time = time.perf_counter() - start_time
+        log_message = "Indexed " + str(len(self.records)) + \
+            " groups in " + self.file_name.name + " in " + \
+            "%.3f" % self.index_time + " s"
+        logging.info(log_message)
+
+    # find the start and end of each record and the label of its group
+    def build_index(self):
+        record = None
+        line_start = 0
+        rest = b''
+        for chunk_start, data in self.text.iter_chunks(save_checkpoints=True):
+            lines = (rest + data).split(b'\n')
+            rest = lines.pop()
+            for line in lines:
+                line_end = line_start + len(line) + 1
+                if line_start == 0:
+                    if line.startswith(b'{'):
+                        raise ValueError("JSON Athena projects are not " +
+                                         "supported: " + str(self.file_name))
+                    if b'Athena project file -- ' not in line:
+                        raise ValueError("invalid Athena File: " +
+                                         str(self.file_name))
+                if line.startswith(b'$old_group'):
+                    old_group = OLD_GROUP.search(line).group(1).decode('utf-8', 'replace')
+                    record = AthenaRecord(old_group, old_group, old_group,
+                                          line_start, None)
+                elif record is None and len(self.records) == 0:
+                    self.header += line + b'\n'
+                elif record is not None and line.startswith(b'@args'):
+                    label = LABEL_ARG.search(line)
+                    if label is not None:
+                        record.label = label.group(1).decode('utf-8', 'replace')
+                elif record is not None and line.startswith(b'[record]'):
+                    record.end = line_end
+                    record.name = group_name(record.label)
+                    # same name as a previous group, read_athena keeps the
+                    # last one
+                    self.records.pop(record.name, None)
+                    self.records[record.name] = record
+                    record = None
+                line_start = line_end
+
+    def keys(self, match=None):
+        if match is None:
+            return list(self.records)
+        return [name for name in self.records
+                if fnmatch(name.lower(), match.lower())]
+
+    def values(self):
+        return [self[name] for name in self.records]
+
+    def items(self):
+        return [(name, self[name]) for name in self.records]
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __contains__(self, name):
+        return name in self.records
+
+    def __getitem__(self, name):
+        if name not in self.decoded:
+            self.extract([name])
+        return self.decoded[name]
+
+    def __getattr__(self, name):
+        # groups as attributes, as in the group returned by read_athena
+        records = self.__dict__.get('records', {})
+        if name in records:
+            return self[name]
+        raise AttributeError(name)
+
+    # code written for the group returned by read_athena uses
+    # project._athena_groups[name]
+    @property
+    def _athena_groups(self):
+        return self
+
+    # decode the arrays of the given groups with read_athena, the text of
+    # the records is saved as a small project with only those groups
+    # output:
+    #  - dictionary of decoded groups
+    def extract(self, names):
+        start_time = time.perf_counter()
+        names = [name for name in names if name not in self.decoded]
+        if len(names) == 0:
+            return {}
+        texts = [self.header]
+        for name in names:
+            record = self.records[name]
+            texts.append(self.text.read_range(record.start, record.end))
+        texts.append(b'\n1;\n')
+        temp_file, temp_name = tempfile.mkstemp(suffix='.prj')
+        try:
+            with os.fdopen(temp_file, 'wb') as project_file:
+                project_file.write(b''.join(texts))
+            project = read_athena(temp_name, **self.read_args)
+        finally:
+            os.remove(temp_name)
+        extracted = {}
+        for name in names:
+            extracted[name] = getattr(project, name)
+        self.decoded.update(extracted)
+        elapsed = time.perf_counter() - start_time
+        self.extract_time += elapsed
+        log_message = "Extracted " + str(len(names)) + " groups from " + \
+            self.file_name.name + " in " + "%.3f" % elapsed + " s"
+        logging.info(log_message)
+        return extracted
+
+    # forget the decoded groups
+    def release(self, names=None):
+        if names is None:
+            names = list(self.decoded)
+        for name in names:
+            self.decoded.pop(name, None)
+
+# read_athena_lazy
+# open an athena project without decoding its groups
+def read_athena_lazy(file_name, do_preedge=True, do_bkg=False, do_fft=False):
+    return LazyAthenaProject(file_name, do_preedge, do_bkg, do_fft)
+
+ #######################################################
+# |         Streaming writer of athena projects       | #
+# V                                                   V #
+ #######################################################
+
+# compression level of the projects written, larch uses 9 which is much slower
+# for files only slightly smaller
+COMPRESS_LEVEL = 6
+
+# end of the project text as written by larch
+PROJECT_FOOTER = "\n@journal = ();\n\n1;\n\n\n# Local Variables:\n" + \
+    "# truncate-lines: t\n# End:\n"
+
+# first lines of the project text as written by larch
+def project_header():
+    python_version = "Python %s on %s" % (platform.python_version(),
+                                          platform.platform())
+    return "# Athena project file -- Demeter version 0.9.21\n" + \
+        "# This file created at " + time.strftime('%Y-%m-%dT%H:%M:%S') + \
+        "\n# Using Larch version " + str(larch_version) + ", " + \
+        python_version + "\n"
+
+# hashkey
+# athena hash key (5 lower case letters) for the index of a group in the
+# project, so the keys are unique also when groups are written in shards
+def hashkey(index):
+    letters = []
+    for _ in range(5):
+        index, letter = divmod(index, 26)
+        letters.append(chr(ord('a') + letter))
+    return ''.join(reversed(letters))
+
+# values of an array as written by larch, str of each value between quotes
+def format_array(values):
+    values = np.asarray(values)
+    if len(values) == 0:
+        return ''
+    return "'" + "','".join(format_values(values)) + "'"
+
+# format_record
+# text of a group in the project as written by larch AthenaProject.save
+# input:
+#  - processed larch group
+#  - athena hash key of the group
+def format_record(xafs_group, key):
+    # larch add_group copies the group and fills the athena arguments
+    project = create_athena()
+    project.add_group(xafs_group)
+    old_key, athena_group = project.groups.popitem()
+    args = dict(athena_group.args)
+    for name in ('datagroup', 'tag', 'old_group', 'label'):
+        if args.get(name) == old_key:
+            args[name] = key
+    for name in ('bkg_nvict', 'fft_kwin'):
+        args.pop(name, None)
+    lines = ["",
+             "$old_group = '%s';" % getattr(athena_group, 'groupname', key),
+             "@args = (%s);" % format_dict(args),
+             "@x = (%s);" % format_array(athena_group.x),
+             "@y = (%s);" % format_array(athena_group.y)]
+    for name in ('i0', 'signal', 'stddev'):
+        values = getattr(athena_group, name, None)
+        if values is not None:
+            lines.append("@%s = (%s);" % (name, format_array(values)))
+    lines.append("[record] # ")
+    return "\n".join(lines) + "\n"
+
+class AthenaWriter:
+    # input:
+    #  - name of the project file
+    def __init__(self, file_name, compresslevel=COMPRESS_LEVEL):
+        self.file_name = Path(file_name)
+        if not self.file_name.parent.exists():
+            self.file_name.parent.mkdir(parents=True, exist_ok=True)
+        self.compresslevel = compresslevel
+        # the project is written to a temporary file which replaces the
+        # project file when it is complete
+        self.temp_name = self.file_name.with_name(self.file_name.name + '.tmp')
+        self.raw_file = open(self.temp_name, 'wb')
+        # gzip member being written
+        self.member = None
+        # number of groups in the project
+        self.count = 0
+        self.write_text(project_header())
+
+    def write_text(self, text):
+        if self.member is None:
+            self.member = gzip.GzipFile(filename='', mode='wb',
+                                        compresslevel=self.compresslevel,
+                                        fileobj=self.raw_file)
+        self.member.write(text.encode('utf-8'))
+
+    # compress and write a group
+    def add_group(self, xafs_group):
+        self.write_text(format_record(xafs_group, hashkey(self.count)))
+        self.count += 1
+
+    # add a shard written by write_athena_shard, the compressed text is copied
+    # input:
+    #  - name of the shard file
+    #  - number of groups in the shard
+    #  - True to remove the shard file once it is copied
+    def add_shard(self, shard_name, n_groups=1, remove=True):
+        if self.member is not None:
+            # finish the gzip member written so far
+            self.member.close()
+            self.member = None
+        with open(shard_name, 'rb') as shard_file:
+            shutil.copyfileobj(shard_file, self.raw_file)
+        if remove:
+            os.remove(shard_name)
+        self.count += n_groups
+
+    # write the end of the project and replace the project file
+    def close(self):
+        self.write_text(PROJECT_FOOTER)
+        self.member.close()
+        self.raw_file.close()
+        os.replace(self.temp_name, self.file_name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            if self.member is not None:
+                self.member.close()
+            self.raw_file.close()
+            os.remove(self.temp_name)
+
+# write_athena_shard
+# write groups as a shard of a project: a gzip file with only the records of
+# the groups, added to a project with AthenaWriter.add_shard
+# input:
+#  - name of the shard file
+#  - the groups
+#  - index of the first group in the project (for the athena hash keys)
+# output:
+#  - number of groups written
+def write_athena_shard(shard_name, groups, start_index=0,
+                       compresslevel=COMPRESS_LEVEL):
+    shard_name = Path(shard_name)
+    if not shard_name.parent.exists():
+        shard_name.parent.mkdir(parents=True, exist_ok=True)
+    count = 0
+    with gzip.GzipFile(shard_name, 'wb', compresslevel=compresslevel) as shard:
+        for a_group in groups:
+            record = format_record(a_group, hashkey(start_index + count))
+            shard.write(record.encode('utf-8'))
+            count += 1
+    return count
+
+# write_athena_project
+# save a list of groups as an athena project, one group at a time
+def write_athena_project(file_name, groups):
+    with AthenaWriter(file_name) as project:
+        for a_group in groups:
+            project.add_group(a_group)
+    return Path(file_name)
+
+# append_athena_project
+# add groups at the end of a project without writing it again, for projects
+# which grow during an experiment (see xas_watch.py). The project is cut at
+# the end of the records kept, the new records are copied there from their
+# shards, then the groups which change at every append (eg: the merge) and the
+# end of the project are written after them.
+# input:
+#  - name of the project file
+#  - offset given by the previous append, None to start a new project
+#  - shards with the new groups (write_athena_shard), removed once copied
+#  - groups written after the records, replaced at the next append
+#  - number of groups in the project before the end groups (hash keys)
+# output:
+#  - offset of the end of the records, for the next append
+def append_athena_project(file_name, offset, shard_names, end_groups, count,
+                          compresslevel=COMPRESS_LEVEL):
+    file_name = Path(file_name)
+    if offset is None or not file_name.exists():
+        if not file_name.parent.exists():
+            file_name.parent.mkdir(parents=True, exist_ok=True)
+        raw_file = open(file_name, 'wb')
+        with gzip.GzipFile(filename='', mode='wb', compresslevel=compresslevel,
+                           fileobj=raw_file) as member:
+            member.write(project_header().encode('utf-8'))
+    else:
+        raw_file = open(file_name, 'r+b')
+        raw_file.truncate(offset)
+        raw_file.seek(offset)
+    with raw_file:
+        for shard_name in shard_names:
+            with open(shard_name, 'rb') as shard_file:
+                shutil.copyfileobj(shard_file, raw_file)
+            os.remove(shard_name)
+        offset = raw_file.tell()
+        with gzip.GzipFile(filename='', mode='wb', compresslevel=compresslevel,
+                           fileobj=raw_file) as member:
+            for index, a_group in enumerate(end_groups):
+                record = format_record(a_group, hashkey(count + index))
+                member.write(record.encode('utf-8'))
+            member.write(PROJECT_FOOTER.encode('utf-8'))
+    return offset
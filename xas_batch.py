@@ -0,0 +1,262 @@
+# batch reduction of many spectra measured on the same energy grid
+# time resolved runs give hundreds or thousands of spectra of the same scan.
+# Instead of processing each spectrum as a larch group, the spectra are
+# stacked in a 2D array (n_spectra, n_energy) and each processing step is
+# done for all the spectra at once with numpy:
+#   - e0, pre-edge and post-edge lines, edge step, norm and flat (pre_edge)
+#   - conversion to k and background removal (autobk)
+#   - windowed fourier transform to R space (xftf)
+#
+# The steps follow the larch functions, but the background is a spline fitted
+# on a k grid with a common e0 for all the spectra, so the spline basis and the
+# fourier transform matrix are the same for all of them and the fit of every
+# spectrum is solved with a single least squares call.
+
+import numpy as np
+
+# conversion of energy (eV) above the edge to k (1/A): k = sqrt(ETOK*(E-e0))
+ETOK = 0.2624682843
+
+# find_e0
+# e0 of each spectrum, the energy of the maximum of the derivative
+# input:
+#  - energy array (n_energy)
+#  - stack of mu (n_spectra, n_energy)
+# output:
+#  - e0 array (n_spectra)
+def find_e0(energy, mu_stack):
+    dmude = np.gradient(mu_stack, energy, axis=1)
+    # ignore the first and last points, where the derivative is noisy
+    dmude[:, :2] = -np.inf
+    dmude[:, -2:] = -np.inf
+    return energy[np.argmax(dmude, axis=1)]
+
+# fit_polynomials
+# least squares fit of a polynomial to each spectrum in a different range,
+# done with the normal equations of all the spectra at once
+# input:
+#  - energy array (n_energy)
+#  - stack of mu (n_spectra, n_energy)
+#  - mask with the points to fit for each spectrum (n_spectra, n_energy)
+#  - order of the polynomial
+# output:
+#  - coefficients (n_spectra, order+1), constant term first
+def fit_polynomials(energy, mu_stack, mask, order):
+    powers = np.vander(energy, order + 1, increasing=True)
+    weights = mask.astype(float)
+    # normal equations (A^T W A) c = A^T W y for each spectrum
+    lhs = np.einsum('se,ei,ej->sij', weights, powers, powers)
+    rhs = np.einsum('se,ei,se->si', weights, powers, mu_stack)
+    return np.linalg.solve(lhs, rhs[..., None])[..., 0]
+
+# evaluate the polynomials of each spectrum on the energy grid
+def eval_polynomials(energy, coefs):
+    powers = np.vander(energy, coefs.shape[1], increasing=True)
+    return coefs @ powers.T
+
+# batch_pre_edge
+# normalisation of all the spectra, as larch pre_edge
+# input:
+#  - energy array (n_energy)
+#  - stack of mu (n_spectra, n_energy)
+#  - e0 for all the spectra (n_spectra) or None to find it
+#  - pre-edge range relative to e0
+#  - normalisation range relative to e0, norm2=None uses the last energy
+#  - order of the post-edge polynomial
+# output:
+#  - dictionary with e0, edge_step, pre_edge, post_edge, norm and flat
+def batch_pre_edge(energy, mu_stack, e0=None, pre1=-150.0, pre2=-30.0,
+                   norm1=150.0, norm2=None, nnorm=2):
+    energy = np.asarray(energy, dtype=float)
+    mu_stack = np.atleast_2d(np.asarray(mu_stack, dtype=float))
+    if e0 is None:
+        e0 = find_e0(energy, mu_stack)
+    e0 = np.broadcast_to(np.asarray(e0, dtype=float), (len(mu_stack),))
+    if norm2 is None:
+        norm2 = energy[-1] - e0
+    norm2 = np.broadcast_to(np.asarray(norm2, dtype=float), e0.shape)
+    relative = energy[None, :] - e0[:, None]
+    pre_mask = (relative >= pre1) & (relative <= pre2)
+    post_mask = (relative >= norm1) & (relative <= norm2[:, None])
+
+    pre_coefs = fit_polynomials(energy, mu_stack, pre_mask, 1)
+    post_coefs = fit_polynomials(energy, mu_stack, post_mask, nnorm)
+    pre_edge = eval_polynomials(energy, pre_coefs)
+    post_edge = eval_polynomials(energy, post_coefs)
+
+    # edge step is the difference of the lines at e0
+    e0_powers = np.vander(e0, nnorm + 1, increasing=True)
+    edge_step = np.einsum('si,si->s', post_coefs, e0_powers) - \
+        (pre_coefs[:, 0] + pre_coefs[:, 1] * e0)
+    norm = (mu_stack - pre_edge) / edge_step[:, None]
+    # flatten the post-edge region
+    flat_residue = (post_edge - pre_edge) / edge_step[:, None] - 1.0
+    flat = np.where(relative >= 0, norm - flat_residue, norm)
+    return {'e0': e0, 'edge_step': edge_step, 'pre_edge': pre_edge,
+            'post_edge': post_edge, 'norm': norm, 'flat': flat}
+
+# ftwindow
+# hanning window as in larch ftwindow
+def ftwindow(x, xmin, xmax, dx):
+    x1, x2 = xmin - dx/2.0, xmin + dx/2.0
+    x3, x4 = xmax - dx/2.0, xmax + dx/2.0
+    window = np.zeros(len(x))
+    rising = (x >= x1) & (x < x2)
+    window[rising] = np.sin((np.pi/2) * (x[rising] - x1) / max(x2 - x1, 1e-10))**2
+    window[(x >= x2) & (x <= x3)] = 1.0
+    falling = (x > x3) & (x <= x4)
+    window[falling] = np.cos((np.pi/2) * (x[falling] - x3) / max(x4 - x3, 1e-10))**2
+    return window
+
+# bspline_basis
+# cubic B-spline basis functions with uniform knots from xmin to xmax
+# output:
+#  - matrix (len(x), n_coef)
+def bspline_basis(x, n_coef, xmin, xmax, degree=3):
+    x = np.clip(x, xmin, xmax)
+    inner = np.linspace(xmin, xmax, n_coef - degree + 1)
+    knots = np.concatenate([[xmin] * degree, inner, [xmax] * degree])
+    basis = ((x[:, None] >= knots[None, :-1]) &
+             (x[:, None] < knots[None, 1:])).astype(float)
+    # the last point belongs to the last non empty interval
+    last = np.nonzero(knots[:-1] < knots[1:])[0][-1]
+    basis[x >= knots[-1], last] = 1.0
+    for d in range(1, degree + 1):
+        n_basis = len(knots) - d - 1
+        left = knots[d:d + n_basis] - knots[:n_basis]
+        right = knots[d + 1:d + 1 + n_basis] - knots[1:1 + n_basis]
+        left = np.where(left > 0, left, np.inf)
+        right = np.where(right > 0, right, np.inf)
+        basis = (x[:, None] - knots[None, :n_basis]) / left * basis[:, :n_basis] + \
+            (knots[None, d + 1:d + 1 + n_basis] - x[:, None]) / right * \
+            basis[:, 1:1 + n_basis]
+    return basis
+
+# batch_autobk
+# background removal for all the spectra, as larch autobk: the background is
+# a spline with few enough knots that it cannot follow signals above rbkg in R,
+# chosen to minimise the fourier transform of chi below rbkg.
+# input:
+#  - energy array (n_energy)
+#  - stack of mu (n_spectra, n_energy)
+#  - common e0 for the k grid
+#  - edge step of each spectrum (n_spectra)
+#  - rbkg, kweight, kmax of the spline, k step of the output grid
+# output:
+#  - dictionary with k (n_k), chi on the k grid (n_spectra, n_k) and bkg on
+#    the energy grid (n_spectra, n_energy), equal to mu below e0
+def batch_autobk(energy, mu_stack, e0, edge_step, rbkg=1.0, kweight=2,
+                 kmax=None, kstep=0.05, nfft=2048, regularise=1.e-4):
+    energy = np.asarray(energy, dtype=float)
+    above = energy >= e0
+    k_energy = np.sqrt(ETOK * (energy[above] - e0))
+    if kmax is None:
+        kmax = k_energy[-1]
+    k = np.arange(0, min(kmax, k_energy[-1]) + kstep/10, kstep)
+    k = k[k <= k_energy[-1]]
+
+    # linear interpolation onto the k grid, same weights for all spectra
+    index = np.clip(np.searchsorted(k_energy, k) - 1, 0, len(k_energy) - 2)
+    fraction = (k - k_energy[index]) / (k_energy[index + 1] - k_energy[index])
+    mu_above = mu_stack[:, above]
+    mu_k = mu_above[:, index] * (1 - fraction) + mu_above[:, index + 1] * fraction
+
+    # number of spline coefficients allowed by rbkg
+    n_coef = int(np.clip(int(2 * rbkg * (k[-1] - k[0]) / np.pi) + 2, 5, 64))
+    basis = bspline_basis(k, n_coef, k[0], k[-1])
+
+    # fourier transform rows for r < rbkg of the k weighted, windowed chi
+    r_low = (np.pi / (kstep * nfft)) * np.arange(nfft // 2)
+    r_low = r_low[r_low < rbkg]
+    window = ftwindow(k, 0, k[-1], 0.1) * k**kweight
+    transform = (kstep / np.sqrt(np.pi)) * \
+        np.exp(-2j * np.outer(r_low, k)) * window[None, :]
+    transform_basis = transform @ basis
+    transform_mu = mu_k @ transform.T
+    # a small weight on the spline following mu keeps the fit stable where
+    # the window is zero
+    scale = np.sqrt(regularise * np.sum(np.abs(transform_basis)**2) /
+                    np.sum(basis**2))
+    lhs = np.vstack([transform_basis.real, transform_basis.imag, scale * basis])
+    rhs = np.hstack([transform_mu.real, transform_mu.imag, scale * mu_k])
+    coefs = np.linalg.lstsq(lhs, rhs.T, rcond=None)[0]
+    chi = (mu_k - (basis @ coefs).T) / np.asarray(edge_step, dtype=float)[:, None]
+    bkg = np.array(mu_stack, dtype=float)
+    bkg[:, above] = (bspline_basis(k_energy, n_coef, k[0], k[-1]) @ coefs).T
+    return {'k': k, 'chi': chi, 'bkg': bkg}
+
+# batch_xftf
+# fourier transform of all the chi(k) to R space, as larch xftf
+# input:
+#  - k grid (n_k), uniform step starting at 0
+#  - stack of chi (n_spectra, n_k)
+#  - window parameters and k weight
+# output:
+#  - dictionary with r (n_r), kwin (n_k) and chir, chir_mag, chir_re,
+#    chir_im (n_spectra, n_r)
+def batch_xftf(k, chi_stack, kmin=2, kmax=15, dk=3, kweight=2, nfft=2048,
+               rmax_out=10):
+    k = np.asarray(k, dtype=float)
+    kstep = k[1] - k[0]
+    kwin = ftwindow(k, kmin, kmax, dk)
+    weighted = np.zeros((len(chi_stack), nfft))
+    weighted[:, :len(k)] = chi_stack * (kwin * k**kweight)[None, :]
+    chir = (kstep / np.sqrt(np.pi)) * np.fft.fft(weighted, axis=1)[:, :nfft // 2]
+    r = (np.pi / (kstep * nfft)) * np.arange(nfft // 2)
+    n_out = int(min(nfft // 2, 1.01 + rmax_out / r[1]))
+    chir = chir[:, :n_out]
+    return {'r': r[:n_out], 'kwin': kwin, 'chir': chir,
+            'chir_mag': np.abs(chir), 'chir_re': chir.real,
+            'chir_im': chir.imag}
+
+class BatchResult:
+    # results of reducing a stack of spectra, all arrays have one row per
+    # spectrum except the grids (energy, k, r and kwin)
+    def __init__(self, energy, mu, **arrays):
+        self.energy = energy
+        self.mu = mu
+        for name, value in arrays.items():
+            setattr(self, name, value)
+
+    def __len__(self):
+        return len(self.mu)
+
+    # get a larch group for one spectrum, for plotting or saving with the
+    # larch functions
+    def group(self, index, label=None):
+        import larch
+        a_group = larch.Group()
+        for name, value in vars(self).items():
+            if name in ('energy', 'k', 'r', 'kwin'):
+                setattr(a_group, name, value)
+            elif np.ndim(value) >= 1 and len(value) == len(self.mu):
+                setattr(a_group, name, value[index])
+        if label is not None:
+            a_group.label = label
+        return a_group
+
+# batch_reduce
+# normalisation, background removal and fourier transform of a stack of
+# spectra measured on the same energy grid
+# input:
+#  - energy array (n_energy)
+#  - stack of mu (n_spectra, n_energy)
+#  - parameters of autobk and xftf as used in xas_read_files
+#  - common e0, if None the median of the e0 of the spectra is used
+# output:
+#  - BatchResult with all the arrays
+def batch_reduce(energy, mu_stack, autobk_params=None, xftf_params=None,
+                 e0=None):
+    autobk_params = dict(autobk_params or {'rbkg': 1.0, 'kweight': 2})
+    xftf_params = dict(xftf_params or {'kmin': 2, 'kmax': 15, 'dk': 3,
+                                       'kweight': 2})
+    energy = np.asarray(energy, dtype=float)
+    mu_stack = np.atleast_2d(np.asarray(mu_stack, dtype=float))
+    if e0 is None:
+        e0 = float(np.median(find_e0(energy, mu_stack)))
+    normalised = batch_pre_edge(energy, mu_stack, e0=e0)
+    background = batch_autobk(energy, mu_stack, e0, normalised['edge_step'],
+                              **autobk_params)
+    transform = batch_xftf(background['k'], background['chi'], **xftf_params)
+    return BatchResult(energy, mu_stack, **normalised, **background,
+                       **transform)
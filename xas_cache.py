@@ -0,0 +1,181 @@
+# persistent cache for the results of xas processing
+# the results of pre_edge, autobk and xftf only depend on the measured data
+# (energy and mu) and on the parameters passed to the larch functions, so they
+# can be saved to disk and reused when the same data is processed again with
+# the same parameters.
+#
+# each result is saved as a numpy .npz file named after a hash of the data
+# and the parameters. When the cache grows over its size limit, the least
+# recently used results are removed. The key also has the larch version, as
+# the defaults of the larch functions can change between versions.
+#
+# the details groups set by pre_edge and autobk (pre_edge_details,
+# autobk_details) are saved with their numeric and text values, so a cached
+# group has the same attributes as a processed one. Other values of the
+# details (eg: dictionaries) are not saved.
+
+import os
+import json
+import hashlib
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+import larch
+
+# arrays and values copied to and from the cache
+CACHED_ATTRIBUTES = ['e0', 'edge_step', 'pre_edge', 'post_edge', 'norm',
+                     'flat', 'dmude', 'bkg', 'chie', 'k', 'chi', 'kwin', 'r',
+                     'chir', 'chir_mag', 'chir_re', 'chir_im', 'chir_pha']
+
+# groups of details copied to and from the cache, their values are saved as
+# '<details>.<name>'
+CACHED_DETAILS = ['pre_edge_details', 'autobk_details']
+
+# version of the cached results, part of the key so results saved with fewer
+# attributes are not used
+CACHE_FORMAT = 2
+
+# default maximum size of the cache, 2 GB
+DEFAULT_MAX_BYTES = 2 * 1024**3
+
+class ResultCache:
+    # input:
+    #  - the directory where results are saved
+    #  - maximum size of the cache in bytes
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        # total size of the cache, calculated on first save
+        self._size = None
+
+    # get the key of a group's data and the processing parameters
+    # input:
+    #  - a larch group with energy and mu
+    #  - a dictionary with all the parameters used for processing, with the
+    #    values passed to each larch function (including e0, None when it is
+    #    found from the data)
+    def key(self, xafs_group, params):
+        hasher = hashlib.sha256()
+        hasher.update(str(CACHE_FORMAT).encode())
+        hasher.update(str(larch.__version__).encode())
+        for name in ['energy', 'mu']:
+            values = np.ascontiguousarray(getattr(xafs_group, name))
+            hasher.update(name.encode())
+            hasher.update(str(values.dtype).encode())
+            hasher.update(str(values.shape).encode())
+            hasher.update(values.tobytes())
+        hasher.update(json.dumps(params, sort_keys=True, default=str).encode())
+        return hasher.hexdigest()
+
+    def path(self, key):
+        return self.cache_dir / (key + '.npz')
+
+    # copy the cached results into the group
+    # output:
+    #  - True if the results were found in the cache
+    def load(self, key, xafs_group):
+        cache_file = self.path(key)
+        try:
+            with np.load(cache_file) as cached:
+                details = {}
+                for name in cached.files:
+                    value = cached[name]
+                    if value.ndim == 0:
+                        value = value.item()
+                    details_name, _, attribute = name.partition('.')
+                    if attribute:
+                        details.setdefault(details_name, {})[attribute] = value
+                    else:
+                        setattr(xafs_group, name, value)
+            for details_name, values in details.items():
+                setattr(xafs_group, details_name, larch.Group(**values))
+        except (OSError, ValueError, KeyError):
+            return False
+        # mark as recently used
+        try:
+            os.utime(cache_file)
+        except OSError:
+            pass
+        return True
+
+    # save the results in the group to the cache
+    def save(self, key, xafs_group):
+        if not self.cache_dir.exists():
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        results = {}
+        for name in CACHED_ATTRIBUTES:
+            if hasattr(xafs_group, name):
+                value = np.asarray(getattr(xafs_group, name))
+                if value.dtype.kind in 'biufc':
+                    results[name] = value
+        for details_name in CACHED_DETAILS:
+            details = getattr(xafs_group, details_name, None)
+            if details is None:
+                continue
+            for attribute, value in vars(details).items():
+                if attribute.startswith('_'):
+                    continue
+                try:
+                    value = np.asarray(value)
+                except ValueError:
+                    continue
+                if value.dtype.kind in 'biufcU':
+                    results[details_name + '.' + attribute] = value
+        # write to a temporary file and rename it so other processes never
+        # see a partial result
+        handle, temp_name = tempfile.mkstemp(dir=str(self.cache_dir),
+                                             suffix='.tmp')
+        with os.fdopen(handle, 'wb') as temp_file:
+            np.savez(temp_file, **results)
+        cache_file = self.path(key)
+        os.replace(temp_name, cache_file)
+        if self._size is None:
+            self._size = self.total_size()
+        else:
+            self._size += cache_file.stat().st_size
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def total_size(self):
+        return sum(entry.stat().st_size for entry in self.cache_dir.glob('*.npz'))
+
+    # remove the least recently used results until the cache fits in its
+    # maximum size
+    def evict(self):
+        entries = []
+        for entry in self.cache_dir.glob('*.npz'):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry))
+        entries.sort()
+        self._size = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if self._size <= self.max_bytes:
+                break
+            try:
+                entry.unlink()
+            except OSError:
+                continue
+            self._size -= size
+
+# process_with_cache
+# run the processing function on the group unless the results for the same
+# data and parameters are in the cache
+# input:
+#  - a larch group with energy and mu
+#  - dictionary with the processing parameters
+#  - function which processes the group in place
+#  - the cache, if None the processing function is always called
+def process_with_cache(xafs_group, params, process, cache=None):
+    if cache is None:
+        process(xafs_group)
+        return xafs_group
+    key = cache.key(xafs_group, params)
+    if not cache.load(key, xafs_group):
+        process(xafs_group)
+        cache.save(key, xafs_group)
+    return xafs_group
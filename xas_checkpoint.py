@@ -0,0 +1,173 @@
+# checkpoints of a bulk run
+# when xas_read_files stops part way through a large directory (a malformed
+# file, the node was stopped...) a new run with --checkpoint continues where
+# it stopped instead of starting again from the first file.
+#
+# the checkpoint is kept in result/checkpoint:
+#
+#   journal.jsonl     one line for each piece of work done: the settings of
+#                     the run, each file reduced and each pattern finished
+#   <pattern>/N.npz   the reduced group of file N of the pattern (a compact
+#                     record, see xas_record.py)
+#   <pattern>/N.gz    its athena record (shard, see xas_athena.py)
+#
+# a file is written to the journal after its record, shard, plot and csv file
+# are saved (plots of the plot service and csv files of the pipeline are saved
+# later, so they are written again for the files done), and a pattern after
+# its merge and athena project are saved. The records are written to a temporary file and renamed, and the journal lines
+# are appended and synced, so a stop at any point loses at most the file in
+# progress. A new run skips the patterns finished (the files of the checkpoint
+# are then removed) and takes the groups of the files done from their records.
+# Files changed since (size or modification time) are processed again, and
+# the checkpoint is not used if the settings of the run changed.
+
+import os
+import json
+import shutil
+import logging
+from pathlib import Path
+
+from xas_record import as_record, save_record, load_record
+
+JOURNAL_NAME = 'journal.jsonl'
+
+# append a line to the journal, a single write (O_APPEND) so lines written by
+# several processes do not mix
+def append_journal(journal_path, entry):
+    line = (json.dumps(entry) + '\n').encode('utf-8')
+    fd = os.open(journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# read the journal, a line cut by a stop while it was written is ignored
+def read_journal(journal_path):
+    entries = []
+    if not journal_path.exists():
+        return entries
+    with open(journal_path, encoding='utf-8') as journal_file:
+        for line in journal_file:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue
+    return entries
+
+# size and modification time of a data file, to find files changed since
+# they were processed
+def file_state(file_path):
+    stat = os.stat(file_path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+class PatternCheckpoint:
+    # checkpoint of the files of a pattern, sent to the pool workers which
+    # save the files they process
+    def __init__(self, journal_path, pattern_dir, pattern):
+        self.journal_path = journal_path
+        self.dir = pattern_dir
+        self.pattern = pattern
+
+    def record_name(self, index):
+        return self.dir / (str(index) + '.npz')
+
+    # same name as xas_read_files shard_name
+    def shard_name(self, index):
+        return self.dir / (str(index) + '.gz')
+
+    # save_file
+    # save the record of a processed file and add it to the journal, the
+    # shard must be written before
+    # input:
+    #  - index of the file in its pattern
+    #  - path of the data file
+    #  - the processed larch group or record
+    def save_file(self, index, file_path, xafs_group):
+        self.dir.mkdir(parents=True, exist_ok=True)
+        save_record(as_record(xafs_group), self.record_name(index))
+        entry = {'kind': 'file', 'pattern': self.pattern, 'index': index,
+                 'file': Path(file_path).name}
+        entry.update(file_state(file_path))
+        append_journal(self.journal_path, entry)
+
+    def load_file(self, index):
+        return load_record(self.record_name(index))
+
+class Checkpoint:
+    # input:
+    #  - the result dir of the run
+    #  - the settings which change the results (data columns, parameters,
+    #    options...), the checkpoint is only used with the same settings
+    def __init__(self, result_dir, settings):
+        self.dir = Path(result_dir) / 'checkpoint'
+        self.journal_path = self.dir / JOURNAL_NAME
+        self.settings = json.loads(json.dumps(settings))
+        # journal entries of the files by (pattern, index) and of the
+        # patterns finished
+        self.files = {}
+        self.patterns = {}
+        self.load()
+
+    def load(self):
+        entries = read_journal(self.journal_path)
+        if entries and (entries[0].get('kind') != 'run' or
+                        entries[0].get('settings') != self.settings):
+            log_message = "Settings changed, checkpoint in " + str(self.dir) + \
+                " not used"
+            logging.info(log_message)
+            shutil.rmtree(self.dir, ignore_errors=True)
+            entries = []
+        for entry in entries:
+            if entry['kind'] == 'file':
+                self.files[(entry['pattern'], entry['index'])] = entry
+            elif entry['kind'] == 'pattern':
+                self.patterns[entry['pattern']] = entry
+        self.dir.mkdir(parents=True, exist_ok=True)
+        if not entries:
+            append_journal(self.journal_path,
+                           {'kind': 'run', 'settings': self.settings})
+        log_message = "Checkpoint in " + str(self.dir) + ": " + \
+            str(len(self.patterns)) + " patterns and " + \
+            str(len(self.files)) + " files done"
+        logging.info(log_message)
+
+    def pattern_dir(self, pattern):
+        return self.dir / pattern[1:][:-1]
+
+    def for_pattern(self, pattern):
+        return PatternCheckpoint(self.journal_path, self.pattern_dir(pattern),
+                                 pattern)
+
+    # check if a pattern was finished with the same files and its athena
+    # project is there
+    def pattern_done(self, pattern, files, project_name):
+        entry = self.patterns.get(pattern)
+        return entry is not None and entry['files'] == list(files) and \
+            Path(project_name).exists()
+
+    # check if a file was processed and was not changed since
+    def file_done(self, pattern, index, file_path):
+        entry = self.files.get((pattern, index))
+        if entry is None or entry['file'] != Path(file_path).name:
+            return False
+        pattern_checkpoint = self.for_pattern(pattern)
+        if not (pattern_checkpoint.record_name(index).exists() and
+                pattern_checkpoint.shard_name(index).exists()):
+            return False
+        state = file_state(file_path)
+        return entry['size'] == state['size'] and \
+            entry['mtime'] == state['mtime']
+
+    # indexes of the files of a pattern which are done
+    def files_done(self, pattern, file_dir, files):
+        return set(index for index, file in enumerate(files)
+                   if self.file_done(pattern, index, Path(file_dir) / file))
+
+    # add a finished pattern to the journal and remove the records and shards
+    # of its files
+    def save_pattern(self, pattern, files):
+        entry = {'kind': 'pattern', 'pattern': pattern, 'files': list(files)}
+        append_journal(self.journal_path, entry)
+        self.patterns[pattern] = entry
+        shutil.rmtree(self.pattern_dir(pattern), ignore_errors=True)
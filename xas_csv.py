@@ -0,0 +1,73 @@
+# csv files for the results of xas processing
+# get_csv_data and write_csv_data read and write tables kept as dictionaries
+# of rows. For arrays (eg: energy and normalised mu) write_csv_columns writes
+# the columns directly, in chunks of rows, without building a dictionary for
+# each row. The text is the same written by csv.DictWriter.
+
+# import library for managing files
+from pathlib import Path
+
+# import library for managing csv files
+import csv
+
+import numpy as np
+
+# rows formatted and written at a time by write_csv_columns
+CHUNK_ROWS = 8192
+
+# get the data from the csv_file, assuming first column is integer id
+def get_csv_data(input_file, id_field):
+    csv_data = {}
+    fieldnames=[]
+    with open(input_file, newline='') as csvfile:
+        reader = csv.DictReader(csvfile)
+        for row in reader:
+            if fieldnames==[]:
+                fieldnames=list(row.keys())
+            csv_data[int(row[id_field])]=row
+    return csv_data, fieldnames
+
+# writes data to the given file name
+def write_csv_data(values, filename):
+    # the keys of all rows in order of appearance, in one pass
+    fieldnames = list(dict.fromkeys(key for row in values.values()
+                                    for key in row))
+    #write back to a new csv file
+    with open(filename, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(values.values())
+
+# format_values
+# text of the values as written by DictWriter (str of each numpy value).
+# For float64 and integers str of the python numbers from tolist is the
+# same and much faster than converting each numpy value.
+def format_values(values):
+    if values.dtype.kind in 'iub' or values.dtype == np.float64:
+        return map(str, values.tolist())
+    return map(str, values)
+
+# write_csv_columns
+# write arrays of the same length as the columns of a csv file
+# input:
+#  - dictionary of column names and arrays, in the order of the columns
+#  - the file name
+def write_csv_columns(columns, filename, chunk_rows=CHUNK_ROWS):
+    filename = Path(filename)
+    if not filename.parent.exists():
+        # other threads or processes may create it at the same time
+        filename.parent.mkdir(parents=True, exist_ok=True)
+    names = list(columns)
+    arrays = [np.asarray(columns[name]) for name in names]
+    n_rows = min(len(values) for values in arrays) if arrays else 0
+    # csv.writer uses \r\n at the end of each line
+    line_end = '\r\n'
+    with open(filename, 'w', newline='') as csvfile:
+        # the header is written by csv so names are quoted as DictWriter does
+        csv.writer(csvfile).writerow(names)
+        for start in range(0, n_rows, chunk_rows):
+            stop = min(start + chunk_rows, n_rows)
+            text_columns = [format_values(values[start:stop])
+                            for values in arrays]
+            csvfile.write(line_end.join(map(','.join, zip(*text_columns))))
+            csvfile.write(line_end)
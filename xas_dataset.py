@@ -0,0 +1,272 @@
+# binary dataset of processed spectra
+# all the spectra of a pattern are saved in a single .npz file instead of one
+# csv file for each spectrum. For each array (energy, norm, flat, k, chi, r,
+# chir_mag) the values of all the spectra are saved one after the other with
+# the offsets where each spectrum starts, so spectra can have different
+# lengths. Per spectrum values (label, e0, edge_step) are saved as arrays.
+#
+# the arrays are stored without compression, so they can be read with numpy
+# memory maps directly from the file, without loading or copying them.
+#
+#   dataset = read_dataset('result/sample1/sample1.npz')
+#   dataset.labels[3], dataset.spectrum(3)['norm'], dataset.stack('norm')
+
+import os
+import json
+import zipfile
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+# arrays saved for each spectrum
+DATASET_ARRAYS = ['energy', 'norm', 'flat', 'k', 'chi', 'r', 'chir_mag']
+
+# values saved for each spectrum
+DATASET_VALUES = ['e0', 'edge_step']
+
+# state of a DatasetWriter with a work directory
+WRITER_STATE = 'state.json'
+
+class DatasetWriter:
+    # input:
+    #  - name of the .npz file to write
+    #  - names of the arrays to save
+    #  - names of the values to save
+    #  - directory where the values of the groups added are kept, so a
+    #    dataset growing during an experiment can be continued by another
+    #    session (see xas_watch.py), None for a temporary directory removed
+    #    when the writer is closed
+    def __init__(self, file_name, arrays=DATASET_ARRAYS, values=DATASET_VALUES,
+                 work_dir=None):
+        self.file_name = Path(file_name)
+        self.arrays = list(arrays)
+        self.values = list(values)
+        self.labels = []
+        self.value_lists = {name: [] for name in self.values}
+        self.offsets = {name: [0] for name in self.arrays}
+        # the values of each array are written to a raw file as the groups
+        # are added, so they are not kept in memory
+        if work_dir is None:
+            self.temp_dir = tempfile.TemporaryDirectory(
+                dir=str(self.file_name.parent) if self.file_name.parent.exists() else None)
+            self.work_dir = Path(self.temp_dir.name)
+        else:
+            self.temp_dir = None
+            self.work_dir = Path(work_dir)
+            self.work_dir.mkdir(parents=True, exist_ok=True)
+            self.load_state()
+        self.temp_files = {name: open(self.raw_name(name), 'ab')
+                           for name in self.arrays}
+
+    def raw_name(self, name):
+        return self.work_dir / (name + '.raw')
+
+    def state_path(self):
+        return self.work_dir / WRITER_STATE
+
+    # continue from the groups saved in the work directory, values of groups
+    # added after the last write are dropped
+    def load_state(self):
+        if self.state_path().exists():
+            with open(self.state_path()) as state_file:
+                state = json.load(state_file)
+            if state['arrays'] == self.arrays and state['values'] == self.values:
+                self.labels = state['labels']
+                self.value_lists = state['value_lists']
+                self.offsets = state['offsets']
+        for name in self.arrays:
+            size = self.offsets[name][-1] * np.dtype(np.float64).itemsize
+            if self.raw_name(name).exists():
+                os.truncate(self.raw_name(name), size)
+
+    def save_state(self):
+        state = {'arrays': self.arrays, 'values': self.values,
+                 'labels': self.labels, 'value_lists': self.value_lists,
+                 'offsets': self.offsets}
+        temp_path = self.state_path().with_suffix('.tmp')
+        with open(temp_path, 'w') as state_file:
+            json.dump(state, state_file)
+        os.replace(temp_path, self.state_path())
+
+    # number of groups added
+    def __len__(self):
+        return len(self.labels)
+
+    # add the arrays of a processed larch group
+    def add_group(self, xafs_group):
+        self.labels.append(group_label(xafs_group))
+        for name in self.values:
+            self.value_lists[name].append(group_value(xafs_group, name))
+        for name in self.arrays:
+            values = group_array(xafs_group, name)
+            self.temp_files[name].write(np.ascontiguousarray(values).tobytes())
+            self.offsets[name].append(self.offsets[name][-1] + len(values))
+
+    # write the .npz file with the groups added so far, followed by end groups
+    # which are not kept (eg: the merge of a dataset which is still growing)
+    def write(self, end_groups=()):
+        end_groups = list(end_groups)
+        for temp_file in self.temp_files.values():
+            temp_file.flush()
+        if self.temp_dir is None:
+            self.save_state()
+        if not self.file_name.parent.exists():
+            self.file_name.parent.mkdir(parents=True)
+        temp_name = self.file_name.with_suffix('.tmp')
+        with zipfile.ZipFile(temp_name, 'w', zipfile.ZIP_STORED,
+                             allowZip64=True) as zip_file:
+            labels = self.labels + [group_label(a_group) for a_group in end_groups]
+            save_member(zip_file, 'labels', np.array(labels, dtype=str))
+            for name in self.values:
+                values = self.value_lists[name] + [group_value(a_group, name)
+                                                   for a_group in end_groups]
+                save_member(zip_file, name, np.array(values, dtype=np.float64))
+            for name in self.arrays:
+                end_arrays = [group_array(a_group, name) for a_group in end_groups]
+                offsets = list(self.offsets[name])
+                for values in end_arrays:
+                    offsets.append(offsets[-1] + len(values))
+                save_member(zip_file, name + '_offsets',
+                            np.array(offsets, dtype=np.int64))
+                copy_raw_member(zip_file, name, self.raw_name(name),
+                                offsets[-1], end_arrays)
+        os.replace(temp_name, self.file_name)
+
+    def close(self):
+        self.write()
+        for temp_file in self.temp_files.values():
+            temp_file.close()
+        if self.temp_dir is not None:
+            self.temp_dir.cleanup()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            for temp_file in self.temp_files.values():
+                temp_file.close()
+            if self.temp_dir is not None:
+                self.temp_dir.cleanup()
+
+# label, value and arrays of a group as saved in the dataset
+def group_label(xafs_group):
+    return str(getattr(xafs_group, 'label', ''))
+
+def group_value(xafs_group, name):
+    return float(getattr(xafs_group, name, np.nan))
+
+def group_array(xafs_group, name):
+    if hasattr(xafs_group, name):
+        return np.asarray(getattr(xafs_group, name), dtype=np.float64)
+    return np.zeros(0)
+
+# save an array as a .npy member of the zip file
+def save_member(zip_file, name, values):
+    with zip_file.open(name + '.npy', 'w', force_zip64=True) as member:
+        np.lib.format.write_array(member, values, allow_pickle=False)
+
+# copy float64 values saved in a raw file as a .npy member of the zip file,
+# followed by the values of the arrays in end_arrays
+def copy_raw_member(zip_file, name, raw_file_name, size, end_arrays=()):
+    header = {'descr': np.lib.format.dtype_to_descr(np.dtype(np.float64)),
+              'fortran_order': False, 'shape': (size,)}
+    with zip_file.open(name + '.npy', 'w', force_zip64=True) as member:
+        np.lib.format.write_array_header_2_0(member, header)
+        with open(raw_file_name, 'rb') as raw_file:
+            while True:
+                chunk = raw_file.read(16 * 1024 * 1024)
+                if not chunk:
+                    break
+                member.write(chunk)
+        for values in end_arrays:
+            member.write(np.ascontiguousarray(values).tobytes())
+
+# write_dataset
+# save a list of processed larch groups as a dataset
+def write_dataset(file_name, groups, arrays=DATASET_ARRAYS, values=DATASET_VALUES):
+    with DatasetWriter(file_name, arrays, values) as writer:
+        for a_group in groups:
+            writer.add_group(a_group)
+    return Path(file_name)
+
+class SpectraDataset:
+    # dataset read with read_dataset, arrays are numpy memory maps of the file
+    def __init__(self, file_name, members):
+        self.file_name = Path(file_name)
+        self.members = members
+        self.labels = [str(label) for label in members['labels']]
+        self.names = [name for name in DATASET_ARRAYS if name in members]
+        self.names += [name[:-len('_offsets')] for name in members
+                       if name.endswith('_offsets') and
+                       name[:-len('_offsets')] not in self.names]
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, name):
+        return self.members[name]
+
+    # the values of an array for one spectrum (a view of the file)
+    def array(self, name, index):
+        offsets = self.members[name + '_offsets']
+        return self.members[name][offsets[index]:offsets[index + 1]]
+
+    # all the arrays of one spectrum
+    def spectrum(self, index):
+        result = {'label': self.labels[index]}
+        for name in self.names:
+            result[name] = self.array(name, index)
+        for name in DATASET_VALUES:
+            if name in self.members:
+                result[name] = float(self.members[name][index])
+        return result
+
+    # the values of an array for all the spectra as a 2D view, only if all
+    # spectra have the same length (eg: spectra on the same energy grid)
+    def stack(self, name, indexes=None):
+        offsets = self.members[name + '_offsets']
+        lengths = np.diff(offsets)
+        if len(lengths) == 0 or np.any(lengths != lengths[0]):
+            raise ValueError("spectra have different lengths for " + name)
+        stacked = self.members[name].reshape(len(lengths), lengths[0])
+        if indexes is not None:
+            return stacked[indexes]
+        return stacked
+
+    # find the index of a spectrum by its label
+    def index(self, label):
+        return self.labels.index(label)
+
+# read_dataset
+# open a dataset, the arrays are memory mapped unless mmap is False
+def read_dataset(file_name, mmap=True):
+    members = {}
+    with zipfile.ZipFile(file_name) as zip_file, open(file_name, 'rb') as raw_file:
+        for info in zip_file.infolist():
+            name = info.filename[:-len('.npy')]
+            if name == 'labels' or not mmap or info.compress_type != zipfile.ZIP_STORED:
+                with zip_file.open(info) as member:
+                    members[name] = np.lib.format.read_array(member,
+                                                             allow_pickle=False)
+                continue
+            # find the start of the data in the file: local file header
+            # (30 bytes, name and extra field) and the .npy header
+            raw_file.seek(info.header_offset + 26)
+            name_size, extra_size = np.frombuffer(raw_file.read(4), dtype='<u2')
+            raw_file.seek(info.header_offset + 30 + int(name_size) + int(extra_size))
+            version = np.lib.format.read_magic(raw_file)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(raw_file)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(raw_file)
+            if np.prod(shape) == 0:
+                members[name] = np.zeros(shape, dtype=dtype)
+                continue
+            members[name] = np.memmap(file_name, dtype=dtype, mode='r',
+                                      offset=raw_file.tell(), shape=shape,
+                                      order='F' if fortran_order else 'C')
+    return SpectraDataset(file_name, members)
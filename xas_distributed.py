@@ -0,0 +1,358 @@
+# distributed processing of a beamtime directory
+# the files of each pattern found by get_file_groups are split in work units
+# (at most --unit-size files of one pattern). The coordinator (xas_read_files
+# with --distributed HOST:PORT) puts the units in a queue served over a socket
+# (multiprocessing.managers, the broker) and workers on any node which can see
+# the data directory (shared storage) take units from it:
+#
+#   coordinator:  python xas_read_files.py /data/beamtime '*.dat' T --distributed 0.0.0.0:50000
+#   each node:    python xas_distributed.py coordinator-host:50000 --workers 8
+#
+# a worker reduces the files of a unit on its own process pool, writes the
+# plots, csv files and athena records (shards) next to the results, and sends
+# back the groups as compact records (see xas_record.py). The coordinator puts
+# together the merge and athena project of a pattern, in file order, when all
+# its units are done, so the results are the same as in a serial run.
+#
+# a unit which fails is sent again (at most --retries times), as is a unit
+# not done --unit-timeout seconds after a worker took it (eg: the node was
+# stopped). A unit which times out on its last attempt is not sent again, the
+# coordinator waits another --unit-timeout seconds for the attempts still
+# running and then stops with an error. The first result of a unit is used
+# and later ones are ignored.
+# Workers stop when the coordinator is done.
+#
+# the broker sends the units and results as pickles, so anyone who can
+# connect to it can run code on the coordinator and the workers. Connections
+# are checked with the key in the XAS_BROKER_KEY environment variable (a long
+# random string, the same on every node), the coordinator and the workers do
+# not start without it.
+
+import os
+import sys
+import time
+import queue
+import shutil
+import socket
+import logging
+import multiprocessing
+from pathlib import Path
+from multiprocessing.managers import BaseManager
+
+from xas_merge import RunningMerge
+from xas_plots import plot_selection
+from xas_timing import TIMER
+
+# seconds between checks of the queues
+WAIT_SECONDS = 1.0
+
+# environment variable with the key of the broker
+AUTHKEY_VARIABLE = 'XAS_BROKER_KEY'
+
+# queues of the broker, they live in the broker process
+_units = queue.Queue()
+_results = queue.Queue()
+
+def get_units():
+    return _units
+
+def get_results():
+    return _results
+
+class BrokerManager(BaseManager):
+    pass
+
+BrokerManager.register('get_units', callable=get_units)
+BrokerManager.register('get_results', callable=get_results)
+
+# get (host, port) from 'host:port'
+def parse_address(address):
+    host, _, port = address.rpartition(':')
+    return host, int(port)
+
+# key of the broker, there is no default key as it would be known to anyone
+# reading this file
+def get_authkey():
+    authkey = os.environ.get(AUTHKEY_VARIABLE, '')
+    if authkey == '':
+        raise RuntimeError("set the " + AUTHKEY_VARIABLE + " environment "
+                           "variable to the same random key on the "
+                           "coordinator and the workers")
+    return authkey.encode()
+
+# make_units
+# split the files of each pattern in units of consecutive files
+# output:
+#  - list of units, each with its id, pattern, index of its first file in the
+#    pattern and file names
+def make_units(file_groups, unit_size):
+    units = []
+    for pattern in file_groups:
+        files = file_groups[pattern]
+        for start in range(0, len(files), max(1, unit_size)):
+            units.append({'id': len(units), 'pattern': pattern,
+                          'start': start,
+                          'files': files[start:start + unit_size]})
+    return units
+
+# process_unit
+# reduce the files of a unit, run by the workers
+# input:
+#  - the unit sent by the coordinator
+#  - the module with the processing functions (xas_read_files)
+#  - the process pool of the worker, None to process the files here
+# output:
+#  - records of the groups, timing rows and names of the athena shards, in
+#    the order of the files
+def process_unit(unit, processing, pool=None):
+    tasks = []
+    for offset, file in enumerate(unit['files']):
+        index = unit['start'] + offset
+        # each attempt writes its own shards, so a unit sent again can not
+        # write over the shards of an attempt still running
+        shard = (unit['shard_dir'] / str(unit['attempt']) / (str(index) + '.gz'),
+                 index)
+        tasks.append((unit['file_dir'] / file, unit['data_columns'],
+                      unit['save_dir'], unit['cache'], unit['options'],
+                      unit['plots'][offset], shard, None))
+    if pool is None:
+        outputs = [processing.process_file_task(task) for task in tasks]
+    else:
+        outputs = pool.map(processing.process_file_task, tasks)
+    timing_rows = [row for _, rows in outputs for row in rows]
+    return ([record for record, _ in outputs], timing_rows,
+            [task[6][0] for task in tasks])
+
+# run_worker
+# take units from the coordinator until it is done
+# input:
+#  - (host, port) of the coordinator
+#  - number of processes for the files of a unit
+def run_worker(address, workers=1):
+    authkey = get_authkey()
+    import xas_read_files as processing
+    manager = BrokerManager(address=address, authkey=authkey)
+    manager.connect()
+    units = manager.get_units()
+    results = manager.get_results()
+    name = socket.gethostname() + ':' + str(os.getpid())
+    log_message = "Worker " + name + " connected to " + str(address) + \
+        " with " + str(workers) + " processes"
+    logging.info(log_message)
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(processes=workers,
+                                    initializer=processing.init_worker)
+    done = 0
+    try:
+        while True:
+            try:
+                unit = units.get(timeout=WAIT_SECONDS)
+            except queue.Empty:
+                continue
+            results.put(('started', unit['id'], unit['attempt'], name))
+            try:
+                output = process_unit(unit, processing, pool)
+            except Exception as error:
+                log_message = "Unit " + str(unit['id']) + " failed: " + \
+                    repr(error)
+                logging.info(log_message)
+                results.put(('failed', unit['id'], unit['attempt'],
+                             name + ' ' + repr(error)))
+                continue
+            results.put(('done', unit['id'], unit['attempt']) + output)
+            done += 1
+    except (EOFError, OSError):
+        # the broker stops when the coordinator is done
+        log_message = "Coordinator closed, " + str(done) + " units done by " + \
+            name
+        logging.info(log_message)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return done
+
+class Coordinator:
+    # input:
+    #  - (host, port) where the broker listens
+    #  - the module with the processing functions (xas_read_files)
+    #  - largest number of files in a unit
+    #  - times a failed unit is sent again
+    #  - seconds after which a unit taken by a worker is sent again, None to
+    #    wait for ever
+    def __init__(self, address, processing, unit_size=50, retries=2,
+                 unit_timeout=900.0):
+        self.address = address
+        self.processing = processing
+        self.unit_size = unit_size
+        self.retries = retries
+        self.unit_timeout = unit_timeout
+        # checked here so the run stops before any file is processed
+        self.authkey = get_authkey()
+
+    # run
+    # process the file groups on the workers and put together the merge and
+    # athena project of each pattern
+    def run(self, file_dir, file_groups, data_columns, cache=None,
+            options=None, plot_service=None):
+        options = options or {}
+        # the workers may run in other directories
+        file_dir = Path(file_dir).resolve()
+        plots = options.get('plots', 'all')
+        units = make_units(file_groups, self.unit_size)
+        for unit in units:
+            pattern = unit['pattern']
+            save_dir = file_dir / 'result' / pattern[1:][:-1]
+            unit.update({
+                'file_dir': file_dir, 'save_dir': save_dir,
+                'shard_dir': save_dir / (pattern[1:][:-1] + '_shards'),
+                'data_columns': data_columns, 'cache': cache,
+                'options': options, 'attempt': 0,
+                'plots': [plot_selection(plots, unit['start'] + offset) and
+                          plot_service is None
+                          for offset in range(len(unit['files']))]})
+        # units left for each pattern
+        remaining = {}
+        for unit in units:
+            remaining[unit['pattern']] = remaining.get(unit['pattern'], 0) + 1
+
+        manager = BrokerManager(address=self.address, authkey=self.authkey)
+        manager.start()
+        log_message = "Coordinator listening on " + str(self.address) + \
+            ", " + str(len(units)) + " units of at most " + \
+            str(self.unit_size) + " files"
+        logging.info(log_message)
+        try:
+            self.unit_queue = manager.get_units()
+            results = manager.get_results()
+            for unit in units:
+                self.unit_queue.put(unit)
+            # outputs of the units done, and time each running unit started
+            self.outputs = {}
+            self.started = {}
+            # time by which the units which timed out on their last attempt
+            # must be done
+            self.deadlines = {}
+            while remaining:
+                try:
+                    message = results.get(timeout=WAIT_SECONDS)
+                except queue.Empty:
+                    self.check_timeouts(units)
+                    continue
+                kind, unit_id, attempt = message[:3]
+                unit = units[unit_id]
+                # late results of units already done are ignored
+                if unit_id in self.outputs:
+                    continue
+                if kind == 'started':
+                    if attempt == unit['attempt']:
+                        self.started[unit_id] = time.monotonic()
+                elif kind == 'failed':
+                    if attempt == unit['attempt']:
+                        log_message = "Unit " + str(unit_id) + " failed on " + \
+                            message[3]
+                        logging.info(log_message)
+                        self.retry(unit)
+                elif kind == 'done':
+                    records, timing_rows, shards = message[3:]
+                    TIMER.extend(timing_rows)
+                    self.outputs[unit_id] = (records, shards)
+                    self.started.pop(unit_id, None)
+                    self.deadlines.pop(unit_id, None)
+                    pattern = unit['pattern']
+                    remaining[pattern] -= 1
+                    log_message = "Unit " + str(unit_id) + " done (" + \
+                        str(len(self.outputs)) + "/" + str(len(units)) + ")"
+                    logging.info(log_message)
+                    if remaining[pattern] == 0:
+                        del remaining[pattern]
+                        self.finish_pattern(pattern, units, cache, options,
+                                            plot_service)
+        finally:
+            manager.shutdown()
+
+    # send a unit again with a new attempt number
+    def retry(self, unit):
+        if unit['attempt'] >= self.retries:
+            raise RuntimeError("unit " + str(unit['id']) + " (" +
+                               unit['files'][0] + " ...) failed " +
+                               str(unit['attempt'] + 1) + " times")
+        unit['attempt'] += 1
+        self.started.pop(unit['id'], None)
+        self.unit_queue.put(unit)
+
+    # send again the units taken by a worker which did not finish in time
+    def check_timeouts(self, units):
+        if self.unit_timeout is None:
+            return
+        now = time.monotonic()
+        for unit_id, deadline in self.deadlines.items():
+            if now > deadline:
+                unit = units[unit_id]
+                raise RuntimeError("unit " + str(unit_id) + " (" +
+                                   unit['files'][0] + " ...) not done " +
+                                   str(self.unit_timeout) + " s after its " +
+                                   "last attempt timed out")
+        for unit_id, start_time in list(self.started.items()):
+            if now - start_time <= self.unit_timeout:
+                continue
+            unit = units[unit_id]
+            if unit['attempt'] >= self.retries:
+                # no attempts left, the attempts still running may finish
+                # (eg: a slow node), so their result is waited for until a
+                # second timeout (eg: the node was stopped)
+                log_message = "Unit " + str(unit_id) + \
+                    " timed out on its last attempt, waiting for its result"
+                logging.info(log_message)
+                del self.started[unit_id]
+                self.deadlines[unit_id] = now + self.unit_timeout
+                continue
+            log_message = "Unit " + str(unit_id) + " timed out"
+            logging.info(log_message)
+            self.retry(unit)
+
+    # merge and athena project of a pattern, from the records and shards of
+    # its units in file order
+    def finish_pattern(self, pattern, units, cache, options, plot_service):
+        processing = self.processing
+        plots = options.get('plots', 'all')
+        pattern_units = [unit for unit in units if unit['pattern'] == pattern]
+        save_dir = pattern_units[0]['save_dir']
+        merge = RunningMerge()
+        outputs = processing.PatternOutputs(pattern, save_dir, options)
+        for unit in pattern_units:
+            records, shards = self.outputs[unit['id']]
+            for offset, (a_group, shard) in enumerate(zip(records, shards)):
+                if plot_service is not None and \
+                        plot_selection(plots, unit['start'] + offset):
+                    plot_service.submit(a_group, save_dir)
+                processing.add_to_merge(merge, a_group)
+                outputs.add_group(a_group, shard)
+            # the records are not needed any more
+            self.outputs[unit['id']] = None
+        # shards of attempts which were not used
+        shutil.rmtree(pattern_units[0]['shard_dir'], ignore_errors=True)
+        processing.process_pattern_groups(pattern, [], save_dir, cache,
+                                          options, plot_service, merge,
+                                          outputs)
+
+# usage: python xas_distributed.py HOST:PORT [--workers N]
+if __name__ == "__main__":
+    try:
+        address = parse_address(sys.argv[1])
+        workers = 1
+        if '--workers' in sys.argv:
+            workers = int(sys.argv[sys.argv.index('--workers') + 1])
+    except (IndexError, ValueError):
+        print("missing arguments"+
+              "\n -string address of the coordinator (eg: beamline-01:50000)"+
+              "\n optional:"+
+              "\n --workers N number of processes for reducing files")
+        sys.exit(1)
+    try:
+        get_authkey()
+    except RuntimeError as error:
+        print(error)
+        sys.exit(1)
+    run_worker(address, workers)
@@ -0,0 +1,150 @@
+# grouping of data files by common name patterns
+# files produced in the same experiment share most of their name, for instance
+#   223752_sample1_insitu_ramp_He_1.dat
+#   223752_sample1_insitu_ramp_He_2.dat
+# the common part of the names of neighbouring files (in sorted order) is used
+# as the pattern which identifies the files to process together.
+#
+# The grouping does a single pass over the sorted file names and uses an
+# index of the patterns by length to find redundant patterns, so it grows
+# linearly with the number of files.
+
+# add logging
+import logging
+
+# get_file_groups:
+# groups files in a directory according to common text patterns assuming that
+# patterns correspond to files which must be processed together.
+# input:
+#  - the directory path where the files to be processed are placed
+#  - the string which is used to filter the files to process (wildcad caracheters)
+# output:
+#  - an indexed list of files, which uses common patterns found as keys
+
+def get_file_groups(source_dir, filename_pattern, group_files):
+    files_list = sorted(source_dir.glob(filename_pattern))
+    log_message = "Found " + str(len(files_list)) + \
+        " files to process with pattern: " + \
+        filename_pattern + \
+        "in dir: " + str(source_dir) + " Group: " +str(group_files)
+    logging.info(log_message)
+
+    file_names = [a_file.name for a_file in files_list]
+    if group_files:
+        file_groups = group_file_names(file_names)
+    else:
+        file_groups = {'unique': file_names}
+
+    for pattern in file_groups:
+        log_message = str(len(file_groups[pattern])) + " files to process with pattern " + pattern + "\nFiles: " + str(file_groups[pattern])
+        logging.info(log_message)
+    return file_groups
+
+# group_file_names
+# group a sorted list of file names by the common pattern of neighbouring
+# names.
+# input:
+#  - list of file names, sorted
+# output:
+#  - dictionary of patterns and the list of file names for each pattern
+def group_file_names(file_names):
+    pattern_current = ""
+    file_groups = {}
+    # one pass over neighbouring names
+    for index in range(len(file_names) - 1):
+        file_name = file_names[index]
+        another_file = file_names[index + 1]
+        common_pattern = get_common(file_name, another_file)
+        if pattern_current == "":
+            pattern_current = common_pattern
+            if pattern_current in file_groups:
+                file_groups[pattern_current] += [file_name, another_file]
+            else:
+                file_groups[pattern_current] = [file_name, another_file]
+        elif pattern_current == common_pattern:
+            file_groups[pattern_current].append(another_file)
+        else:
+            pattern_current = ""
+    return merge_redundant_patterns(file_groups)
+
+# merge_redundant_patterns
+# a pattern which contains another pattern is redundant, its files are added
+# to the group of the shorter pattern and the longer pattern is removed.
+# Instead of comparing every pair of patterns, the windows of each pattern
+# are looked up in an index of the patterns grouped by length.
+def merge_redundant_patterns(file_groups):
+    patterns_by_length = {}
+    for pattern in file_groups:
+        patterns_by_length.setdefault(len(pattern), set()).add(pattern)
+    pattern_lengths = sorted(patterns_by_length)
+
+    # files contributed by the patterns which contain each pattern
+    merged_files = {}
+    patterns_remove = set()
+    for pattern_check in file_groups:
+        for length in pattern_lengths:
+            if length >= len(pattern_check):
+                break
+            candidates = patterns_by_length[length]
+            # use a set to avoid adding the files twice for repeated windows
+            found = set()
+            for start in range(len(pattern_check) - length + 1):
+                window = pattern_check[start:start + length]
+                if window in candidates and window not in found:
+                    found.add(window)
+                    merged_files.setdefault(window, []).append(pattern_check)
+            if found:
+                patterns_remove.add(pattern_check)
+
+    result_groups = {}
+    for pattern in file_groups:
+        if pattern in patterns_remove:
+            continue
+        if pattern in merged_files:
+            # use sets to ignore duplicates and keep the sorted file order
+            files_set = set(file_groups[pattern])
+            for pattern_other in merged_files[pattern]:
+                files_set.update(file_groups[pattern_other])
+            result_groups[pattern] = sorted(files_set)
+        else:
+            result_groups[pattern] = file_groups[pattern]
+    return result_groups
+
+# get the common pattern between the two strings
+# this is the longest common sub-string, the earliest in file_1 if there are
+# several with the same length (as returned by difflib find_longest_match).
+# Neighbouring file names usually share a long prefix, so the search starts
+# from the length of the common prefix and only grows from there.
+def get_common(file_1, file_2):
+    prefix_size = 0
+    for char_1, char_2 in zip(file_1, file_2):
+        if char_1 != char_2:
+            break
+        prefix_size += 1
+    match_size = prefix_size
+    while match_size < min(len(file_1), len(file_2)) and \
+            has_common_substring(file_1, file_2, match_size + 1):
+        match_size += 1
+    if match_size == 0:
+        log_message = 'No longest common sub-string found'
+        logging.info(log_message)
+        return ""
+    if match_size == prefix_size:
+        return file_1[:prefix_size]
+    windows_2 = substrings_of_size(file_2, match_size)
+    for start in range(len(file_1) - match_size + 1):
+        if file_1[start:start + match_size] in windows_2:
+            return file_1[start:start + match_size]
+    return ""
+
+# check if the two strings have a common sub-string of the given size
+def has_common_substring(file_1, file_2, size):
+    windows_2 = substrings_of_size(file_2, size)
+    for start in range(len(file_1) - size + 1):
+        if file_1[start:start + size] in windows_2:
+            return True
+    return False
+
+# all the sub-strings of the given size in a string
+def substrings_of_size(text, size):
+    return {text[start:start + size] for start in range(len(text) - size + 1)}
@@ -0,0 +1,109 @@
+# operations on larch groups without copying their arrays
+# get_mu and copy_group in the processing scripts made a new group from a
+# dictionary of the attributes of the group (group2dict and dict2group) to add
+# mu or to copy it. Here mu is added to the group in place, and a copy shares
+# the arrays of the original group (copy on write):
+#
+#  - the shared arrays are read-only views in both groups, so an in place
+#    change (group.mu *= 2) raises an error instead of changing the other
+#    group
+#  - larch functions set new arrays in the group (group.norm = ...), so they
+#    work on copies without copying anything
+#  - writable(group, 'mu') copies a shared array before changing it in place
+#
+#   fe_xafs = add_mu(fe_xafs)
+#   fe_copy = clone_group(fe_xafs)           # no arrays copied
+#   writable(fe_copy, 'mu')[:10] = 0.0       # mu of the copy only
+
+import copy
+
+import numpy as np
+
+import larch
+
+# add_mu
+# calculate mu from the columns of the group and add it in place
+# input:
+#  - larch group with i0 and it (transmission) or i0 and ifluor
+#  - 'transmission' for log(|i0/it|), 'fluorescence' for ifluor/i0
+#  - name of the fluorescence column
+# output:
+#  - the same group
+def add_mu(xafs_group, mode='transmission', fluorescence='ifluor'):
+    i0 = np.asarray(xafs_group.i0, dtype=float)
+    if mode == 'transmission':
+        mu = np.divide(i0, xafs_group.it)
+        np.abs(mu, out=mu)
+        np.log(mu, out=mu)
+    elif mode == 'fluorescence':
+        mu = np.divide(getattr(xafs_group, fluorescence), i0)
+    else:
+        raise ValueError("unknown mode " + str(mode))
+    xafs_group.mu = mu
+    return xafs_group
+
+# read-only view of an array, sharing its data
+def shared_view(values):
+    view = values.view()
+    view.flags.writeable = False
+    return view
+
+# clone_group
+# copy of a group which shares the arrays of the group
+# input:
+#  - the larch group
+#  - text added to the filename of the copy (None to keep it)
+# output:
+#  - the new group
+def clone_group(xafs_group, suffix='_copy'):
+    new_group = larch.Group()
+    for name, value in vars(xafs_group).items():
+        if name.startswith('__'):
+            continue
+        if isinstance(value, np.ndarray):
+            # both groups get read-only views of the same data
+            value = shared_view(value)
+            setattr(xafs_group, name, shared_view(value))
+        elif isinstance(value, (list, dict, set)):
+            # small containers (header, array_labels...) are copied
+            value = copy.copy(value)
+        setattr(new_group, name, value)
+    if suffix is not None and hasattr(new_group, 'filename'):
+        new_group.filename = new_group.filename + suffix
+    return new_group
+
+# writable
+# array of a group that can be changed in place, copied if it is shared
+# input:
+#  - the larch group and name of the array
+# output:
+#  - the array of the group
+def writable(xafs_group, name):
+    values = getattr(xafs_group, name)
+    if not values.flags.writeable:
+        values = np.array(values)
+        setattr(xafs_group, name, values)
+    return values
+
+# group_nbytes
+# bytes of the array data of a group, counting arrays shared with other
+# groups once
+# input:
+#  - a larch group or a list of groups
+def group_nbytes(xafs_groups):
+    if not isinstance(xafs_groups, (list, tuple)):
+        xafs_groups = [xafs_groups]
+    seen = set()
+    total = 0
+    for xafs_group in xafs_groups:
+        for value in vars(xafs_group).values():
+            if not isinstance(value, np.ndarray):
+                continue
+            # views share the memory of their base array
+            base = value
+            while base.base is not None and isinstance(base.base, np.ndarray):
+                base = base.base
+            if id(base) not in seen:
+                seen.add(id(base))
+                total += base.nbytes
+    return total
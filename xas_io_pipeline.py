@@ -0,0 +1,169 @@
+# staged pipeline for bulk processing
+# the serial loop reads a file, reduces it and writes its outputs before
+# reading the next one, so the processor waits for the (network) storage and
+# the storage waits for the processor. Here each stage runs at the same time
+# as the others:
+#
+#   read     threads reading the files (the GIL is released while waiting)
+#   compute  process pool (parsing, autobk, xftf, ...)
+#   output   the caller, which takes the results in the order of the items
+#            (merges and athena projects come out as in a serial run), with
+#            WriteQueue threads for writing the output files
+#
+# the number of items read but not yet taken by the output is limited
+# (queue_size), a stage waits when the next stage falls behind, so memory
+# stays bounded and the run goes at the speed of the slowest stage.
+#
+#   pipeline = OrderedPipeline(read, compute, pool, read_threads=2)
+#   for item, result in pipeline.run(items):
+#       ...
+
+import queue
+import logging
+import threading
+
+# seconds between checks of the stop flag while a thread waits
+WAIT_SECONDS = 0.1
+
+# result of an item computed on a reader thread, or of a failed read, with
+# the same get as the results of the pool
+class Ready:
+    def __init__(self, value=None, error=None):
+        self.value = value
+        self.error = error
+
+    def get(self):
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+class OrderedPipeline:
+    # input:
+    #  - function reading an item, run on the reader threads
+    #  - function computing the result from what was read, run on the pool
+    #    (it must be a module function so it can be sent to the processes)
+    #  - the process pool, None to compute on the reader threads
+    #  - number of reader threads
+    #  - largest number of items read (or being read) and not yet taken by
+    #    the output
+    def __init__(self, read, compute, pool=None, read_threads=2,
+                 queue_size=16):
+        self.read = read
+        self.compute = compute
+        self.pool = pool
+        self.read_threads = max(1, read_threads)
+        self.queue_size = max(1, queue_size)
+
+    # run
+    # read and compute the items, the results are given in the order of the
+    # items as they are ready
+    # output:
+    #  - generator of (item, result), an error reading or computing an item
+    #    is raised when its turn comes
+    def run(self, items):
+        items = list(items)
+        work = queue.Queue()
+        for position, item in enumerate(items):
+            work.put((position, item))
+        # a slot is taken before an item is taken from the work queue, so the
+        # next item in order always has one
+        slots = threading.Semaphore(self.queue_size)
+        taking = threading.Lock()
+        results = {}
+        ready = threading.Condition()
+        stop = threading.Event()
+
+        def reader():
+            while not stop.is_set():
+                if not slots.acquire(timeout=WAIT_SECONDS):
+                    continue
+                with taking:
+                    try:
+                        position, item = work.get_nowait()
+                    except queue.Empty:
+                        slots.release()
+                        return
+                try:
+                    value = self.read(item)
+                    if self.pool is None:
+                        result = Ready(self.compute(value))
+                    else:
+                        result = self.pool.apply_async(self.compute, (value,))
+                except Exception as error:
+                    result = Ready(error=error)
+                with ready:
+                    results[position] = result
+                    ready.notify_all()
+
+        threads = [threading.Thread(target=reader, daemon=True)
+                   for _ in range(min(self.read_threads, max(1, len(items))))]
+        for thread in threads:
+            thread.start()
+        try:
+            for position, item in enumerate(items):
+                with ready:
+                    while position not in results:
+                        ready.wait()
+                    result = results.pop(position)
+                yield item, result.get()
+                # the slot is free once the output is done with the item
+                slots.release()
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+class WriteQueue:
+    # threads writing output files, submit waits when too many writes are
+    # pending
+    # input:
+    #  - number of threads
+    #  - largest number of writes pending
+    def __init__(self, threads=2, max_pending=16):
+        self.queue = queue.Queue(maxsize=max(1, max_pending))
+        self.errors = []
+        self.written = 0
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self.writer, daemon=True)
+                        for _ in range(max(1, threads))]
+        for thread in self.threads:
+            thread.start()
+
+    def writer(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+            function, args = task
+            try:
+                function(*args)
+                with self.lock:
+                    self.written += 1
+            except Exception as error:
+                self.errors.append(error)
+
+    # write in a thread: function(*args), errors of earlier writes are
+    # raised here
+    def submit(self, function, *args):
+        self.check()
+        self.queue.put((function, args))
+
+    def check(self):
+        if self.errors:
+            raise self.errors[0]
+
+    # wait for the pending writes and stop the threads
+    def close(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        log_message = "Written files: " + str(self.written)
+        logging.info(log_message)
+        self.check()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
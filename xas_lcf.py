@@ -0,0 +1,480 @@
+# linear combination fitting of many spectra at once
+# larch lincombo_fit interpolates the standards onto the grid of the spectrum
+# and runs an lmfit minimisation for each spectrum. When many spectra (eg: all
+# the time points of a run) are fitted with the same standards, the standards
+# are interpolated onto the fit grid only once and the fit of each spectrum is
+# a small quadratic problem with the Gram matrix of the standards (A^T A):
+#
+#   min |A w - y|^2   with   sum(w) = 1   and   minvals <= w <= maxvals
+#
+# without bounds, the weights of all the spectra are found with a single
+# linear solve. Spectra whose weights fall outside the bounds are solved again
+# with an active set method (fixing weights at the bounds), which only uses
+# the n_standards x n_standards Gram matrix.
+#
+#   result = batch_lcf(readings, standards)     # normalised larch groups
+#   result.weights        # (n_spectra, n_standards)
+#   result.write_csv('lcf_time_series.csv')
+
+import logging
+import multiprocessing
+from math import comb
+
+import numpy as np
+
+from larch.math import interp, index_of
+
+from xas_csv import write_csv_data
+
+# label of a group, as used by larch lincombo_fit
+def get_label(xafs_group):
+    for name in ('filename', 'label', 'groupname', '__name__'):
+        label = getattr(xafs_group, name, None)
+        if label is not None:
+            return label
+    return hex(id(xafs_group))
+
+# fit_range
+# the points of the energy grid between xmin and xmax (as lincombo_fit)
+def fit_range(energy, xmin=-np.inf, xmax=np.inf):
+    imin = index_of(energy, xmin)
+    imax = index_of(energy, xmax) + 1
+    return slice(imin, imax)
+
+class LCFStandards:
+    # standards interpolated onto the fit grid, with their Gram matrix
+    # input:
+    #  - list of normalised larch groups
+    #  - the fit grid (energy)
+    #  - name of the array fitted
+    def __init__(self, standards, energy, arrayname='norm', kind='cubic'):
+        self.energy = np.asarray(energy)
+        self.arrayname = arrayname
+        self.labels = [get_label(standard) for standard in standards]
+        # (n_points, n_standards)
+        self.matrix = np.column_stack([
+            interp(standard.energy, getattr(standard, arrayname),
+                   self.energy, kind=kind) for standard in standards])
+        self.gram = self.matrix.T @ self.matrix
+
+    def __len__(self):
+        return len(self.labels)
+
+# solve_kkt
+# weights minimising |A w - y|^2 with sum(w) = total for the free weights,
+# for one or many right hand sides (columns of aty)
+# input:
+#  - Gram matrix of the free standards
+#  - A^T y for each spectrum (n_free, n_spectra)
+#  - sum of the free weights for each spectrum, None for no sum constraint
+def solve_kkt(gram, aty, total=None):
+    if total is None:
+        return np.linalg.lstsq(gram, aty, rcond=None)[0]
+    n_free = gram.shape[0]
+    kkt = np.zeros((n_free + 1, n_free + 1))
+    kkt[:n_free, :n_free] = gram
+    kkt[:n_free, n_free] = 1.0
+    kkt[n_free, :n_free] = 1.0
+    rhs = np.vstack([aty, np.atleast_2d(total)])
+    return np.linalg.lstsq(kkt, rhs, rcond=None)[0][:n_free]
+
+# solve_bounded
+# active set solution of the fit of one spectrum with bounds
+# input:
+#  - Gram matrix of the standards and A^T y of the spectrum
+#  - True to make the weights sum to one
+#  - lower and upper bounds of the weights
+# output:
+#  - the weights
+def solve_bounded(gram, aty, sum_to_one, minvals, maxvals, max_iterations=100):
+    n_comps = len(aty)
+    # feasible start: equal weights moved inside the bounds
+    weights = np.clip(np.full(n_comps, 1.0 / n_comps), minvals, maxvals)
+    if sum_to_one and not np.isclose(weights.sum(), 1.0):
+        weights = feasible_start(minvals, maxvals)
+    # weights fixed at a bound
+    fixed = np.zeros(n_comps, dtype=bool)
+    for _ in range(max_iterations):
+        free = ~fixed
+        total = None
+        if sum_to_one:
+            total = 1.0 - weights[fixed].sum()
+        target = weights.copy()
+        if free.any():
+            rhs = aty[free] - gram[np.ix_(free, fixed)] @ weights[fixed]
+            target[free] = solve_kkt(gram[np.ix_(free, free)], rhs[:, None],
+                                     total)[:, 0]
+        step = target - weights
+        if np.allclose(step, 0.0, atol=1e-12):
+            # check if a fixed weight should be released: the gradient must
+            # push it against its bound
+            gradient = gram @ weights - aty
+            if sum_to_one and free.any():
+                gradient = gradient - gradient[free].mean()
+            at_min = fixed & np.isclose(weights, minvals)
+            release = (at_min & (gradient < -1e-12)) | \
+                (fixed & ~at_min & (gradient > 1e-12))
+            if not release.any():
+                return weights
+            fixed[np.argmax(np.abs(gradient) * release)] = False
+            continue
+        # longest step inside the bounds
+        ratios = np.ones(n_comps)
+        decreasing = free & (step < 0)
+        increasing = free & (step > 0)
+        ratios[decreasing] = (minvals[decreasing] - weights[decreasing]) / \
+            step[decreasing]
+        ratios[increasing] = (maxvals[increasing] - weights[increasing]) / \
+            step[increasing]
+        blocking = int(np.argmin(ratios))
+        alpha = min(1.0, max(0.0, ratios[blocking]))
+        weights = weights + alpha * step
+        if alpha < 1.0:
+            fixed[blocking] = True
+            weights[blocking] = minvals[blocking] if step[blocking] < 0 \
+                else maxvals[blocking]
+    return weights
+
+# weights inside the bounds which sum to one
+def feasible_start(minvals, maxvals):
+    low = np.where(np.isfinite(minvals), minvals, np.minimum(maxvals, 0.0))
+    high = np.where(np.isfinite(maxvals), maxvals, np.maximum(minvals, 1.0))
+    if low.sum() > 1.0 or high.sum() < 1.0:
+        raise ValueError("no weights inside the bounds sum to one")
+    # move from the lower bounds towards the upper bounds
+    fraction = (1.0 - low.sum()) / max(high.sum() - low.sum(), 1e-300)
+    return low + fraction * (high - low)
+
+# solve the bounded fits of a chunk of spectra, used by the worker pool
+def solve_bounded_task(task):
+    gram, aty_chunk, sum_to_one, minvals, maxvals = task
+    return np.array([solve_bounded(gram, aty, sum_to_one, minvals, maxvals)
+                     for aty in aty_chunk])
+
+# solve_lcf
+# weights of many spectra with the same standards
+# input:
+#  - Gram matrix of the standards (n_standards, n_standards)
+#  - A^T y of each spectrum (n_spectra, n_standards)
+#  - True to make the weights sum to one
+#  - lower and upper bounds (arrays, -inf/inf for no bound)
+#  - number of processes for the spectra which need the bounded solution
+def solve_lcf(gram, aty, sum_to_one=True, minvals=None, maxvals=None,
+              workers=1):
+    n_comps = gram.shape[0]
+    minvals = bounds_array(minvals, -np.inf, n_comps)
+    maxvals = bounds_array(maxvals, np.inf, n_comps)
+    total = np.ones(len(aty)) if sum_to_one else None
+    weights = solve_kkt(gram, aty.T, total).T
+    outside = np.any((weights < minvals - 1e-12) | (weights > maxvals + 1e-12),
+                     axis=1)
+    if outside.any():
+        indexes = np.nonzero(outside)[0]
+        if workers > 1 and len(indexes) > workers:
+            chunks = np.array_split(indexes, workers)
+            tasks = [(gram, aty[chunk], sum_to_one, minvals, maxvals)
+                     for chunk in chunks]
+            with multiprocessing.Pool(processes=workers) as pool:
+                solved = pool.map(solve_bounded_task, tasks)
+            for chunk, chunk_weights in zip(chunks, solved):
+                weights[chunk] = chunk_weights
+        else:
+            for index in indexes:
+                weights[index] = solve_bounded(gram, aty[index], sum_to_one,
+                                               minvals, maxvals)
+    return weights
+
+def bounds_array(values, default, n_comps):
+    if values is None:
+        return np.full(n_comps, default)
+    values = np.broadcast_to(np.asarray(values, dtype=float), (n_comps,))
+    return np.where(np.isnan(values), default, values)
+
+class LCFResult:
+    # fit of many spectra with the same standards
+    def __init__(self, labels, standards, energy, ydata, weights,
+                 sum_to_one=True, times=None):
+        self.labels = labels
+        self.sum_to_one = sum_to_one
+        self.standard_labels = standards.labels
+        self.energy = energy
+        self.ydata = ydata
+        self.weights = weights
+        self.times = np.arange(len(labels)) if times is None else \
+            np.asarray(times)
+        self.yfit = weights @ standards.matrix.T
+        self.residual = ydata - self.yfit
+        self.chisqr = (self.residual**2).sum(axis=1)
+        self.rfactor = self.chisqr / (ydata**2).sum(axis=1)
+        self.nvarys = len(standards) - (1 if self.sum_to_one else 0)
+        self.redchi = self.chisqr / max(1, len(energy) - self.nvarys)
+
+    # weights of a standard for all the spectra
+    def fraction(self, standard_label):
+        return self.weights[:, self.standard_labels.index(standard_label)]
+
+    # one row per spectrum with the weights and fit statistics
+    def rows(self):
+        rows = {}
+        for index, label in enumerate(self.labels):
+            row = {'id': index, 'label': label, 'time': self.times[index]}
+            for standard_index, standard in enumerate(self.standard_labels):
+                row[standard] = self.weights[index, standard_index]
+            row['total'] = self.weights[index].sum()
+            row['chisqr'] = self.chisqr[index]
+            row['redchi'] = self.redchi[index]
+            row['rfactor'] = self.rfactor[index]
+            rows[index] = row
+        return rows
+
+    # write the fractions and residuals of each spectrum as a time series
+    def write_csv(self, file_name):
+        write_csv_data(self.rows(), file_name)
+
+    # save the fitted data, fits and residual curves
+    def save(self, file_name):
+        with open(file_name, 'wb') as lcf_file:
+            np.savez(lcf_file, energy=self.energy, ydata=self.ydata,
+                     yfit=self.yfit, residual=self.residual,
+                     weights=self.weights, times=self.times,
+                     labels=np.array(self.labels, dtype=str),
+                     standards=np.array(self.standard_labels, dtype=str))
+
+# batch_lcf
+# linear combination fit of many spectra with the same standards
+# input:
+#  - the spectra: list of normalised larch groups, or a tuple (energy,
+#    stack of arrays) for spectra on the same grid (eg: xas_batch results)
+#  - list of normalised larch groups of the standards
+#  - fit range and name of the array fitted (as lincombo_fit)
+#  - True to make the weights sum to one
+#  - lower and upper bounds of the weights, the defaults keep the fractions
+#    between 0 and 1 (None for no bounds, as lincombo_fit)
+#  - number of processes for the bounded fits
+#  - time (or other value) of each spectrum for the time series
+# output:
+#  - LCFResult
+def batch_lcf(spectra, standards, xmin=-np.inf, xmax=np.inf,
+              arrayname='norm', sum_to_one=True, minvals=0.0, maxvals=1.0,
+              workers=1, times=None, labels=None):
+    if isinstance(spectra, tuple):
+        energy, ydata = spectra
+        energy = np.asarray(energy)
+        ydata = np.atleast_2d(ydata)
+        if labels is None:
+            labels = [str(index) for index in range(len(ydata))]
+        selection = fit_range(energy, xmin, xmax)
+        energy = energy[selection]
+        ydata = ydata[:, selection]
+    else:
+        # grid of the first spectrum, the others are interpolated onto it
+        energy = np.asarray(spectra[0].energy)
+        energy = energy[fit_range(energy, xmin, xmax)]
+        ydata = np.array([
+            interp(a_group.energy, getattr(a_group, arrayname), energy,
+                   kind='cubic') for a_group in spectra])
+        if labels is None:
+            labels = [get_label(a_group) for a_group in spectra]
+    prepared = LCFStandards(standards, energy, arrayname)
+    aty = ydata @ prepared.matrix
+    weights = solve_lcf(prepared.gram, aty, sum_to_one, minvals, maxvals,
+                        workers)
+    log_message = "LCF of " + str(len(ydata)) + " spectra with " + \
+        str(len(prepared)) + " standards"
+    logging.info(log_message)
+    return LCFResult(labels, prepared, energy, ydata, weights, sum_to_one,
+                     times)
+
+ #######################################################
+# |     Search of the best combinations of standards  | #
+# V                                                   V #
+ #######################################################
+
+# fit_subset
+# weights and chi-square of the fit with some of the standards, from the Gram
+# matrix of all the standards
+# input:
+#  - Gram matrix, A^T y and y^T y of the spectrum with all the standards
+#  - indexes of the standards used
+# output:
+#  - weights of the standards used and chi-square
+def fit_subset(gram, aty, yty, subset, sum_to_one, minvals, maxvals):
+    subset = list(subset)
+    sub_gram = gram[np.ix_(subset, subset)]
+    sub_aty = aty[subset]
+    weights = solve_lcf(sub_gram, sub_aty[None, :], sum_to_one,
+                        minvals[subset], maxvals[subset])[0]
+    # |A w - y|^2 = y^T y - 2 w^T A^T y + w^T A^T A w
+    chisqr = yty - 2.0 * weights @ sub_aty + weights @ sub_gram @ weights
+    return weights, max(chisqr, 0.0)
+
+class SubsetSearch:
+    # depth first search of the subsets of standards keeping the best fits
+    # a subset whose standards are all in a larger set can not fit better
+    # than it (the extra weights can be 0), so when the fit with the standards
+    # already chosen and all the standards still to be tried is worse than the
+    # top fits, none of the subsets of the branch is tried
+    # input:
+    #  - Gram matrix, A^T y and y^T y of the spectrum
+    #  - number of points of the fit
+    #  - largest number of standards in a combination
+    #  - number of best combinations kept
+    #  - sum to one and bounds as solve_lcf
+    def __init__(self, gram, aty, yty, npts, max_standards, top, sum_to_one,
+                 minvals, maxvals):
+        self.gram = gram
+        self.aty = aty
+        self.yty = yty
+        self.npts = npts
+        self.max_standards = max_standards
+        self.top = top
+        self.sum_to_one = sum_to_one
+        self.minvals = minvals
+        self.maxvals = maxvals
+        # pruning needs the weights of the standards left out (0) to be
+        # inside the bounds
+        self.prune = bool(np.all(minvals <= 0.0) and np.all(maxvals >= 0.0))
+        # fits by subset, the bounds of a branch reuse them
+        self.fits = {}
+        # best fits as (redchi, subset, weights, chisqr), sorted by redchi
+        self.best = []
+        self.evaluated = 0
+        self.pruned = 0
+
+    def nvarys(self, n_standards):
+        return n_standards - (1 if self.sum_to_one else 0)
+
+    def redchi(self, chisqr, n_standards):
+        return chisqr / max(1, self.npts - self.nvarys(n_standards))
+
+    # reduced chi-square needed to enter the top fits
+    def threshold(self):
+        if len(self.best) < self.top:
+            return np.inf
+        return self.best[-1][0]
+
+    def fit(self, subset):
+        if subset not in self.fits:
+            self.fits[subset] = fit_subset(self.gram, self.aty, self.yty,
+                                           subset, self.sum_to_one,
+                                           self.minvals, self.maxvals)
+        return self.fits[subset]
+
+    def add(self, subset):
+        weights, chisqr = self.fit(subset)
+        self.evaluated += 1
+        redchi = self.redchi(chisqr, len(subset))
+        if redchi < self.threshold():
+            self.best.append((redchi, subset, weights, chisqr))
+            self.best.sort(key=lambda fit: fit[0])
+            del self.best[self.top:]
+
+    # number of subsets of a branch, to count the subsets pruned
+    def branch_size(self, n_chosen, n_candidates):
+        left = self.max_standards - n_chosen
+        return sum(comb(n_candidates, size) for size in range(0, left + 1))
+
+    # search the subsets with the chosen standards and some of the candidates
+    def search(self, chosen, candidates):
+        self.add(chosen)
+        if len(chosen) == self.max_standards:
+            return
+        for position, index in enumerate(candidates):
+            branch = chosen + (index,)
+            rest = candidates[position + 1:]
+            if self.prune and len(rest) > 0 and \
+                    len(branch) < self.max_standards:
+                # best possible fit of the branch
+                chisqr = self.fit(branch + rest)[1]
+                if self.redchi(chisqr, len(branch)) >= self.threshold():
+                    self.pruned += self.branch_size(len(branch), len(rest))
+                    continue
+            self.search(branch, rest)
+
+# search the combinations starting with one standard, used by the worker pool
+def subset_search_task(task):
+    (first, gram, aty, yty, npts, max_standards, top, sum_to_one, minvals,
+     maxvals) = task
+    search = SubsetSearch(gram, aty, yty, npts, max_standards, top,
+                          sum_to_one, minvals, maxvals)
+    search.search((first,), tuple(range(first + 1, len(aty))))
+    return search.best, search.evaluated, search.pruned
+
+class CombinationResult:
+    # best combinations of standards for a spectrum
+    def __init__(self, label, standard_labels, best, evaluated, pruned):
+        self.label = label
+        self.standard_labels = standard_labels
+        self.evaluated = evaluated
+        self.pruned = pruned
+        # list of (redchi, indexes of the standards, weights, chisqr)
+        self.best = best
+
+    # labels and weights of the standards of a combination (0 is the best)
+    def combination(self, rank=0):
+        _, subset, weights, _ = self.best[rank]
+        return {self.standard_labels[index]: weight
+                for index, weight in zip(subset, weights)}
+
+    # one row per combination, best first
+    def rows(self):
+        rows = {}
+        for rank, (redchi, subset, weights, chisqr) in enumerate(self.best):
+            rows[rank] = {'rank': rank,
+                          'standards': ' + '.join(self.standard_labels[index]
+                                                  for index in subset),
+                          'weights': ' '.join('%.4f' % weight
+                                              for weight in weights),
+                          'n_standards': len(subset),
+                          'chisqr': chisqr, 'redchi': redchi}
+        return rows
+
+    def write_csv(self, file_name):
+        write_csv_data(self.rows(), file_name)
+
+# combinatorial_lcf
+# fit a spectrum with all the combinations of up to max_standards standards
+# and keep the best ones by reduced chi-square
+# the standards are interpolated and their Gram matrix calculated once, each
+# combination is then solved from the rows and columns of its standards
+# input:
+#  - normalised larch group of the spectrum
+#  - list of normalised larch groups of the standards
+#  - largest number of standards in a combination
+#  - number of best combinations reported
+#  - fit range, name of the array fitted, sum to one and bounds as batch_lcf
+#  - number of processes, the combinations are split by their first standard
+# output:
+#  - CombinationResult
+def combinatorial_lcf(xafs_group, standards, max_standards=3, top=10,
+                      xmin=-np.inf, xmax=np.inf, arrayname='norm',
+                      sum_to_one=True, minvals=0.0, maxvals=1.0, workers=1):
+    energy = np.asarray(xafs_group.energy)
+    selection = fit_range(energy, xmin, xmax)
+    energy = energy[selection]
+    ydata = np.asarray(getattr(xafs_group, arrayname))[selection]
+    prepared = LCFStandards(standards, energy, arrayname)
+    n_standards = len(prepared)
+    max_standards = min(max_standards, n_standards)
+    aty = ydata @ prepared.matrix
+    yty = ydata @ ydata
+    minvals = bounds_array(minvals, -np.inf, n_standards)
+    maxvals = bounds_array(maxvals, np.inf, n_standards)
+
+    tasks = [(first, prepared.gram, aty, yty, len(energy), max_standards, top,
+              sum_to_one, minvals, maxvals) for first in range(n_standards)]
+    if workers > 1:
+        with multiprocessing.Pool(processes=workers) as pool:
+            outputs = pool.map(subset_search_task, tasks)
+    else:
+        outputs = [subset_search_task(task) for task in tasks]
+
+    best = sorted([fit for output in outputs for fit in output[0]],
+                  key=lambda fit: fit[0])[:top]
+    evaluated = sum(output[1] for output in outputs)
+    pruned = sum(output[2] for output in outputs)
+    log_message = "LCF of " + get_label(xafs_group) + ": " + \
+        str(evaluated) + " combinations fitted, " + str(pruned) + " pruned"
+    logging.info(log_message)
+    return CombinationResult(get_label(xafs_group), prepared.labels, best,
+                             evaluated, pruned)
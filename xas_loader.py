@@ -0,0 +1,205 @@
+# fast loading of column data files
+# larch read_ascii parses every line of a file in python and builds a group
+# with all the columns. For bulk processing only the columns in the ini file
+# are needed, so the numbers are parsed with the numpy text parser (written
+# in C) in a single call which only keeps the configured columns.
+#
+# files from the same run share the same header format: number of header
+# lines, line with the column labels and number of columns. The formats of
+# the files read are kept, and a new file is first checked against them: the
+# header is split at the same number of lines (str.split, in C) and only the
+# line after it (data), the last header line (not data) and the label line
+# are checked, instead of testing every header line in python. Only a file
+# with a new format is scanned line by line. The rest of the header can
+# change from file to file (eg: timestamps). The larch group is only created
+# when it is needed (see LoadedFile.group).
+
+import io
+import logging
+from pathlib import Path
+
+import numpy as np
+
+# number of header formats kept
+HEADER_FORMATS = 16
+
+# header formats of the files read, most recently used first, each as
+# (number of header lines, index of the label line, labels, number of columns)
+_header_formats = []
+
+class HeaderFormat:
+    # input:
+    #  - number of characters before the first data line
+    #  - header lines (without the comment characters)
+    #  - column labels
+    #  - number of columns of the data
+    def __init__(self, data_start, header, labels, n_columns):
+        self.data_start = data_start
+        self.header = header
+        self.labels = labels
+        self.n_columns = n_columns
+
+# check if a line of text starts with a number
+def is_data_line(line):
+    words = line.split()
+    if len(words) == 0:
+        return False
+    try:
+        float(words[0])
+    except ValueError:
+        return False
+    return True
+
+# strip the comment characters of a header line
+def strip_comment(line):
+    return line.strip().lstrip('#;*%!').strip()
+
+# column labels from the header lines (without the comment characters)
+# output:
+#  - index of the header line with the labels (usually the last comment
+#    line), None if no line has a label for each column
+#  - the labels
+def column_labels(header, n_columns):
+    for index in range(len(header) - 1, -1, -1):
+        words = header[index].split()
+        if len(words) == n_columns:
+            return index, [word.lower() for word in words]
+    return None, ['col' + str(index + 1) for index in range(n_columns)]
+
+# match_format
+# check if a file has a known header format
+# output:
+#  - HeaderFormat of the file, None if the file has another format
+def match_format(text, header_format):
+    n_lines, label_index, labels, n_columns = header_format
+    parts = text.split('\n', n_lines)
+    if len(parts) <= n_lines:
+        return None
+    first_line = parts[-1].split('\n', 1)[0]
+    if len(first_line.split()) != n_columns or not is_data_line(first_line):
+        return None
+    if n_lines > 0 and is_data_line(parts[n_lines - 1]):
+        return None
+    header = [strip_comment(line) for line in parts[:-1]]
+    # the labels are in the same line, and no later line could be the labels
+    first_after = 0 if label_index is None else label_index + 1
+    if label_index is not None and \
+            [word.lower() for word in header[label_index].split()] != labels:
+        return None
+    if any(len(line.split()) == n_columns for line in header[first_after:]):
+        return None
+    return HeaderFormat(len(text) - len(parts[-1]), header, list(labels),
+                        n_columns)
+
+# parse_header
+# find where the data starts, the number of columns and their labels, the
+# known header formats are tried first
+# input:
+#  - text of the file
+#  - name of the file, for the error message
+# output:
+#  - HeaderFormat of the file
+def parse_header(text, file_name=''):
+    for position, header_format in enumerate(_header_formats):
+        matched = match_format(text, header_format)
+        if matched is not None:
+            if position > 0:
+                _header_formats.insert(0, _header_formats.pop(position))
+            return matched
+
+    data_start = 0
+    header_lines = []
+    first_line = None
+    while data_start < len(text):
+        line_end = text.find('\n', data_start)
+        if line_end < 0:
+            line_end = len(text)
+        line = text[data_start:line_end]
+        if is_data_line(line):
+            first_line = line
+            break
+        header_lines.append(line)
+        data_start = line_end + 1
+    if first_line is None:
+        # empty file, or only the header was written yet
+        raise ValueError("no data in " + str(file_name))
+
+    header = [strip_comment(line) for line in header_lines]
+    n_columns = len(first_line.split())
+    label_index, labels = column_labels(header, n_columns)
+    _header_formats.insert(0, (len(header_lines), label_index, labels,
+                               n_columns))
+    del _header_formats[HEADER_FORMATS:]
+    return HeaderFormat(data_start, header, list(labels), n_columns)
+
+class LoadedFile:
+    # columns of a data file, read with load_columns
+    def __init__(self, path, header_format, columns):
+        self.path = Path(path)
+        self.header_format = header_format
+        # arrays by name as in the data columns map
+        self.columns = columns
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    # create the larch group with the same attributes set by xas_read_files
+    # read_file ('mur' is saved as 'mue')
+    def group(self):
+        import larch
+        xafsdat = larch.Group()
+        xafsdat.path = str(self.path)
+        xafsdat.filename = self.path.name
+        xafsdat.header = self.header_format.header
+        xafsdat.array_labels = self.header_format.labels
+        for name, values in self.columns.items():
+            if name == 'mur':
+                name = 'mue'
+            setattr(xafsdat, name, values)
+        return xafsdat
+
+# load_columns
+# read the configured columns of a data file
+# input:
+#  - path of the file
+#  - the data columns map (eg: {'energy': 0, 'mu': 5})
+#  - the bytes of the file if they were already read (eg: by the read stage of
+#    xas_io_pipeline.py), None to read the file
+# output:
+#  - LoadedFile with an array for each column in the map
+def load_columns(file_path, data_columns, data=None):
+    if data is None:
+        data = Path(file_path).read_bytes()
+    text = data.decode('latin-1')
+    header_format = parse_header(text, file_path)
+    names = list(data_columns)
+    table = np.loadtxt(io.StringIO(text[header_format.data_start:]),
+                       usecols=[data_columns[name] for name in names],
+                       ndmin=2)
+    columns = {}
+    for index, name in enumerate(names):
+        # copy so each array is contiguous
+        columns[name] = table[:, index].copy()
+    return LoadedFile(file_path, header_format, columns)
+
+# load_stack
+# read the same columns from many files, if all files have the same energy
+# grid the columns are returned as 2D arrays (n_files, n_points) as needed by
+# xas_batch.batch_reduce
+# output:
+#  - energy array, or None if the files have different energy grids
+#  - dictionary with a 2D array (or a list of arrays) for each column
+def load_stack(file_paths, data_columns):
+    loaded = [load_columns(file_path, data_columns) for file_path in file_paths]
+    names = [name for name in data_columns if name != 'energy']
+    energy = loaded[0]['energy']
+    same_grid = all(len(a_file['energy']) == len(energy) and
+                    np.array_equal(a_file['energy'], energy)
+                    for a_file in loaded)
+    if not same_grid:
+        log_message = "files have different energy grids, not stacking"
+        logging.info(log_message)
+        return None, {name: [a_file[name] for a_file in loaded]
+                      for name in data_columns}
+    return energy, {name: np.vstack([a_file[name] for a_file in loaded])
+                    for name in names}
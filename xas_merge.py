@@ -0,0 +1,142 @@
+# merging of xas groups without keeping all the groups in memory
+# larch merge_groups interpolates every group onto the energy grid of the
+# first group and averages the interpolated values. The same result can be
+# obtained by adding each group to a running average on that grid as soon as
+# it is processed, so the memory used does not depend on the number of groups.
+#
+#   merge = RunningMerge()
+#   for a_group in groups:      # can be a generator reading one at a time
+#       merge.add(a_group)
+#   merged_group = merge.result()
+
+import numpy as np
+
+import larch
+from larch.math import interp, index_of
+
+class RunningMerge:
+    # input (same meaning as in larch merge_groups):
+    #  - name of the x array
+    #  - name of the y array
+    #  - interpolation kind
+    #  - trim the result to the energy range of the groups
+    def __init__(self, xarray='energy', yarray='mu', kind='cubic', trim=True):
+        self.xarray = xarray
+        self.yarray = yarray
+        self.kind = kind
+        self.trim = trim
+        self.count = 0
+        # reference grid and y values of the first group (master)
+        self.xout = None
+        self.y0 = None
+        self.xmin = None
+        self.xmax = None
+        # running mean and sum of squared differences from the mean (Welford)
+        # of the interpolated values. merge_groups falls back to linear
+        # interpolation if the cubic result is noisy, so the linear values
+        # are kept too
+        self.sums = {}
+
+    # add a group to the merge
+    def add(self, xafs_group):
+        self.add_arrays(getattr(xafs_group, self.xarray),
+                        getattr(xafs_group, self.yarray))
+
+    # add the x and y arrays of a spectrum to the merge
+    def add_arrays(self, x, y):
+        x = np.asarray(x)
+        y = np.asarray(y)
+        if self.count == 0:
+            self.xout = x.copy()
+            self.y0 = y.copy()
+            self.xmin = min(self.xout)
+            self.xmax = max(self.xout)
+        self.xmin = min(self.xmin, min(x))
+        self.xmax = max(self.xmax, max(x))
+        self.count += 1
+        kinds = [self.kind]
+        if self.kind == 'cubic':
+            kinds.append('linear')
+        for kind in kinds:
+            yvals = interp(x, y, self.xout, kind=kind)
+            if kind not in self.sums:
+                self.sums[kind] = [np.zeros(len(self.xout)),
+                                   np.zeros(len(self.xout))]
+            mean, m2 = self.sums[kind]
+            delta = yvals - mean
+            mean += delta / self.count
+            m2 += delta * (yvals - mean)
+
+    # get the merged group
+    def result(self):
+        if self.count == 0:
+            raise ValueError("no groups to merge")
+        kind = self.kind
+        yave, ystd = self._average(kind)
+        if kind == 'cubic':
+            # if the derivative gets much worse, use linear interpolation
+            if max(np.diff(yave)) > 50*max(np.diff(self.y0)):
+                kind = 'linear'
+                yave, ystd = self._average(kind)
+        xout = self.xout
+        if self.trim:
+            ixmin = index_of(xout, self.xmin)
+            ixmax = index_of(xout, self.xmax)
+            xout = xout[ixmin:ixmax]
+            yave = yave[ixmin:ixmax]
+            ystd = ystd[ixmin:ixmax]
+        merged_group = larch.Group()
+        setattr(merged_group, self.xarray, xout)
+        setattr(merged_group, self.yarray, yave)
+        setattr(merged_group, self.yarray + '_std', ystd)
+        return merged_group
+
+    def _average(self, kind):
+        mean, m2 = self.sums[kind]
+        # population standard deviation as numpy std
+        return mean.copy(), np.sqrt(m2 / self.count)
+
+    # save the state of the merge so it can be continued later
+    def save(self, file_name):
+        arrays = {'xout': self.xout, 'y0': self.y0,
+                  'limits': np.array([self.xmin, self.xmax]),
+                  'count': np.array(self.count)}
+        for kind in self.sums:
+            arrays[kind + '_mean'] = self.sums[kind][0]
+            arrays[kind + '_m2'] = self.sums[kind][1]
+        with open(file_name, 'wb') as state_file:
+            np.savez(state_file, **arrays)
+
+    # load a merge saved with save
+    @classmethod
+    def load(cls, file_name, xarray='energy', yarray='mu', kind='cubic',
+             trim=True):
+        merge = cls(xarray=xarray, yarray=yarray, kind=kind, trim=trim)
+        with np.load(file_name) as state:
+            merge.xout = state['xout']
+            merge.y0 = state['y0']
+            merge.xmin, merge.xmax = state['limits']
+            merge.count = int(state['count'])
+            for name in state.files:
+                if name.endswith('_mean'):
+                    kind_saved = name[:-len('_mean')]
+                    merge.sums[kind_saved] = [state[name].copy(),
+                                              state[kind_saved + '_m2'].copy()]
+                elif name.endswith('_sum'):
+                    # states saved as sums of the values and their squares
+                    kind_saved = name[:-len('_sum')]
+                    ysum = state[name]
+                    ysum2 = state[kind_saved + '_sum2']
+                    m2 = np.maximum(ysum2 - ysum**2 / merge.count, 0.0)
+                    merge.sums[kind_saved] = [ysum / merge.count, m2]
+        return merge
+
+# merge_streaming
+# merge groups from a list or an iterator without keeping them in memory,
+# same arguments as larch merge_groups
+def merge_streaming(groups, xarray='energy', yarray='mu', kind='cubic',
+                    trim=True):
+    merge = RunningMerge(xarray=xarray, yarray=yarray, kind=kind, trim=trim)
+    for a_group in groups:
+        merge.add(a_group)
+    return merge.result()
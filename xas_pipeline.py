@@ -0,0 +1,136 @@
+# processing of a group with pre_edge, autobk and xftf where only the stages
+# affected by a change of parameters are run again
+# each stage depends on the results of the stage before it:
+#
+#   pre_edge (e0, edge_step, norm, flat)
+#     -> autobk (bkg, k, chi)
+#       -> xftf (kwin, r, chir_mag)
+#
+# so a change of kweight for xftf only needs the fourier transform to run
+# again, while a change of rbkg needs autobk and xftf. The results of each
+# stage are kept for the parameters already used, so going back to a previous
+# value (eg: kweight 1 -> 2 -> 1) does not run anything.
+#
+#   pipeline = XafsPipeline(fe_xafs, xftf=XFTF_DEFAULTS)
+#   pipeline.run()
+#   pipeline.update(rbkg=0.7)              # autobk and xftf
+#   pipeline.update('xftf', kweight=2)     # only xftf
+
+import json
+import logging
+from collections import OrderedDict
+
+from larch.xafs import pre_edge, autobk, xftf
+
+# stages in the order they are run
+STAGES = ['pre_edge', 'autobk', 'xftf']
+
+# parameters of the larch function of each stage
+STAGE_PARAMETERS = {
+    'pre_edge': ['e0', 'step', 'pre1', 'pre2', 'norm1', 'norm2', 'nnorm',
+                 'nvict', 'make_flat', 'emin_area'],
+    'autobk': ['rbkg', 'e0', 'edge_step', 'nknots', 'kmin', 'kmax',
+               'kweight', 'dk', 'win', 'k_std', 'chi_std', 'nfft', 'kstep',
+               'nclamp', 'clamp_lo', 'clamp_hi', 'calc_uncertainties',
+               'err_sigma'],
+    'xftf': ['kmin', 'kmax', 'kweight', 'dk', 'dk2', 'window', 'kwindow',
+             'rmax_out', 'nfft', 'kstep', 'with_phase'],
+}
+
+# results kept for previous parameters
+MAX_RESULTS = 64
+
+class XafsPipeline:
+    # input:
+    #  - larch group with energy and mu
+    #  - parameters for pre_edge, autobk and xftf
+    #  - larch interpreter passed to the larch functions (optional)
+    def __init__(self, xafs_group, pre_edge=None, autobk=None, xftf=None,
+                 _larch=None):
+        if not hasattr(xafs_group, 'mu'):
+            raise ValueError("the group has no mu, calculate it first")
+        self.group = xafs_group
+        self.params = {'pre_edge': dict(pre_edge or {}),
+                       'autobk': dict(autobk or {}),
+                       'xftf': dict(xftf or {})}
+        self._larch = _larch
+        # key of the results currently in the group for each stage
+        self.current = {}
+        # attributes set by each stage, by stage key
+        self.results = OrderedDict()
+        # number of times each stage was run
+        self.runs = {stage: 0 for stage in STAGES}
+
+    # find the stage of a parameter given without stage, only for names used
+    # by a single stage (eg: rbkg), kweight or kmin need the stage
+    def stage_of(self, name):
+        stages = [stage for stage in STAGES
+                  if name in STAGE_PARAMETERS[stage]]
+        if len(stages) != 1:
+            raise ValueError("give the stage for parameter " + name +
+                             " (one of " + str(STAGES) + ")")
+        return stages[0]
+
+    # change parameters, nothing is run until run is called
+    # input:
+    #  - stage of the parameters, None to find it from the parameter names
+    #  - the parameters (value None to go back to the larch default)
+    def set(self, stage=None, **params):
+        if stage is not None and stage not in STAGES:
+            raise ValueError("unknown stage " + str(stage))
+        for name, value in params.items():
+            param_stage = stage if stage is not None else self.stage_of(name)
+            if value is None:
+                self.params[param_stage].pop(name, None)
+            else:
+                self.params[param_stage][name] = value
+        return self
+
+    # key of the results of a stage: its parameters and the parameters of
+    # the stages before it
+    def key(self, stage):
+        stages = STAGES[:STAGES.index(stage) + 1]
+        return json.dumps([stage] + [self.params[a_stage] for a_stage in stages],
+                          sort_keys=True, default=str)
+
+    # run the stages whose parameters (or the parameters before them) changed
+    # output:
+    #  - the group with the results
+    def run(self):
+        functions = {'pre_edge': pre_edge, 'autobk': autobk, 'xftf': xftf}
+        for stage in STAGES:
+            key = self.key(stage)
+            if self.current.get(stage) == key:
+                continue
+            if key in self.results:
+                # same parameters used before, restore the results
+                self.results.move_to_end(key)
+                for name, value in self.results[key].items():
+                    setattr(self.group, name, value)
+            else:
+                before = {name: id(value)
+                          for name, value in vars(self.group).items()}
+                kws = dict(self.params[stage])
+                if self._larch is not None:
+                    kws['_larch'] = self._larch
+                functions[stage](self.group, **kws)
+                self.runs[stage] += 1
+                # the attributes set (or replaced) by the stage
+                self.results[key] = {name: value for name, value
+                                     in vars(self.group).items()
+                                     if before.get(name) != id(value)}
+                while len(self.results) > MAX_RESULTS:
+                    self.results.popitem(last=False)
+            self.current[stage] = key
+        return self.group
+
+    # change parameters and run the stages affected
+    def update(self, stage=None, **params):
+        self.set(stage, **params)
+        return self.run()
+
+    # log how many times each stage was run
+    def log_runs(self):
+        log_message = "stage runs: " + ", ".join(
+            stage + " " + str(self.runs[stage]) for stage in STAGES)
+        logging.info(log_message)
@@ -0,0 +1,194 @@
+# plot rendering for bulk processing
+# basic_plot in xas_read_files creates a new figure with four subplots for
+# each spectrum. Here the figure, the axes and the lines are created once and
+# only the data of the lines is changed for each spectrum, and the plots are
+# rendered by a pool of processes (Agg backend, no windows), so the processing
+# of the next files does not wait for the plots.
+#
+#   plot_service = PlotService(workers=2)
+#   plot_service.submit(xafs_group, save_dir)
+#   ...
+#   plot_service.close()   # waits for the pending plots
+
+import logging
+import multiprocessing
+from pathlib import Path
+
+import numpy as np
+
+# pending plots per worker before submit waits, keeps memory bounded
+MAX_PENDING_PER_WORKER = 16
+
+# plot_data
+# the arrays needed for the plot of a group, the normalised mu is limited to
+# [e0 - 25: e0 + 75] as in basic_plot
+# output:
+#  - dictionary which can be sent to a plot process
+def plot_data(xas_group, dest_dir):
+    j0 = np.abs(xas_group.energy-(xas_group.e0 - 25.0)).argmin()
+    j1 = np.abs(xas_group.energy-(xas_group.e0 + 75.0)).argmin()
+    return {'label': xas_group.label,
+            'save_as': str(Path(dest_dir) / (xas_group.label + "_01.jpg")),
+            'energy': np.asarray(xas_group.energy),
+            'bkg': np.asarray(xas_group.bkg),
+            'mu': np.asarray(xas_group.mu),
+            'norm_energy': np.asarray(xas_group.energy[j0:j1]),
+            'norm': np.asarray(xas_group.norm[j0:j1]),
+            'k': np.asarray(xas_group.k),
+            'chik2': np.asarray(xas_group.chi*xas_group.k**2),
+            'kwin': np.asarray(xas_group.kwin),
+            'r': np.asarray(xas_group.r),
+            'chir_mag': np.asarray(xas_group.chir_mag),
+            'chir_re': np.asarray(xas_group.chir_re)}
+
+class PlotRenderer:
+    # figure with the same four plots as basic_plot, the lines are updated
+    # with the data of each spectrum
+    def __init__(self):
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        self.fig, axes = plt.subplots(2, 2, figsize=(10, 8))
+        self.axes = axes.flatten()
+        self.lines = {}
+
+        # mu + bkg
+        ax = self.axes[0]
+        ax.set_title(r'$\mu$ and background')
+        self.lines['bkg'], = ax.plot([], [], 'r--', label = 'background')
+        self.lines['mu'], = ax.plot([], [], label = r"$\mu$")
+        ax.set_xlabel('Energy (eV)')
+
+        # normalized XANES
+        ax = self.axes[1]
+        ax.set_title(r'normalized $\mu$')
+        self.lines['norm'], = ax.plot([], [], label=r"$\mu$ Normalised")
+        ax.set_xlabel('Energy (eV)')
+
+        # chi(k)
+        ax = self.axes[2]
+        ax.set_title(r"$\chi(k)$")
+        self.lines['chik2'], = ax.plot([], [], label= r'$ \chi(k^2)$')
+        self.lines['kwin'], = ax.plot([], [], 'r--', label= r'$k$ window')
+        ax.set_xlabel(r'$ k (\AA^{-1}) $', fontsize='small')
+        ax.set_ylabel(r'$ k^2 \chi(\AA^{-2}) $', fontsize='small')
+
+        # chi(R)
+        ax = self.axes[3]
+        ax.set_title(r"$\chi(R)$")
+        self.lines['chir_mag'], = ax.plot([], [], label = r"$\chi(R)$ magnitude")
+        self.lines['chir_re'], = ax.plot([], [], 'r--', label = r"$\chi(R)$ re")
+        ax.set_xlabel(r'$ R (\AA) $',fontsize='small')
+        ax.set_ylabel(r'$ \chi(R) (\AA^{-3}) $', fontsize='small')
+
+        for ax in self.axes:
+            ax.grid(linestyle=':', linewidth=1)
+            ax.legend()
+        # the layout does not change between spectra, so it is done once
+        self.fig.tight_layout(pad=3.0)
+        self.title = self.fig.suptitle('')
+
+    # render and save the plot of one spectrum
+    def render(self, data):
+        self.lines['bkg'].set_data(data['energy'], data['bkg'])
+        self.lines['mu'].set_data(data['energy'], data['mu'])
+        self.lines['norm'].set_data(data['norm_energy'], data['norm'])
+        self.lines['chik2'].set_data(data['k'], data['chik2'])
+        self.lines['kwin'].set_data(data['k'], data['kwin'])
+        self.lines['chir_mag'].set_data(data['r'], data['chir_mag'])
+        self.lines['chir_re'].set_data(data['r'], data['chir_re'])
+        for ax in self.axes:
+            ax.relim()
+            ax.autoscale_view()
+        self.title.set_text(data['label'])
+
+        save_as = Path(data['save_as'])
+        if not save_as.parent.exists():
+            save_as.parent.mkdir(parents=True, exist_ok=True)
+        self.fig.savefig(str(save_as))
+        return str(save_as)
+
+ #######################################################
+# |     Plot processes, each one with its renderer    | #
+# V                                                   V #
+ #######################################################
+
+_renderer = None
+
+def init_plot_worker():
+    global _renderer
+    _renderer = PlotRenderer()
+
+def render_task(data):
+    return _renderer.render(data)
+
+class PlotService:
+    # input:
+    #  - number of plot processes
+    def __init__(self, workers=1):
+        self.workers = max(1, workers)
+        self.pool = multiprocessing.Pool(processes=self.workers,
+                                         initializer=init_plot_worker)
+        self.pending = []
+        self.max_pending = MAX_PENDING_PER_WORKER * self.workers
+        self.rendered = 0
+
+    # send a group to be plotted, waits if too many plots are pending
+    def submit(self, xas_group, dest_dir):
+        self.submit_data(plot_data(xas_group, dest_dir))
+
+    def submit_data(self, data):
+        self.collect()
+        while len(self.pending) >= self.max_pending:
+            self.pending[0].wait()
+            self.collect()
+        self.pending.append(self.pool.apply_async(render_task, (data,)))
+
+    # remove the plots already rendered from the pending list
+    def collect(self):
+        still_pending = []
+        for result in self.pending:
+            if result.ready():
+                self.rendered += 1
+                try:
+                    result.get()
+                except Exception as error:
+                    log_message = "plot failed: " + str(error)
+                    logging.info(log_message)
+            else:
+                still_pending.append(result)
+        self.pending = still_pending
+
+    # wait for all the plots and stop the processes
+    def close(self):
+        for result in self.pending:
+            result.wait()
+        self.collect()
+        self.pool.close()
+        self.pool.join()
+        log_message = "Rendered plots: " + str(self.rendered)
+        logging.info(log_message)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# plot_selection
+# check which spectra are plotted according to the --plots option:
+#   all     every spectrum and the merges (default)
+#   merge   only the merges
+#   none    no plots
+#   N       every Nth spectrum of each pattern and the merges
+# input:
+#  - the value of the option
+#  - index of the spectrum in its pattern, None for a merge
+def plot_selection(plots, index=None):
+    if plots == 'none':
+        return False
+    if index is None or plots == 'all':
+        return True
+    if plots == 'merge':
+        return False
+    return index % int(plots) == 0
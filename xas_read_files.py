@@ -6,44 +6,19 @@
 # import library for managing files
 from pathlib import Path
 import sys
-from difflib import SequenceMatcher
-
-# import library for managing csv files
-import csv
-
-# get the data from the csv_file, assuming first column is integer id
-def get_csv_data(input_file, id_field):
-    csv_data = {}
-    fieldnames=[]
-    with open(input_file, newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            if fieldnames==[]:
-                fieldnames=list(row.keys())
-            csv_data[int(row[id_field])]=row
-    return csv_data, fieldnames
-
-# writes data to the given file name
-def write_csv_data(values, filename):
-    fieldnames = []
-    for item in values.keys():
-        for key in values[item].keys():
-            if not key in fieldnames:
-                fieldnames.append(key)
-    #write back to a new csv file
-    with open(filename, 'w', newline='') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        for key in values.keys():
-            writer.writerow(values[key])
+import multiprocessing
+import cProfile
+
+# csv files of results
+from xas_csv import write_csv_columns
 
 # add logging
 # save processing steps in log file
 import logging
 
-file_dir = Path("log_dir")
-if not file_dir.exists():
-    file_dir.mkdir(parents=True)
+LOG_DIR = Path("log_dir")
+if not LOG_DIR.exists():
+    LOG_DIR.mkdir(parents=True)
 
 logging.basicConfig(format='[%(asctime)s] %(message)s', filename='log_dir/processing.log', filemode='w', level=logging.INFO)
 console = logging.StreamHandler()
@@ -63,102 +38,49 @@ import larch
 # larch-xas processing functions
 from larch_plugins.xafs import autobk, xftf
 
-# import the larch.io function for merging groups interpolating if necessary
-from larch.io import merge_groups
+# merging groups interpolating if necessary, without keeping a copy of every
+# interpolated group (same result as larch.io merge_groups)
+from xas_merge import RunningMerge
 
 # import the larch.io libraries for managing athena files
 from larch.io import create_athena, read_athena, extract_athenagroup
 
-# create a larch interpreter, passed to most functions
-my_larch = larch.Interpreter()
+# athena projects written one group at a time, also from shards
+from xas_athena import AthenaWriter, write_athena_shard
 
-# get_file_groups:
-# groups files in a directory according to common text patterns assuming that 
-# patterns correspond to files which must be processed together. 
-# input:
-#  - the directory path where the files to be processed are placed
-#  - the string which is used to filter the files to process (wildcad caracheters)
-# output:
-#  - an indexed list of files, which uses common patterns found as keys
-
-def get_file_groups(source_dir, filename_pattern, group_files):
-    #i_counter = 0
-    files_list = []
-    for filepath in sorted(source_dir.glob(filename_pattern)):
-        #i_counter += 1
-        files_list.append(filepath)
-    log_message = "Found " + str(len(files_list)) + \
-        " files to process with pattern: " + \
-        filename_pattern + \
-        "in dir: " + str(source_dir) + " Group: " +str(group_files)
-    logging.info(log_message)
-    pattern_current = ""
-    file_groups = {}
-
-    if group_files:
-        for index, a_file in enumerate(files_list):
-            file_name = a_file.name
-            if index < len(files_list)-1:
-                another_file = files_list[index+1].name
-                common_pattern = get_common(file_name, another_file)
-                if pattern_current == "":
-                    pattern_current = common_pattern
-                    if pattern_current in file_groups:
-                        file_groups[pattern_current] += [file_name, another_file]
-                    else:
-                        file_groups[pattern_current] = [file_name, another_file]
-                elif pattern_current == common_pattern:
-                    file_groups[pattern_current].append(another_file)
-                else:
-                    pattern_current = ""
-            else:
-                another_file = ""
-
-        patterns_found = file_groups.keys()
-        patterns_remove = []
-
-        # mark redundant patterns to remove
-        for pattern_check in file_groups:
-            for pattern_other in patterns_found:
-                if pattern_other != pattern_check:
-                    # use sets to ignore duplicates
-                    set_check = set(file_groups[pattern_check])
-                    set_other = set(file_groups[pattern_other])
-                    if pattern_other in pattern_check:
-                        #merge check into other and remove check
-                        file_groups[pattern_other] = list(set_other.union(set_check))
-                        patterns_remove.append(pattern_check)
-                    elif pattern_other in pattern_check:
-                        #merge other into check and remove other
-                        patterns_remove.append(pattern_other)
-                        file_groups[pattern_check] = list(set_other.union(set_check))
-    
-        # remove redundant patterns
-        if len(patterns_remove) > 0:
-            for pattern_rem in patterns_remove:
-                file_groups.pop(pattern_rem)
-    else:
-        file_groups['unique'] = []
-        for file in files_list:
-            file_groups['unique'].append(file.name)
-        
-    for pattern in file_groups: 
-        log_message = str(len(file_groups[pattern])) + " files to process with pattern " + pattern + "\nFiles: " + str(file_groups[pattern])
-        logging.info(log_message)
-    return file_groups
+# grouping of files by common name patterns
+from xas_file_groups import get_file_groups
+
+# plots rendered on separate processes
+from xas_plots import PlotService, plot_selection
+
+# binary dataset of processed spectra
+from xas_dataset import DatasetWriter
+
+# fast loading of the data columns
+from xas_loader import load_columns
+
+# persistent cache of processing results
+from xas_cache import ResultCache, process_with_cache
 
+# compact records of the spectra sent back by the workers
+from xas_record import as_record, as_group
 
-# get the common pattern between the two strings
-def get_common(file_1, file_2):
-    common_pattern = ""
-    seqMatch = SequenceMatcher(None, file_1, file_2)
-    match = seqMatch.find_longest_match(0, len(file_1), 0, len(file_2))
-    if (match.size!=0): 
-        common_pattern = file_1[match.a: match.a + match.size]
-    else: 
-         log_message = 'No longest common sub-string found'
-         logging.info(log_message)
-    return common_pattern
+# timing of the processing stages
+from xas_timing import TIMER, stage
+
+# reading, reduction and writing of the outputs running at the same time
+from xas_io_pipeline import OrderedPipeline, WriteQueue
+
+# journal of the work done, to continue a run which was stopped
+from xas_checkpoint import Checkpoint
+
+# create a larch interpreter, passed to most functions
+my_larch = larch.Interpreter()
+
+# parameters used for reducing all the files, e0 is found from the data
+AUTOBK_PARAMS = {'rbkg': 1.0, 'kweight': 2, 'e0': None}
+XFTF_PARAMS = {'kmin': 2, 'kmax': 15, 'dk': 3, 'kweight': 2}
 
 # basic plot of a group
 # input:
@@ -215,7 +137,7 @@ def basic_plot(xas_group, dest_dir, show_plot = False):
     save_as = dest_dir / (xas_group.label + "_01.jpg")
 
     if not save_as.parent.exists():
-        save_as.parent.mkdir(parents=True)
+        save_as.parent.mkdir(parents=True, exist_ok=True)
         
     fig.tight_layout(pad=3.0)
     fig.suptitle(xas_group.label)    
@@ -225,43 +147,16 @@ def basic_plot(xas_group, dest_dir, show_plot = False):
     plt.clf()
 
 # save energy and normalised mu
+# the columns are written directly from the arrays (see xas_csv.py)
 def save_e_nmu(xafsgroup, save_dir):
-    export = {}
-    for n_index, value in enumerate(xafsgroup.energy):
-        export[n_index] = {'energy':value, 'norm':xafsgroup.norm[n_index]}
-    write_csv_data(export, save_dir/(xafsgroup.label+"_EvNm.csv"))
-
-# xas_read_files
-# groups files in a directory according to common text patterns
-# process groups of files using larch with defaults:
-#   get mu (calculate if needed)
-#   get normal, pre-edge and post-edge E0
-#   plot groups
-#   merge groups
-#   plot merge
-#   save diagrams
-#   save all as athena project
-
-def xas_read_files(argv):
-    try:
-        # required
-        file_path = argv[0]
-        name_pattern = argv[1]
-        if len(argv) == 3:
-            if argv[2] == 'T':
-                group_files = True
-        else:
-            group_files = False
-            
-    except:
-        print("missing arguments"+
-              "\n -string files path (eg: ../documents/ascii_path)"+
-              "\n -string file pattern (eg: *experiment_FeO2_sample*)"+
-              "\n -character T or F to indicate if grouping")
-        return
-    
-    file_dir= Path(file_path)
-    # initialisation file
+    with stage('save_e_nmu', xafsgroup.label):
+        write_csv_columns({'energy': xafsgroup.energy, 'norm': xafsgroup.norm},
+                          save_dir/(xafsgroup.label+"_EvNm.csv"))
+
+# read_data_columns
+# get the data columns map from the ini file in the data directory or use the
+# defaults if there is no ini file
+def read_data_columns(file_dir):
     ini_file = file_dir / "xas_processing.ini"
     data_columns = {}
     if ini_file.exists():
@@ -301,76 +196,791 @@ def xas_read_files(argv):
                         'mur': 6}
     log_message = "data_columns:" + str(data_columns)
     logging.info(log_message)
-      
-    file_groups = get_file_groups(file_dir, name_pattern, group_files)
+    return data_columns
+
+# reduce_group
+# background removal and fourier transform with the bulk processing defaults,
+# results are taken from the cache if the same data was already processed
+def reduce_group(xafs_group, cache=None):
+    file_name = getattr(xafs_group, 'filename',
+                        getattr(xafs_group, 'label', None))
+    def process(a_group):
+        # run autobk on the xafsdat Group, including a larch Interpreter....
+        # note that this expects 'energy' and 'mu' to be in xafsdat, and will
+        # write data for 'k', 'chi', 'kwin', 'e0', ... into xafsdat
+        with stage('autobk', file_name):
+            autobk(a_group, _larch=my_larch, **AUTOBK_PARAMS)
+        # Fourier transform to R space, again passing in a Group (here,
+        # 'k' and 'chi' are expected, and writitng out 'r', 'chir_mag',
+        # and so on
+        with stage('xftf', file_name):
+            xftf(a_group, _larch=my_larch, **XFTF_PARAMS)
+    params = {'autobk': AUTOBK_PARAMS, 'xftf': XFTF_PARAMS}
+    # with a cache, reduce includes looking up and saving the results
+    with stage('reduce', file_name):
+        return process_with_cache(xafs_group, params, process, cache)
+
+# read_file
+# read a data file and set the data columns specified in the ini file
+# input:
+#   - path of the file to read
+#   - the data columns map
+#   - True to only read the data columns with the fast loader (xas_loader.py)
+#   - the bytes of the file if they were already read (only used by the fast
+#     loader, larch read_ascii reads the file again)
+# output:
+#   - larch group with the data columns as arrays
+def read_file(file_path, data_columns, fast_load=False, data=None):
+    if fast_load:
+        with stage('fast_load', Path(file_path).name):
+            return load_columns(file_path, data_columns, data).group()
+    with stage('read_ascii', Path(file_path).name):
+        xafsdat = larch.io.read_ascii(file_path)
+    # get data columns specified in ini_file
+    if 'energy' in data_columns:
+        xafsdat.energy = xafsdat.data[data_columns['energy']]
+    if 'time' in data_columns:
+        xafsdat.time = xafsdat.data[data_columns['time']]
+    if 'i0' in data_columns:    
+        xafsdat.i0 = xafsdat.data[data_columns['i0']]
+    if 'it' in data_columns:
+        xafsdat.it = xafsdat.data[data_columns['it']]
+    if 'ir' in data_columns:
+        xafsdat.ir = xafsdat.data[data_columns['ir']]
+    if 'mu' in data_columns:
+        xafsdat.mu = xafsdat.data[data_columns['mu']]
+    if 'mur' in data_columns:
+        xafsdat.mue = xafsdat.data[data_columns['mur']]
+    return xafsdat
+
+# process_file
+# read a single file and reduce it with the bulk processing defaults
+# input:
+#   - path of the file to process
+#   - the data columns map
+#   - the destination dir for plots and csv outputs
+#   - the results cache (optional)
+#   - the options given to xas_read_files (optional)
+#   - True to plot the group
+#   - the plot service (see xas_plots.py), if None the plot is done here
+# output:
+#   - the processed larch group
+def process_file(file_path, data_columns, save_dir, cache=None, options=None,
+                 plot=True, plot_service=None):
+    options = options or {}
+    with stage('file', Path(file_path).name):
+        xafsdat = read_file(file_path, data_columns,
+                            options.get('fast_load', False))
+        reduce_group(xafsdat, cache)
+
+        xafsdat.label = xafsdat.filename[:-4]
+
+        # plot and save each file in group 
+        if plot:
+            plot_group(xafsdat, save_dir, plot_service)
+
+        # save energy v normalised mu
+        if saves_csv(options):
+            save_e_nmu(xafsdat, save_dir)
+    return xafsdat
+
+# process_pattern_groups
+# merge the groups processed for a pattern, plot and save the merge and save
+# everything as an athena project
+# input:
+#   - the groups not yet added to the merge and outputs
+#   - the running merge of the groups if it was updated as the files were
+#     processed (see xas_merge.py)
+#   - the pattern outputs if the groups were written as the files were
+#     processed
+def process_pattern_groups(pattern, groups, save_dir, cache=None,
+                           options=None, plot_service=None, merge=None,
+                           outputs=None):
+    if merge is None:
+        merge = RunningMerge()
+    if outputs is None:
+        outputs = PatternOutputs(pattern, save_dir, options)
+    for a_group in groups:
+        add_to_merge(merge, a_group)
+        outputs.add_group(a_group)
+    # merge groups
+    with stage('merge', pattern[1:][:-1]):
+        merged_group = merge.result()
+    process_merge(merged_group, pattern, save_dir, cache, options,
+                  plot_service)
     
-    # process file groups
-    for pattern in file_groups:
-        groups = []
-        for file in file_groups[pattern]:
-            save_dir = file_dir / 'result' / pattern[1:][:-1]
-            file_path = file_dir / file
-            xafsdat = larch.io.read_ascii(file_path)
-            # get data columns specified in ini_file
-            if 'energy' in data_columns:
-                xafsdat.energy = xafsdat.data[data_columns['energy']]
-            if 'time' in data_columns:
-                xafsdat.time = xafsdat.data[data_columns['time']]
-            if 'i0' in data_columns:    
-                xafsdat.i0 = xafsdat.data[data_columns['i0']]
-            if 'it' in data_columns:
-                xafsdat.it = xafsdat.data[data_columns['it']]
-            if 'ir' in data_columns:
-                xafsdat.ir = xafsdat.data[data_columns['ir']]
-            if 'mu' in data_columns:
-                xafsdat.mu = xafsdat.data[data_columns['mu']]
-            if 'mur' in data_columns:
-                xafsdat.mue = xafsdat.data[data_columns['mur']]
-            # run autobk on the xafsdat Group, including a larch Interpreter....
-            # note that this expects 'energy' and 'mu' to be in xafsdat, and will
-            # write data for 'k', 'chi', 'kwin', 'e0', ... into xafsdat
-            autobk(xafsdat, rbkg=1.0, kweight=2, _larch=my_larch)
-            
-            # Fourier transform to R space, again passing in a Group (here,
-            # 'k' and 'chi' are expected, and writitng out 'r', 'chir_mag',
-            # and so on
-            xftf(xafsdat, kmin=2, kmax=15, dk=3, kweight=2, _larch=my_larch)
+    outputs.add_group(merged_group)
 
-            xafsdat.label = xafsdat.filename[:-4]
-            
-            # add group to list
-            groups.append(xafsdat)
+    log_message = "Processed groups (including merge): " + str(outputs.count) + " for pattern " + (pattern[1:][:-1])
+    logging.info(log_message)
+    
+    # finish the athena project (and dataset)
+    with stage('athena_save', pattern[1:][:-1]):
+        outputs.close()
+    return merged_group
+
+# add a group to the running merge of its pattern
+def add_to_merge(merge, xafs_group):
+    with stage('merge', getattr(xafs_group, 'label', None)):
+        merge.add(xafs_group)
+
+# PatternOutputs
+# athena project and dataset of a pattern, each group is written when it is
+# added so the groups of the pattern do not need to be kept in memory. The
+# shards of a checkpoint are kept until the pattern is finished
+class PatternOutputs:
+    def __init__(self, pattern, save_dir, options=None, keep_shards=False):
+        self.project_name = save_dir / (pattern[1:][:-1] + '.prj')
+        self.keep_shards = keep_shards
+        self.athena = AthenaWriter(self.project_name)
+        self.dataset = None
+        if saves_dataset(options):
+            self.dataset_name = save_dir / (pattern[1:][:-1] + '.npz')
+            self.dataset = DatasetWriter(self.dataset_name)
+        self.count = 0
+
+    # add a group, its athena record can come from a shard written by a
+    # worker (see process_file_task)
+    def add_group(self, xafs_group, shard_name=None):
+        label = getattr(xafs_group, 'label', None)
+        with stage('athena', label):
+            if shard_name is None:
+                self.athena.add_group(as_group(xafs_group))
+            else:
+                self.athena.add_shard(shard_name, remove=not self.keep_shards)
+        if self.dataset is not None:
+            with stage('dataset', label):
+                self.dataset.add_group(xafs_group)
+        self.count += 1
+
+    def close(self):
+        self.athena.close()
+        log_message = "Saved athena project " + str(self.project_name)
+        logging.info(log_message)
+        if self.dataset is not None:
+            self.dataset.close()
+            log_message = "Saved dataset " + str(self.dataset_name)
+            logging.info(log_message)
+
+# process_merge
+# reduce the merge of a pattern, plot it and save energy v normalised mu
+def process_merge(merged_group, pattern, save_dir, cache=None, options=None,
+                  plot_service=None):
+    merged_group.label = pattern[1:][:-1] + "_merge"
+    reduce_group(merged_group, cache)
+    # plot and save for merge
+    if plot_selection((options or {}).get('plots', 'all')):
+        plot_group(merged_group, save_dir, plot_service)
+    # save energy v normalised mu for merge
+    if saves_csv(options):
+        save_e_nmu(merged_group, save_dir)
+    return merged_group
+
+# plot a group with basic_plot or send it to the plot service
+def plot_group(xafs_group, save_dir, plot_service=None):
+    with stage('plot', xafs_group.label):
+        if plot_service is None:
+            basic_plot(xafs_group, save_dir)
+        else:
+            plot_service.submit(xafs_group, save_dir)
+
+# get the plot service from the options, None to plot in the processing loop
+def get_plot_service(options):
+    if options['plot_workers'] < 1 or options['plots'] == 'none':
+        return None
+    log_message = "Rendering plots with " + str(options['plot_workers']) + \
+        " processes"
+    logging.info(log_message)
+    return PlotService(options['plot_workers'])
+
+# check the output format option, csv files are written by default
+def saves_csv(options):
+    return (options or {}).get('output_format', 'csv') in ('csv', 'both')
+
+def saves_dataset(options):
+    return (options or {}).get('output_format', 'csv') in ('dataset', 'both')
+
+ #######################################################
+# |      Worker pool for per-file reduction           | #
+# V   each worker process gets its own interpreter    V #
+ #######################################################
+
+# init_worker
+# runs once in each worker process, replaces the interpreter inherited from
+# the parent so workers never share interpreter state
+def init_worker():
+    global my_larch
+    my_larch = larch.Interpreter()
+    # keep plotting off screen in the workers
+    plt.switch_backend('Agg')
+
+# process_file_task
+# wrapper used by the pool, arguments come as a single tuple
+# the athena record of the group is written by the worker to a shard file
+# (with the index of the file in its pattern), which is added to the project
+# without formatting the group again. The group is sent back as a compact
+# record (see xas_record.py), with the timing of its stages. With a checkpoint
+# of the pattern the record is saved too (see xas_checkpoint.py)
+def process_file_task(task):
+    file_path, data_columns, save_dir, cache, options, plot, shard, \
+        checkpoint = task
+    if (options or {}).get('timing') and not TIMER.enabled:
+        TIMER.enable(options.get('timing_memory', False))
+    xafsdat = process_file(file_path, data_columns, save_dir, cache, options,
+                           plot)
+    record = as_record(xafsdat)
+    if shard is not None:
+        shard_name, index = shard
+        with stage('athena_shard', xafsdat.label):
+            write_athena_shard(shard_name, [xafsdat], index)
+        if checkpoint is not None:
+            with stage('checkpoint', xafsdat.label):
+                checkpoint.save_file(index, file_path, record)
+    return record, TIMER.take_rows()
+
+# name of the athena shard of a file processed by the pool
+def shard_name(shard_dir, index):
+    return shard_dir / (str(index) + '.gz')
+
+ #######################################################
+# |     Pipeline: read, reduce and write at once      | #
+# V       stages connected by bounded queues          V #
+ #######################################################
+
+# read_data
+# read stage of the pipeline, run on the reader threads: the bytes of the file
+# are read and sent with the task. With larch read_ascii the worker reads the
+# file again, from the system cache
+# input:
+#   - the task of process_data_task without the bytes
+# output:
+#   - the task with the bytes of the file (None for read_ascii)
+def read_data(task):
+    file_path, options = task[0], task[4]
+    with stage('read', Path(file_path).name):
+        data = Path(file_path).read_bytes()
+    if not (options or {}).get('fast_load', False):
+        data = None
+    return (file_path, data) + task[1:]
+
+# process_data_task
+# compute stage of the pipeline, run on the pool: the group is made from the
+# bytes read by the read stage, reduced, plotted (if there is no plot service)
+# and its athena record written to a shard as in process_file_task. The csv
+# file is written by the output stage
+def process_data_task(task):
+    file_path, data, data_columns, save_dir, cache, options, plot, shard, \
+        checkpoint = task
+    if (options or {}).get('timing') and not TIMER.enabled:
+        TIMER.enable(options.get('timing_memory', False))
+    with stage('file', Path(file_path).name):
+        xafsdat = read_file(file_path, data_columns,
+                            options.get('fast_load', False), data)
+        reduce_group(xafsdat, cache)
+        xafsdat.label = xafsdat.filename[:-4]
+        if plot:
+            plot_group(xafsdat, save_dir)
+    record = as_record(xafsdat)
+    shard_name, index = shard
+    with stage('athena_shard', xafsdat.label):
+        write_athena_shard(shard_name, [xafsdat], index)
+    if checkpoint is not None:
+        with stage('checkpoint', xafsdat.label):
+            checkpoint.save_file(index, file_path, record)
+    return record, TIMER.take_rows()
+
+# xas_read_files_pipeline
+# the files are read by threads, reduced on a process pool and the outputs
+# written by threads (see xas_io_pipeline.py). Results are taken in file order,
+# so the merges and athena projects are the same as in a serial run
+def xas_read_files_pipeline(file_dir, file_groups, data_columns, workers,
+                            cache=None, options=None, plot_service=None,
+                            checkpoint=None):
+    options = options or {}
+    plots = options.get('plots', 'all')
+    # items read, reduced or written but not yet merged
+    queue_size = options.get('queue_size') or 4 * workers
+    log_message = "Pipeline with " + str(options.get('read_threads', 2)) + \
+        " reader threads, " + str(workers) + " workers, " + \
+        str(options.get('write_threads', 2)) + " writer threads, " + \
+        str(queue_size) + " files in flight"
+    logging.info(log_message)
+    tasks = []
+    patterns = []
+    for pattern in file_groups:
+        save_dir = file_dir / 'result' / pattern[1:][:-1]
+        if pattern_done(checkpoint, pattern, file_groups[pattern], save_dir):
+            continue
+        pattern_checkpoint, done = get_pattern_checkpoint(
+            checkpoint, pattern, file_dir, file_groups[pattern])
+        shard_dir = get_shard_dir(pattern, save_dir, pattern_checkpoint)
+        patterns.append((pattern, save_dir, shard_dir, pattern_checkpoint,
+                         done))
+        for index, file in enumerate(file_groups[pattern]):
+            if index in done:
+                continue
+            tasks.append((file_dir / file, data_columns, save_dir, cache,
+                          options,
+                          plot_selection(plots, index) and plot_service is None,
+                          (shard_name(shard_dir, index), index),
+                          pattern_checkpoint))
+    with multiprocessing.Pool(processes=workers, initializer=init_worker) as pool, \
+            WriteQueue(options.get('write_threads', 2), queue_size) as writes:
+        pipeline = OrderedPipeline(read_data, process_data_task, pool,
+                                   options.get('read_threads', 2), queue_size)
+        results = pipeline.run(tasks)
+        try:
+            for pattern, save_dir, shard_dir, pattern_checkpoint, done in patterns:
+                merge = RunningMerge()
+                outputs = PatternOutputs(pattern, save_dir, options,
+                                         pattern_checkpoint is not None)
+                for index in range(len(file_groups[pattern])):
+                    # the plots and csv files of the files done before are
+                    # written again, they are written after the checkpoint
+                    if index in done:
+                        a_group = pattern_checkpoint.load_file(index)
+                    else:
+                        _, (a_group, timing_rows) = next(results)
+                        TIMER.extend(timing_rows)
+                    if plot_service is not None and plot_selection(plots, index):
+                        plot_service.submit(a_group, save_dir)
+                    if saves_csv(options):
+                        writes.submit(save_e_nmu, a_group, save_dir)
+                    add_to_merge(merge, a_group)
+                    outputs.add_group(a_group, shard_name(shard_dir, index))
+                finish_pattern(pattern, save_dir, shard_dir, cache, options,
+                               plot_service, merge, outputs, checkpoint,
+                               file_groups[pattern])
+        finally:
+            results.close()
+
+ #######################################################
+# |     Checkpoints, to continue a run which stopped  | #
+# V              (see xas_checkpoint.py)              V #
+ #######################################################
+
+# get the checkpoint of the run from the options, with the settings which
+# change the results
+def get_checkpoint(options, file_dir, data_columns):
+    if not options['checkpoint']:
+        return None
+    settings = {'data_columns': data_columns, 'autobk': AUTOBK_PARAMS,
+                'xftf': XFTF_PARAMS, 'fast_load': options['fast_load'],
+                'output_format': options['output_format'],
+                'plots': options['plots']}
+    return Checkpoint(file_dir / 'result', settings)
+
+# check if a pattern was finished by an earlier run
+def pattern_done(checkpoint, pattern, files, save_dir):
+    if checkpoint is None:
+        return False
+    project_name = save_dir / (pattern[1:][:-1] + '.prj')
+    if not checkpoint.pattern_done(pattern, files, project_name):
+        return False
+    log_message = "Pattern " + pattern[1:][:-1] + " already done"
+    logging.info(log_message)
+    return True
+
+# the checkpoint of a pattern and the indexes of its files already done
+def get_pattern_checkpoint(checkpoint, pattern, file_dir, files):
+    if checkpoint is None:
+        return None, set()
+    done = checkpoint.files_done(pattern, file_dir, files)
+    if done:
+        log_message = "Pattern " + pattern[1:][:-1] + ": " + str(len(done)) + \
+            " of " + str(len(files)) + " files already done"
+        logging.info(log_message)
+    return checkpoint.for_pattern(pattern), done
+
+# directory of the athena shards of a pattern, kept in the checkpoint if
+# there is one
+def get_shard_dir(pattern, save_dir, pattern_checkpoint=None):
+    if pattern_checkpoint is not None:
+        return pattern_checkpoint.dir
+    return save_dir / (pattern[1:][:-1] + '_shards')
+
+# merge and athena project of a pattern whose groups were added from shards,
+# then the pattern is added to the checkpoint
+def finish_pattern(pattern, save_dir, shard_dir, cache, options, plot_service,
+                   merge, outputs, checkpoint=None, files=None):
+    if checkpoint is None:
+        shard_dir.rmdir()
+    process_pattern_groups(pattern, [], save_dir, cache, options,
+                           plot_service, merge, outputs)
+    if checkpoint is not None:
+        checkpoint.save_pattern(pattern, files)
+
+# options accepted by xas_read_files, with their type and default value
+OPTIONS = {
+    '--workers': (int, 1),
+    '--cache': (str, None),
+    '--cache-size': (float, None),
+    '--watch': (float, None),
+    '--fast-load': (bool, False),
+    '--output-format': (str, 'csv'),
+    '--plots': (str, 'all'),
+    '--plot-workers': (int, 0),
+    '--timing': (bool, False),
+    '--timing-memory': (bool, False),
+    '--profile': (bool, False),
+    '--pipeline': (bool, False),
+    '--read-threads': (int, 2),
+    '--write-threads': (int, 2),
+    '--queue-size': (int, 0),
+    '--distributed': (str, None),
+    '--unit-size': (int, 50),
+    '--retries': (int, 2),
+    '--unit-timeout': (float, 900.0),
+    '--checkpoint': (bool, False),
+}
+
+# values accepted by the --output-format option
+OUTPUT_FORMATS = ['csv', 'dataset', 'both']
+
+# get_options
+# remove the options (eg: '--workers 4' or '--workers=4') from the argument
+# list, options of type bool take no value (eg: '--fast-load')
+# output:
+#  - the remaining arguments
+#  - dictionary of option values, using the option name without '--' and
+#    with '-' replaced by '_' (eg: cache_size)
+def get_options(argv):
+    options = {}
+    for option, (_, default) in OPTIONS.items():
+        options[option[2:].replace('-', '_')] = default
+    other_args = []
+    arg_index = 0
+    while arg_index < len(argv):
+        option, _, value = argv[arg_index].partition('=')
+        if option in OPTIONS:
+            option_type = OPTIONS[option][0]
+            if option_type is bool:
+                options[option[2:].replace('-', '_')] = True
+                arg_index += 1
+                continue
+            if value == '':
+                arg_index += 1
+                value = argv[arg_index]
+            try:
+                options[option[2:].replace('-', '_')] = option_type(value)
+            except ValueError:
+                raise ValueError(option + " must be a " + option_type.__name__ +
+                                 ", not " + value)
+        else:
+            other_args.append(argv[arg_index])
+        arg_index += 1
+    options['workers'] = max(1, options['workers'])
+    if options['output_format'] not in OUTPUT_FORMATS:
+        raise ValueError("output format must be one of " + str(OUTPUT_FORMATS))
+    if options['plots'] not in ('all', 'merge', 'none') and \
+            not (options['plots'].isdigit() and int(options['plots']) > 0):
+        raise ValueError("plots must be all, merge, none or a number")
+    return other_args, options
+
+# get the results cache from the options
+def get_cache(options):
+    if options['cache'] is None:
+        return None
+    log_message = "Using results cache in " + options['cache']
+    logging.info(log_message)
+    if options['cache_size'] is None:
+        return ResultCache(options['cache'])
+    # size given in MB
+    return ResultCache(options['cache'],
+                       max_bytes=int(options['cache_size'] * 1024**2))
 
-            # plot and save each file in group 
-            basic_plot(xafsdat, save_dir)
+# xas_read_files
+# groups files in a directory according to common text patterns
+# process groups of files using larch with defaults:
+#   get mu (calculate if needed)
+#   get normal, pre-edge and post-edge E0
+#   plot groups
+#   merge groups
+#   plot merge
+#   save diagrams
+#   save all as athena project
+# options:
+#   --workers N      reduce files on a pool of N processes, the merge and
+#                    athena project of each pattern are done as soon as its
+#                    files are reduced
+#   --cache DIR      reuse autobk/xftf results saved in DIR
+#   --cache-size MB  maximum size of the cache
+#   --watch SECONDS  keep checking the directory and only process new or
+#                    changed files (see xas_watch.py)
+#   --fast-load      read only the data columns with numpy (see xas_loader.py)
+#                    instead of larch read_ascii
+#   --output-format  csv (one _EvNm.csv file per spectrum), dataset (one .npz
+#                    file per pattern, see xas_dataset.py) or both
+#   --plots MODE     all (default), merge (only merges), none, or a number N
+#                    to plot every Nth spectrum and the merges
+#   --plot-workers N render plots on N separate processes (see xas_plots.py)
+#   --timing         save the wall and cpu time of each stage and file in
+#                    log_dir/timing.csv and a summary in log_dir/timing.json
+#                    (see xas_timing.py)
+#   --timing-memory  also save the peak memory of each stage (slower)
+#   --profile        save a cProfile of the processing (main process) in
+#                    log_dir/processing.prof
+#   --pipeline       read the files on threads, reduce them on a pool of
+#                    --workers processes and write the csv files on threads,
+#                    all at the same time (see xas_io_pipeline.py)
+#   --read-threads N threads reading files in the pipeline (default 2)
+#   --write-threads N threads writing csv files in the pipeline (default 2)
+#   --queue-size N   files in the pipeline at once (default 4 per worker)
+#   --distributed HOST:PORT
+#                    split the files in units and process them on workers
+#                    started on other nodes with xas_distributed.py, the
+#                    merges and athena projects are put together here
+#   --unit-size N    largest number of files in a unit (default 50)
+#   --retries N      times a failed unit is sent again (default 2)
+#   --unit-timeout SECONDS
+#                    send a unit again if it is not done in this time
+#                    (default 900, 0 to wait for ever)
+#   --checkpoint     keep a journal of the files and patterns done with the
+#                    reduced groups in result/checkpoint, a run stopped part
+#                    way is continued from where it stopped by running it
+#                    again (see xas_checkpoint.py)
 
-            # save energy v normalised mu
-            save_e_nmu(xafsdat, save_dir)
-        # merge groups
-        merged_group = merge_groups(groups)
-        merged_group.label = pattern[1:][:-1] + "_merge"
-        autobk(merged_group, rbkg=1.0, kweight=2, _larch=my_larch)
-        xftf(merged_group, kmin=2, kmax=15, dk=3, kweight=2, _larch=my_larch)
-        # plot and save for merge
-        basic_plot(merged_group, save_dir)
-        # save energy v normalised mu for merge
-        save_e_nmu(merged_group, save_dir)
-        
-        groups.append(merged_group)
+def xas_read_files(argv):
+    try:
+        argv, options = get_options(argv)
+        # required
+        file_path = argv[0]
+        name_pattern = argv[1]
+        if len(argv) == 3:
+            if argv[2] == 'T':
+                group_files = True
+        else:
+            group_files = False
+            
+    except ValueError as error:
+        # invalid option value
+        print(error)
+        return
+    except:
+        print("missing arguments"+
+              "\n -string files path (eg: ../documents/ascii_path)"+
+              "\n -string file pattern (eg: *experiment_FeO2_sample*)"+
+              "\n -character T or F to indicate if grouping"+
+              "\n optional:"+
+              "\n --workers N number of processes for reducing files"+
+              "\n --cache DIR directory for reusing processing results"+
+              "\n --cache-size MB maximum size of the cache"+
+              "\n --watch SECONDS check for new files every SECONDS"+
+              "\n --fast-load read only the data columns with numpy"+
+              "\n --output-format csv, dataset or both"+
+              "\n --plots all, merge, none or N for every Nth spectrum"+
+              "\n --plot-workers N number of processes for plots"+
+              "\n --timing save the time of each stage in log_dir"+
+              "\n --timing-memory also save the peak memory of each stage"+
+              "\n --profile save a cProfile of the processing in log_dir"+
+              "\n --pipeline read, reduce and write files at the same time"+
+              "\n --read-threads N threads reading files in the pipeline"+
+              "\n --write-threads N threads writing files in the pipeline"+
+              "\n --queue-size N files in the pipeline at once"+
+              "\n --distributed HOST:PORT process the files on workers started with xas_distributed.py"+
+              "\n --unit-size N files in each unit of work"+
+              "\n --retries N times a failed unit is sent again"+
+              "\n --unit-timeout SECONDS send a unit again after SECONDS"+
+              "\n --checkpoint save the work done to continue a stopped run")
+        return
+    
+    file_dir= Path(file_path)
+    # initialisation file
+    data_columns = read_data_columns(file_dir)
+      
+    file_groups = get_file_groups(file_dir, name_pattern, group_files)
+    cache = get_cache(options)
+
+    if options['watch'] is not None:
+        # the watch uses the processing functions in this module
+        from xas_watch import watch_directory
+        watch_directory(file_dir, name_pattern, group_files, data_columns,
+                        options['watch'], cache, sys.modules[__name__],
+                        options)
+        return
 
-        log_message = "Processed groups (including merge): " + str(len(groups)) + " for pattern " + (pattern[1:][:-1])
+    plot_service = get_plot_service(options)
+    if options['timing'] or options['timing_memory']:
+        options['timing'] = True
+        TIMER.enable(options['timing_memory'])
+    checkpoint = None
+    if options['distributed'] is None:
+        checkpoint = get_checkpoint(options, file_dir, data_columns)
+    elif options['checkpoint']:
+        log_message = "--checkpoint is not used with --distributed"
         logging.info(log_message)
-        
-        # save as an athena project
-
-        project_name = save_dir / (pattern[1:][:-1] + '.prj')
-        athena_project = create_athena(project_name)
-        for a_group in groups:
-            athena_project.add_group(a_group)
-        athena_project.save()
-        log_message = "Saved athena project " + str(project_name)
+    profiler = None
+    if options['profile']:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        if options['distributed'] is not None:
+            # the workers use the processing functions in this module
+            from xas_distributed import Coordinator, parse_address
+            coordinator = Coordinator(parse_address(options['distributed']),
+                                      sys.modules[__name__],
+                                      options['unit_size'], options['retries'],
+                                      options['unit_timeout'] or None)
+            coordinator.run(file_dir, file_groups, data_columns, cache,
+                            options, plot_service)
+        elif options['pipeline']:
+            xas_read_files_pipeline(file_dir, file_groups, data_columns,
+                                    options['workers'], cache, options,
+                                    plot_service, checkpoint)
+        elif options['workers'] > 1:
+            xas_read_files_pool(file_dir, file_groups, data_columns,
+                                options['workers'], cache, options,
+                                plot_service, checkpoint)
+        else:
+            xas_read_files_serial(file_dir, file_groups, data_columns, cache,
+                                  options, plot_service, checkpoint)
+    finally:
+        if plot_service is not None:
+            plot_service.close()
+        save_timing(options, profiler)
+
+# save_timing
+# write the timing report and the profile next to log_dir/processing.log
+def save_timing(options, profiler=None):
+    if profiler is not None:
+        profiler.disable()
+        profile_name = LOG_DIR / 'processing.prof'
+        profiler.dump_stats(str(profile_name))
+        log_message = "Saved profile " + str(profile_name) + \
+            " (python -m pstats " + str(profile_name) + ")"
+        logging.info(log_message)
+    if options.get('timing'):
+        csv_name, json_name = TIMER.write_report(LOG_DIR)
+        for name, totals in sorted(TIMER.summary().items(),
+                                   key=lambda item: -item[1]['wall']):
+            log_message = "timing %-12s %6d calls %9.3f s wall %9.3f s cpu" % \
+                (name, totals['count'], totals['wall'], totals['cpu'])
+            logging.info(log_message)
+        log_message = "Saved timing " + str(csv_name) + " and " + \
+            str(json_name)
+        logging.info(log_message)
+
+# xas_read_files_serial
+# process the files of each pattern one after the other
+# with a checkpoint, the athena record of each file is written to a shard
+# which is kept with the record of the group until the pattern is done
+def xas_read_files_serial(file_dir, file_groups, data_columns, cache=None,
+                          options=None, plot_service=None, checkpoint=None):
+    plots = (options or {}).get('plots', 'all')
+    # process file groups
+    for pattern in file_groups:
+        save_dir = file_dir / 'result' / pattern[1:][:-1]
+        if pattern_done(checkpoint, pattern, file_groups[pattern], save_dir):
+            continue
+        pattern_checkpoint, done = get_pattern_checkpoint(
+            checkpoint, pattern, file_dir, file_groups[pattern])
+        # the merge and outputs are updated as each file is processed
+        merge = RunningMerge()
+        outputs = PatternOutputs(pattern, save_dir, options,
+                                 checkpoint is not None)
+        for index, file in enumerate(file_groups[pattern]):
+            file_path = file_dir / file
+            shard = None
+            if index in done:
+                xafsdat = pattern_checkpoint.load_file(index)
+                shard = pattern_checkpoint.shard_name(index)
+                # plots still queued in the plot service when the run stopped
+                # may be lost, they are rendered again
+                if plot_service is not None and plot_selection(plots, index):
+                    plot_service.submit(xafsdat, save_dir)
+            else:
+                xafsdat = process_file(file_path, data_columns, save_dir,
+                                       cache, options,
+                                       plot_selection(plots, index),
+                                       plot_service)
+                if pattern_checkpoint is not None:
+                    shard = pattern_checkpoint.shard_name(index)
+                    with stage('athena_shard', xafsdat.label):
+                        write_athena_shard(shard, [xafsdat], index)
+                    with stage('checkpoint', xafsdat.label):
+                        pattern_checkpoint.save_file(index, file_path, xafsdat)
+            add_to_merge(merge, xafsdat)
+            outputs.add_group(xafsdat, shard)
+        process_pattern_groups(pattern, [], save_dir, cache, options,
+                               plot_service, merge, outputs)
+        if checkpoint is not None:
+            checkpoint.save_pattern(pattern, file_groups[pattern])
+
+# xas_read_files_pool
+# same processing as the serial loop but the files are reduced by a process
+# pool, results come back in file order so the merges and athena projects are
+# the same as in a serial run. The workers also write the athena record of
+# each group (shards), so the project of a pattern is put together by copying
+# the shards
+# the files of a pattern are sent with imap and each result is added to the
+# merge and outputs as it comes back, so the records of a pattern are not all
+# kept. The next pattern is sent before the current one is finished, so the
+# pool keeps working while its merge and project are written, with at most
+# two patterns in flight
+# with a plot service the workers do not plot, the selected groups are sent
+# to the plot service as they come back
+# with a checkpoint, the workers save the record of each file and only the
+# files not done before are sent to the pool
+def xas_read_files_pool(file_dir, file_groups, data_columns, workers,
+                        cache=None, options=None, plot_service=None,
+                        checkpoint=None):
+    plots = (options or {}).get('plots', 'all')
+    log_message = "Reducing files with " + str(workers) + " workers"
+    logging.info(log_message)
+    with multiprocessing.Pool(processes=workers, initializer=init_worker) as pool:
+        submitted = (submit_pool_pattern(pool, file_dir, pattern,
+                                         file_groups[pattern], data_columns,
+                                         cache, options, plot_service,
+                                         checkpoint)
+                     for pattern in file_groups)
+        submitted = (item for item in submitted if item is not None)
+        current = next(submitted, None)
+        while current is not None:
+            following = next(submitted, None)
+            pattern, save_dir, shard_dir, pattern_checkpoint, done, \
+                results = current
+            merge = RunningMerge()
+            outputs = PatternOutputs(pattern, save_dir, options,
+                                     pattern_checkpoint is not None)
+            for index in range(len(file_groups[pattern])):
+                if index in done:
+                    a_group = pattern_checkpoint.load_file(index)
+                else:
+                    a_group, timing_rows = next(results)
+                    TIMER.extend(timing_rows)
+                if plot_service is not None and plot_selection(plots, index):
+                    plot_service.submit(a_group, save_dir)
+                # the athena records were written by the workers
+                add_to_merge(merge, a_group)
+                outputs.add_group(a_group, shard_name(shard_dir, index))
+            finish_pattern(pattern, save_dir, shard_dir, cache, options,
+                           plot_service, merge, outputs, checkpoint,
+                           file_groups[pattern])
+            current = following
+
+# submit_pool_pattern
+# send the files of a pattern not done before to the pool
+# output:
+#   - pattern, save dir, shard dir, pattern checkpoint, indexes of the files
+#     done before and the iterator of the results (imap, in file order), or
+#     None if the pattern was finished before
+def submit_pool_pattern(pool, file_dir, pattern, files, data_columns,
+                        cache=None, options=None, plot_service=None,
+                        checkpoint=None):
+    plots = (options or {}).get('plots', 'all')
+    save_dir = file_dir / 'result' / pattern[1:][:-1]
+    if pattern_done(checkpoint, pattern, files, save_dir):
+        return None
+    pattern_checkpoint, done = get_pattern_checkpoint(checkpoint, pattern,
+                                                      file_dir, files)
+    shard_dir = get_shard_dir(pattern, save_dir, pattern_checkpoint)
+    tasks = [(file_dir / files[index], data_columns, save_dir, cache, options,
+              plot_selection(plots, index) and plot_service is None,
+              (shard_name(shard_dir, index), index), pattern_checkpoint)
+             for index in range(len(files)) if index not in done]
+    return (pattern, save_dir, shard_dir, pattern_checkpoint, done,
+            pool.imap(process_file_task, tasks))
     
 
 if __name__ == "__main__":
    xas_read_files(sys.argv[1:])
-
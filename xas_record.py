@@ -0,0 +1,185 @@
+# compact record of a processed spectrum
+# a larch group keeps each array as a separate object in its own dictionary,
+# with the interpreter attributes of the group. Bulk runs keep (or send
+# between processes) tens of thousands of spectra, so a spectrum is kept as a
+# record with fixed fields (__slots__, no dictionary) where the columns of
+# each axis are rows of one contiguous 2D buffer:
+#
+#   energy axis: energy, time, i0, it, ir, mu, mue, bkg, pre_edge, ...
+#   k axis:      k, chi, kwin
+#   r axis:      r, chir_mag, chir_re, chir_im
+#
+# the columns are read as attributes (record.mu is a view of a row of the
+# buffer), so the merge, the dataset writer and the plots use records as
+# groups. Larch groups are only made when calling larch functions:
+#
+#   record = SpectrumRecord.from_group(xafsdat)
+#   record.norm                      # view into record.energy_data
+#   xafs_group = record.to_group()   # larch group with views of the columns
+#   save_record(record, 'checkpoint/12.npz')   # see xas_checkpoint.py
+
+import os
+import json
+from pathlib import Path
+
+import numpy as np
+
+import larch
+
+# columns of each axis, in the order of the rows of the buffer
+RECORD_AXES = {
+    'energy': ('energy', 'time', 'i0', 'it', 'ir', 'mu', 'mue', 'bkg',
+               'pre_edge', 'post_edge', 'norm', 'flat', 'dmude'),
+    'k': ('k', 'chi', 'kwin'),
+    'r': ('r', 'chir_mag', 'chir_re', 'chir_im'),
+}
+
+# values and text of each spectrum
+RECORD_VALUES = ('e0', 'edge_step')
+RECORD_TEXT = ('path', 'filename', 'label')
+
+# layouts by the columns present, shared by all the records with the same
+# columns
+_layouts = {}
+
+class RecordLayout:
+    # the columns present in a record and the row of each column
+    # input:
+    #  - tuple with the names of the columns present for each axis (in the
+    #    order of RECORD_AXES)
+    def __init__(self, key):
+        self.key = key
+        self.rows = {}
+        for axis, names in zip(RECORD_AXES, key):
+            for row, name in enumerate(names):
+                self.rows[name] = (axis, row)
+
+    # records sent to other processes use the layout of that process
+    def __reduce__(self):
+        return (get_layout, (self.key,))
+
+def get_layout(key):
+    if key not in _layouts:
+        _layouts[key] = RecordLayout(key)
+    return _layouts[key]
+
+class SpectrumRecord:
+    __slots__ = RECORD_TEXT + RECORD_VALUES + \
+        ('layout',) + tuple(axis + '_data' for axis in RECORD_AXES)
+
+    # SpectrumRecord.from_group makes a record from a larch group
+    # input:
+    #  - the layout of the columns
+    #  - 2D buffer of each axis (by axis name)
+    #  - values and text of the spectrum (e0, label, ...)
+    def __init__(self, layout, buffers, **values):
+        self.layout = layout
+        for axis in RECORD_AXES:
+            setattr(self, axis + '_data', buffers[axis])
+        for name, value in values.items():
+            setattr(self, name, value)
+
+    # make a record from a larch group, the columns of each axis are copied
+    # to the buffer of the axis
+    @classmethod
+    def from_group(cls, xafs_group):
+        key = []
+        buffers = {}
+        for axis, names in RECORD_AXES.items():
+            # the first column of an axis gives its length
+            first = np.asarray(getattr(xafs_group, names[0], np.zeros(0)))
+            present = tuple(name for name in names
+                            if np.ndim(getattr(xafs_group, name, None)) == 1
+                            and len(getattr(xafs_group, name)) == len(first))
+            if len(first) == 0:
+                present = ()
+            buffer = np.empty((len(present), len(first)))
+            for row, name in enumerate(present):
+                buffer[row] = getattr(xafs_group, name)
+            key.append(present)
+            buffers[axis] = buffer
+        values = {name: getattr(xafs_group, name)
+                  for name in RECORD_VALUES + RECORD_TEXT
+                  if hasattr(xafs_group, name)}
+        return cls(get_layout(tuple(key)), buffers, **values)
+
+    # larch group with the values and views of the columns of the record
+    def to_group(self):
+        xafs_group = larch.Group()
+        for name in RECORD_TEXT + RECORD_VALUES:
+            if hasattr(self, name):
+                setattr(xafs_group, name, getattr(self, name))
+        for name in self.layout.rows:
+            setattr(xafs_group, name, getattr(self, name))
+        return xafs_group
+
+    # names of the columns present
+    def columns(self):
+        return list(self.layout.rows)
+
+    # bytes of the buffers
+    @property
+    def nbytes(self):
+        return sum(getattr(self, axis + '_data').nbytes
+                   for axis in RECORD_AXES)
+
+    # slots are pickled without a dictionary
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__
+                if hasattr(self, name)}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+# column of a record as an attribute, missing columns raise AttributeError so
+# hasattr and getattr with a default work as with larch groups
+def column_property(name):
+    def get_column(record):
+        position = record.layout.rows.get(name)
+        if position is None:
+            raise AttributeError(name)
+        axis, row = position
+        return getattr(record, axis + '_data')[row]
+    return property(get_column)
+
+for _axis_names in RECORD_AXES.values():
+    for _name in _axis_names:
+        setattr(SpectrumRecord, _name, column_property(_name))
+
+# make records from larch groups (or keep records as they are)
+def as_record(xafs_group):
+    if isinstance(xafs_group, SpectrumRecord):
+        return xafs_group
+    return SpectrumRecord.from_group(xafs_group)
+
+# make a larch group from a record (or keep groups as they are)
+def as_group(xafs_group):
+    if isinstance(xafs_group, SpectrumRecord):
+        return xafs_group.to_group()
+    return xafs_group
+
+# save_record
+# save a record in a .npz file, written to a temporary file which is renamed
+# when it is complete, so the file is either complete or missing
+def save_record(record, file_name):
+    file_name = Path(file_name)
+    temp_name = file_name.with_name(file_name.name + '.tmp')
+    values = {name: getattr(record, name)
+              for name in RECORD_VALUES + RECORD_TEXT if hasattr(record, name)}
+    buffers = {axis + '_data': getattr(record, axis + '_data')
+               for axis in RECORD_AXES}
+    with open(temp_name, 'wb') as npz_file:
+        np.savez(npz_file, layout=json.dumps(record.layout.key),
+                 values=json.dumps(values, default=float), **buffers)
+        npz_file.flush()
+        os.fsync(npz_file.fileno())
+    os.replace(temp_name, file_name)
+
+# load a record saved with save_record
+def load_record(file_name):
+    with np.load(file_name) as data:
+        key = tuple(tuple(names) for names in json.loads(str(data['layout'])))
+        values = json.loads(str(data['values']))
+        buffers = {axis: data[axis + '_data'] for axis in RECORD_AXES}
+    return SpectrumRecord(get_layout(key), buffers, **values)
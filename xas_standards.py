@@ -0,0 +1,212 @@
+# library of normalised reference spectra (standards)
+# the standards used for fitting and comparison (Au foil, Au3Cl aq, ...) are
+# usually extracted from an athena project and normalised every time they are
+# used. The library keeps them already normalised and flattened, interpolated
+# onto one energy grid for each element and edge, so they are loaded as ready
+# arrays.
+#
+# the library is a directory with:
+#  - index.json: the element, edge, grid (first, last, step) and standards
+#    (label, e0, edge step, source) of each edge
+#  - <element>_<edge>.npz: energy grid and norm and flat of the standards
+#
+#   library = StandardsLibrary('XAFSExamples/standards')
+#   library.add_group(au_foil, 'hqlr', label='Au Foil')
+#   library.save()
+#   energy, flat = library.arrays('Au', 'L3')      # (n_points), (n_standards, n_points)
+#   standards = library.groups('Au', 'L3', ['hqlr', 'tscd'])   # for LCF
+
+import os
+import json
+import logging
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+import larch
+from larch.xafs import pre_edge
+from larch.io import extract_athenagroup
+from larch.xray import guess_edge
+
+# arrays kept for each standard
+LIBRARY_ARRAYS = ['norm', 'flat']
+
+# default grid around e0: from e0 + GRID_EMIN to e0 + GRID_EMAX in GRID_STEP
+GRID_EMIN = -100.0
+GRID_EMAX = 300.0
+GRID_STEP = 0.25
+
+INDEX_FILE = 'index.json'
+
+# name used for an edge in the index and file names, eg: Au_L3
+def edge_name(element, edge):
+    return element + '_' + edge
+
+class StandardsLibrary:
+    # input:
+    #  - directory of the library, created when saved
+    def __init__(self, library_dir):
+        self.library_dir = Path(library_dir)
+        self.index = {}
+        index_file = self.library_dir / INDEX_FILE
+        if index_file.exists():
+            with open(index_file) as index_json:
+                self.index = json.load(index_json)
+        # arrays of each edge, loaded when first used
+        self.edge_arrays = {}
+        # edges changed since they were saved
+        self.changed = set()
+
+    def edges(self):
+        return [(entry['element'], entry['edge'])
+                for entry in self.index.values()]
+
+    def has(self, element, edge, name=None):
+        entry = self.index.get(edge_name(element, edge))
+        if entry is None:
+            return False
+        return name is None or name in entry['names']
+
+    # names of the standards of an edge
+    def names(self, element, edge):
+        return list(self.index[edge_name(element, edge)]['names'])
+
+    # load the arrays of an edge
+    # output:
+    #  - dictionary with energy and an array (n_standards, n_points) for each
+    #    of LIBRARY_ARRAYS
+    def load(self, element, edge):
+        key = edge_name(element, edge)
+        if key not in self.edge_arrays:
+            if key not in self.index:
+                raise KeyError("no standards for " + key)
+            with np.load(self.library_dir / self.index[key]['file']) as arrays:
+                self.edge_arrays[key] = {name: arrays[name]
+                                         for name in arrays.files}
+        return self.edge_arrays[key]
+
+    # energy grid and arrays of some (default all) standards of an edge
+    # output:
+    #  - energy (n_points) and array (n_standards, n_points)
+    def arrays(self, element, edge, names=None, arrayname='flat'):
+        arrays = self.load(element, edge)
+        values = arrays[arrayname]
+        if names is not None:
+            all_names = self.names(element, edge)
+            values = values[[all_names.index(name) for name in names]]
+        return arrays['energy'], values
+
+    # standards as larch groups with energy, norm and flat, eg: for
+    # lincombo_fit or xas_lcf
+    def groups(self, element, edge, names=None):
+        entry = self.index[edge_name(element, edge)]
+        if names is None:
+            names = entry['names']
+        arrays = self.load(element, edge)
+        groups = []
+        for name in names:
+            position = entry['names'].index(name)
+            info = entry['standards'][name]
+            a_group = larch.Group(energy=arrays['energy'], label=name,
+                                  filename=info['label'], e0=info['e0'],
+                                  edge_step=info['edge_step'])
+            for arrayname in LIBRARY_ARRAYS:
+                setattr(a_group, arrayname, arrays[arrayname][position])
+            groups.append(a_group)
+        return groups
+
+    def group(self, element, edge, name):
+        return self.groups(element, edge, [name])[0]
+
+    # add a standard to the library
+    # input:
+    #  - larch group with energy and mu (normalised with pre_edge if it has no
+    #    flat)
+    #  - name of the standard in the library, eg: athena group name
+    #  - label of the standard, eg: "Au Foil"
+    #  - element and edge, guessed from e0 if not given
+    #  - source of the data, eg: project file
+    def add_group(self, xafs_group, name, label=None, element=None,
+                  edge=None, source=None):
+        if not hasattr(xafs_group, 'flat'):
+            pre_edge(xafs_group)
+        if element is None or edge is None:
+            element, edge = guess_edge(xafs_group.e0)
+        key = edge_name(element, edge)
+        if key not in self.index:
+            energy = np.arange(xafs_group.e0 + GRID_EMIN,
+                               xafs_group.e0 + GRID_EMAX + GRID_STEP / 2,
+                               GRID_STEP)
+            self.index[key] = {'element': element, 'edge': edge,
+                               'file': key + '.npz',
+                               'grid': [float(energy[0]), float(energy[-1]),
+                                        GRID_STEP],
+                               'names': [],
+                               'standards': {}}
+            self.edge_arrays[key] = {'energy': energy}
+            for arrayname in LIBRARY_ARRAYS:
+                self.edge_arrays[key][arrayname] = np.empty((0, len(energy)))
+        entry = self.index[key]
+        arrays = self.load(element, edge)
+        # values outside the measured range are the first or last value, the
+        # flattened spectrum is close to 0 before and 1 after the edge
+        new_values = {arrayname: np.interp(arrays['energy'],
+                                           xafs_group.energy,
+                                           getattr(xafs_group, arrayname))
+                      for arrayname in LIBRARY_ARRAYS}
+        if name in entry['names']:
+            position = entry['names'].index(name)
+            for arrayname in LIBRARY_ARRAYS:
+                arrays[arrayname][position] = new_values[arrayname]
+        else:
+            entry['names'].append(name)
+            for arrayname in LIBRARY_ARRAYS:
+                arrays[arrayname] = np.vstack([arrays[arrayname],
+                                               new_values[arrayname]])
+        entry['standards'][name] = {
+            'label': label if label is not None else name,
+            'e0': float(xafs_group.e0),
+            'edge_step': float(xafs_group.edge_step),
+            'emin': float(np.min(xafs_group.energy)),
+            'emax': float(np.max(xafs_group.energy)),
+            'source': str(source) if source is not None else None}
+        self.changed.add(key)
+        return element, edge
+
+    # add groups of an athena project (larch read_athena or
+    # xas_athena.read_athena_lazy)
+    # input:
+    #  - the project and the names of its groups to add
+    #  - labels of the groups, dictionary by name (optional)
+    #  - element and edge, guessed from e0 if not given
+    #  - function preparing each group, eg: calc_with_defaults
+    def add_project(self, athena_project, group_keys, labels=None,
+                    element=None, edge=None, process=None, source=None):
+        for group_key in group_keys:
+            a_group = extract_athenagroup(
+                athena_project._athena_groups[group_key])
+            if process is not None:
+                a_group = process(a_group)
+            label = (labels or {}).get(group_key, group_key)
+            self.add_group(a_group, group_key, label, element, edge, source)
+
+    # write the changed edges and the index
+    def save(self):
+        self.library_dir.mkdir(parents=True, exist_ok=True)
+        for key in sorted(self.changed):
+            # temporary file renamed when complete, as ResultCache.save
+            handle, temp_name = tempfile.mkstemp(dir=str(self.library_dir),
+                                                 suffix='.tmp')
+            with os.fdopen(handle, 'wb') as temp_file:
+                np.savez(temp_file, **self.edge_arrays[key])
+            os.replace(temp_name, self.library_dir / self.index[key]['file'])
+        handle, temp_name = tempfile.mkstemp(dir=str(self.library_dir),
+                                             suffix='.tmp')
+        with os.fdopen(handle, 'w') as index_json:
+            json.dump(self.index, index_json, indent=1)
+        os.replace(temp_name, self.library_dir / INDEX_FILE)
+        log_message = "Saved standards library " + str(self.library_dir) + \
+            " (" + ", ".join(sorted(self.changed)) + ")"
+        logging.info(log_message)
+        self.changed = set()
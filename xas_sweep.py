@@ -0,0 +1,251 @@
+# parameter sweeps of autobk and xftf
+# the effect of rbkg, kweight, kmin, kmax... is explored by running autobk and
+# xftf for every point of a grid of parameter values. The normalisation
+# (pre_edge) does not depend on these parameters, so it is done once for each
+# spectrum and e0 and the edge step are passed to autobk for every point. The
+# points with the same autobk parameters share the background removal, only
+# the fourier transform is done for each xftf parameter.
+#
+# the autobk runs are done on a process pool, each task runs autobk once and
+# xftf for all the xftf points of the grid.
+#
+#   grid = {'rbkg': np.linspace(0.5, 1.5, 50), 'xftf.kweight': [1, 2, 3]}
+#   result = parameter_sweep(fe_xafs, grid, workers=4,
+#                            xftf_params=XFTF_DEFAULTS)
+#   result.chir_mag[result.index(rbkg=1.0, kweight=2)]
+#   result.metric        # low R peak ratio of each point, shape of the grid
+
+import itertools
+import logging
+import multiprocessing
+
+import numpy as np
+
+import larch
+from larch.xafs import pre_edge, autobk, xftf
+
+from xas_pipeline import STAGES, STAGE_PARAMETERS
+
+# parameters which can be changed in a sweep
+SWEEP_STAGES = ['autobk', 'xftf']
+
+# low_r_peak
+# metric of a point: largest |chi(R)| below r_low (where the background
+# removal leaves spurious peaks) relative to the largest |chi(R)| between
+# r_low and r_max
+def low_r_peak(k, chi, r, chir_mag, r_low=1.0, r_max=6.0):
+    low = chir_mag[r < r_low]
+    high = chir_mag[(r >= r_low) & (r <= r_max)]
+    if len(low) == 0 or len(high) == 0 or np.max(high) == 0:
+        return np.nan
+    return np.max(low) / np.max(high)
+
+# parse_grid
+# find the stage of each parameter of the grid, names can be given with the
+# stage (eg: 'xftf.kweight') or alone if only used by one stage (eg: 'rbkg')
+# output:
+#  - list of (stage, name, values) with the autobk parameters first
+def parse_grid(grid):
+    axes = []
+    for full_name, values in grid.items():
+        stage, _, name = full_name.rpartition('.')
+        if stage == '':
+            stages = [a_stage for a_stage in STAGES
+                      if name in STAGE_PARAMETERS[a_stage]]
+            if len(stages) != 1:
+                raise ValueError("give the stage for parameter " + name +
+                                 " (eg: xftf." + name + ")")
+            stage = stages[0]
+        if stage not in SWEEP_STAGES:
+            raise ValueError("only autobk and xftf parameters can be swept")
+        # numpy values as python values
+        values = [value.item() if isinstance(value, np.generic) else value
+                  for value in values]
+        axes.append((stage, name, values))
+    # autobk axes first, keeping the order given for each stage
+    return [axis for stage in SWEEP_STAGES for axis in axes if axis[0] == stage]
+
+class SweepResult:
+    # results of a sweep for one spectrum
+    # input:
+    #  - the axes of the grid (list of (stage, name, values))
+    #  - k and r arrays
+    #  - chi and |chi(R)| arrays with the shape of the grid plus k or r
+    #  - metric for each point of the grid
+    def __init__(self, label, axes, k, r, chi, chir_mag, metric):
+        self.label = label
+        self.axes = axes
+        self.names = [name for _, name, _ in axes]
+        self.k = k
+        self.r = r
+        self.chi = chi
+        self.chir_mag = chir_mag
+        self.metric = metric
+
+    @property
+    def shape(self):
+        return tuple(len(values) for _, _, values in self.axes)
+
+    # index of a point of the grid from its parameter values
+    def index(self, **values):
+        index = []
+        for _, name, axis_values in self.axes:
+            if name not in values:
+                raise ValueError("missing value for " + name)
+            if values[name] in axis_values:
+                index.append(axis_values.index(values[name]))
+                continue
+            # closest value of a numeric axis
+            distance = np.abs(np.asarray(axis_values, dtype=float) -
+                              values[name])
+            index.append(int(np.argmin(distance)))
+        return tuple(index)
+
+    # parameter values of a point of the grid
+    def values(self, index):
+        return {name: axis_values[position]
+                for (_, name, axis_values), position in zip(self.axes, index)}
+
+    # point with the smallest metric
+    def best(self):
+        index = np.unravel_index(np.nanargmin(self.metric), self.metric.shape)
+        return self.values(index)
+
+    # one row per point with its parameters and metric, eg: for write_csv_data
+    def rows(self):
+        rows = {}
+        for row_id, index in enumerate(np.ndindex(*self.shape)):
+            row = {'id': row_id}
+            row.update(self.values(index))
+            row['metric'] = self.metric[index]
+            rows[row_id] = row
+        return rows
+
+    def save(self, file_name):
+        arrays = {'k': self.k, 'r': self.r, 'chi': self.chi,
+                  'chir_mag': self.chir_mag, 'metric': self.metric,
+                  'names': np.array([stage + '.' + name
+                                     for stage, name, _ in self.axes])}
+        for stage, name, values in self.axes:
+            arrays['axis_' + stage + '.' + name] = np.asarray(values)
+        with open(file_name, 'wb') as sweep_file:
+            np.savez(sweep_file, **arrays)
+
+ #######################################################
+# |      Sweep tasks, run on the pool or in process   | #
+# V                                                   V #
+ #######################################################
+
+# sweep_task
+# autobk with one set of parameters and xftf for each set of xftf parameters
+# input (as a single tuple):
+#  - index of the spectrum and of the autobk point
+#  - energy, mu, e0 and edge step of the spectrum
+#  - autobk parameters and list of xftf parameters
+#  - metric function and its arguments
+def sweep_task(task):
+    (spectrum_index, autobk_index, energy, mu, e0, edge_step, autobk_params,
+     xftf_points, metric, metric_args) = task
+    xafs_group = larch.Group(energy=energy, mu=mu)
+    autobk(xafs_group, e0=e0, edge_step=edge_step, **autobk_params)
+    chir_mags = []
+    metrics = []
+    for xftf_params in xftf_points:
+        xftf(xafs_group, **xftf_params)
+        chir_mags.append(np.asarray(xafs_group.chir_mag))
+        metrics.append(metric(xafs_group.k, xafs_group.chi, xafs_group.r,
+                              xafs_group.chir_mag, **metric_args))
+    return (spectrum_index, autobk_index, np.asarray(xafs_group.k),
+            np.asarray(xafs_group.chi), np.asarray(xafs_group.r), chir_mags,
+            metrics)
+
+# fill an array of the largest length with the arrays of each point, shorter
+# arrays (eg: different kmax) are padded with nan
+def stack_padded(shape, arrays):
+    length = max(len(values) for values in arrays)
+    stacked = np.full((len(arrays), length), np.nan)
+    for index, values in enumerate(arrays):
+        stacked[index, :len(values)] = values
+    return stacked.reshape(shape + (length,))
+
+# parameters of each point of the grid of a stage, in the order of the grid
+def grid_points(axes, params=None):
+    names = [name for _, name, _ in axes]
+    points = []
+    for values in itertools.product(*[values for _, _, values in axes]):
+        point = dict(params or {})
+        point.update(zip(names, values))
+        points.append(point)
+    return points
+
+# parameter_sweep
+# run autobk and xftf for all the points of a grid of parameters
+# input:
+#  - larch group with energy and mu, or a list of groups
+#  - dictionary of parameter names and values
+#  - number of processes, 1 to run in this process
+#  - parameters for pre_edge, autobk and xftf not in the grid
+#  - metric of each point, a function (k, chi, r, chir_mag, **metric_args)
+#    defined at module level so it can be sent to the pool
+# output:
+#  - SweepResult, or a list of them for a list of groups
+def parameter_sweep(xafs_groups, grid, workers=1, pre_edge_params=None,
+                    autobk_params=None, xftf_params=None, metric=low_r_peak,
+                    metric_args=None):
+    single = not isinstance(xafs_groups, (list, tuple))
+    if single:
+        xafs_groups = [xafs_groups]
+    axes = parse_grid(grid)
+    autobk_axes = [axis for axis in axes if axis[0] == 'autobk']
+    xftf_axes = [axis for axis in axes if axis[0] == 'xftf']
+    autobk_points = grid_points(autobk_axes, autobk_params)
+    xftf_points = grid_points(xftf_axes, xftf_params)
+
+    tasks = []
+    for spectrum_index, xafs_group in enumerate(xafs_groups):
+        # normalisation shared by all the points
+        normalised = larch.Group(energy=xafs_group.energy, mu=xafs_group.mu)
+        pre_edge(normalised, **(pre_edge_params or {}))
+        for autobk_index, point in enumerate(autobk_points):
+            tasks.append((spectrum_index, autobk_index,
+                          np.asarray(xafs_group.energy),
+                          np.asarray(xafs_group.mu), normalised.e0,
+                          normalised.edge_step, point, xftf_points, metric,
+                          metric_args or {}))
+    log_message = "Sweep of " + str(len(autobk_points) * len(xftf_points)) + \
+        " points for " + str(len(xafs_groups)) + " spectra"
+    logging.info(log_message)
+
+    if workers > 1:
+        with multiprocessing.Pool(processes=workers) as pool:
+            outputs = pool.map(sweep_task, tasks)
+    else:
+        outputs = [sweep_task(task) for task in tasks]
+
+    # outputs of each spectrum, in one pass over the outputs
+    outputs_by_spectrum = {}
+    for output in outputs:
+        outputs_by_spectrum.setdefault(output[0], []).append(output)
+
+    shape = tuple(len(values) for _, _, values in axes)
+    results = []
+    for spectrum_index, xafs_group in enumerate(xafs_groups):
+        spectrum_outputs = outputs_by_spectrum[spectrum_index]
+        spectrum_outputs.sort(key=lambda output: output[1])
+        chis = []
+        chir_mags = []
+        metrics = []
+        for output in spectrum_outputs:
+            chis.extend([output[3]] * len(xftf_points))
+            chir_mags.extend(output[5])
+            metrics.extend(output[6])
+        longest_k = max(spectrum_outputs, key=lambda output: len(output[2]))[2]
+        label = getattr(xafs_group, 'label', str(spectrum_index))
+        results.append(SweepResult(label, axes, longest_k,
+                                   spectrum_outputs[0][4],
+                                   stack_padded(shape, chis),
+                                   stack_padded(shape, chir_mags),
+                                   np.array(metrics).reshape(shape)))
+    if single:
+        return results[0]
+    return results
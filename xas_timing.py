@@ -0,0 +1,147 @@
+# timing of the processing stages
+# the time of each stage (reading a file, autobk, xftf, plots, csv files,
+# merge, athena project...) is recorded for each file with:
+#  - wall time (time.perf_counter)
+#  - cpu time of the thread running the stage (time.thread_time)
+#  - peak memory allocated during the stage over the memory used when it
+#    started (tracemalloc, numpy arrays included), only when memory tracing
+#    is on as it slows python down
+#
+# stages can be nested (eg: autobk and xftf inside reduce), the time of a
+# stage includes the stages inside it. Stages can run on several threads (eg:
+# the reader threads of xas_io_pipeline.py), the nesting is followed for each
+# thread but the peak memory is of the whole process. Nothing is recorded
+# unless the timer is enabled, so the instrumented code runs as before.
+#
+#   with stage('autobk', file_name):
+#       autobk(xafsdat)
+#   TIMER.write_report('log_dir')    # timing.csv and timing.json
+
+import os
+import json
+import time
+import threading
+import tracemalloc
+from pathlib import Path
+from contextlib import contextmanager
+
+from xas_csv import write_csv_data
+
+# columns of each row of the report
+TIMING_COLUMNS = ['stage', 'file', 'pid', 'wall', 'cpu', 'peak_memory']
+
+class StageTimer:
+    # input:
+    #  - True to record the stages
+    #  - True to record the peak memory of each stage
+    def __init__(self, enabled=False, memory=False):
+        self.enabled = enabled
+        self.memory = memory
+        self.rows = []
+        # memory at the start and peak memory of the stages running on each
+        # thread, innermost last
+        self._threads = threading.local()
+
+    def enable(self, memory=False):
+        self.enabled = True
+        self.memory = memory
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    # stages running on this thread
+    def peaks(self):
+        if not hasattr(self._threads, 'peaks'):
+            self._threads.peaks = []
+        return self._threads.peaks
+
+    # record a stage
+    # input:
+    #  - name of the stage
+    #  - file (or group label) processed, None for stages of a pattern
+    @contextmanager
+    def stage(self, name, file=None):
+        if not self.enabled:
+            yield
+            return
+        if self.memory:
+            # the peak of the stage is measured from its start, the stages
+            # around it keep the largest peak seen inside them
+            peaks = self.peaks()
+            current, peak = tracemalloc.get_traced_memory()
+            if peaks:
+                peaks[-1][1] = max(peaks[-1][1], peak)
+            tracemalloc.reset_peak()
+            peaks.append([current, current])
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = time.thread_time() - cpu_start
+            peak_memory = None
+            if self.memory:
+                start, peak = peaks.pop()
+                peak = max(peak, tracemalloc.get_traced_memory()[1])
+                # memory allocated by the stage over what was used before it
+                peak_memory = peak - start
+                if peaks:
+                    peaks[-1][1] = max(peaks[-1][1], peak)
+            self.rows.append({'stage': name,
+                              'file': '' if file is None else str(file),
+                              'pid': os.getpid(), 'wall': wall, 'cpu': cpu,
+                              'peak_memory': peak_memory})
+
+    # rows recorded by other processes (eg: the pool workers)
+    def extend(self, rows):
+        self.rows.extend(rows)
+
+    # remove and return the rows recorded, used by the workers to send the
+    # rows of each file back
+    def take_rows(self):
+        rows = self.rows
+        self.rows = []
+        return rows
+
+    # totals of each stage
+    # output:
+    #  - dictionary by stage with count, total and largest wall time, total
+    #    cpu time and largest peak memory
+    def summary(self):
+        stages = {}
+        for row in self.rows:
+            totals = stages.setdefault(row['stage'], {
+                'count': 0, 'wall': 0.0, 'wall_max': 0.0, 'cpu': 0.0,
+                'peak_memory': None})
+            totals['count'] += 1
+            totals['wall'] += row['wall']
+            totals['wall_max'] = max(totals['wall_max'], row['wall'])
+            totals['cpu'] += row['cpu']
+            if row['peak_memory'] is not None:
+                totals['peak_memory'] = max(totals['peak_memory'] or 0,
+                                            row['peak_memory'])
+        for totals in stages.values():
+            totals['wall_mean'] = totals['wall'] / totals['count']
+        return stages
+
+    # write the rows (timing.csv) and the summary (timing.json) in a
+    # directory, eg: next to log_dir/processing.log
+    def write_report(self, report_dir, name='timing'):
+        report_dir = Path(report_dir)
+        report_dir.mkdir(parents=True, exist_ok=True)
+        csv_rows = {index: {column: row[column] for column in TIMING_COLUMNS}
+                    for index, row in enumerate(self.rows)}
+        write_csv_data(csv_rows, report_dir / (name + '.csv'))
+        with open(report_dir / (name + '.json'), 'w') as json_file:
+            json.dump({'stages': self.summary(),
+                       'files': len(set(row['file'] for row in self.rows
+                                        if row['file'] != '')),
+                       'processes': len(set(row['pid'] for row in self.rows))},
+                      json_file, indent=1)
+        return report_dir / (name + '.csv'), report_dir / (name + '.json')
+
+# timer of this process, used by the processing modules
+TIMER = StageTimer()
+
+def stage(name, file=None):
+    return TIMER.stage(name, file)
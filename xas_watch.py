@@ -0,0 +1,460 @@
+# watch mode for bulk processing
+# during an experiment new files keep arriving in the data directory. Instead
+# of processing the whole directory again, the directory is checked every few
+# seconds and only new or changed files are processed.
+#
+# a manifest (result/manifest.json) keeps the modification time, size and
+# hash of the processed files, so the watch can be stopped and started again
+# without processing the same files twice. A new file is added to the
+# manifest once it is processed, files not in a group yet (eg: the first file
+# of a pattern) are kept until a later check puts them in one.
+#
+# the merge of each pattern is kept as a running average (see xas_merge.py)
+# which is updated with the new files, and only the new groups are added to
+# the athena project and dataset, so the time to process a new file does not
+# grow with the number of files already processed.
+#
+# the record of each processed file is saved (result/watch_records, see
+# xas_record.py), so when a pattern has to be built again (a file changed,
+# a file was added before the others or left the pattern) only the changed
+# files are processed, the others are taken from their records. The outputs
+# of a pattern left by a file are built again without it (its plot and csv
+# file are removed), and the outputs of a pattern without files are removed.
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+
+from xas_athena import write_athena_shard, append_athena_project
+from xas_dataset import DatasetWriter
+from xas_file_groups import group_file_names
+from xas_merge import RunningMerge
+from xas_plots import plot_selection
+from xas_record import as_group, as_record, save_record, load_record
+
+# name of the manifest file, saved in the result dir
+MANIFEST_NAME = 'manifest.json'
+
+# dir of the records of the processed files, in the result dir
+RECORDS_DIR = 'watch_records'
+
+# files modified less than this number of seconds ago may still be written
+SETTLE_TIME = 2.0
+
+# get the sha256 hash of a file
+def file_hash(file_path):
+    hasher = hashlib.sha256()
+    with open(file_path, 'rb') as data_file:
+        for chunk in iter(lambda: data_file.read(1024 * 1024), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+# read the manifest, empty if it does not exist
+def load_manifest(manifest_path):
+    if not manifest_path.exists():
+        return {}
+    with open(manifest_path) as manifest_file:
+        return json.load(manifest_file)
+
+# write the manifest to a temporary file and rename it, so an interrupted
+# write never leaves a broken manifest
+def save_manifest(manifest_path, manifest):
+    if not manifest_path.parent.exists():
+        manifest_path.parent.mkdir(parents=True)
+    temp_path = manifest_path.with_suffix('.tmp')
+    with open(temp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+    os.replace(temp_path, manifest_path)
+
+# WatchOutputs
+# athena project and dataset of a pattern growing with the new files. The
+# records of the new groups are appended to the project and their arrays to
+# the dataset, the merge is written after them and replaced at each update,
+# so an update only writes the new groups. The state (number of groups, end
+# of the records in the project) is saved so a new session continues them.
+class WatchOutputs:
+    # input:
+    #  - the pattern
+    #  - the destination dir of the pattern
+    #  - True to also write the dataset of the pattern
+    def __init__(self, pattern, save_dir, dataset=False):
+        name = pattern[1:][:-1]
+        self.project_name = save_dir / (name + '.prj')
+        self.state_path = save_dir / (name + '_watch.json')
+        self.shard_dir = save_dir / (name + '_shards')
+        self.dataset_name = save_dir / (name + '.npz')
+        self.dataset_dir = save_dir / (name + '_dataset')
+        self.with_dataset = dataset
+        self.dataset = None
+        # groups in the project (without the merge), end of their records
+        self.count = 0
+        self.offset = None
+        # shards of the groups added since the last write
+        self.shards = []
+
+    # continue the outputs saved by a previous session
+    # output:
+    #  - True if the saved outputs have the given number of groups
+    def resume(self, count):
+        if not self.state_path.exists() or not self.project_name.exists():
+            return False
+        with open(self.state_path) as state_file:
+            state = json.load(state_file)
+        if state['count'] != count or \
+                self.project_name.stat().st_size < state['offset']:
+            return False
+        if self.with_dataset:
+            self.dataset = DatasetWriter(self.dataset_name,
+                                         work_dir=self.dataset_dir)
+            if len(self.dataset) != count:
+                self.close_dataset()
+                return False
+        self.count = count
+        self.offset = state['offset']
+        return True
+
+    # start the outputs again from the first group
+    def reset(self):
+        self.count = 0
+        self.offset = None
+        self.shards = []
+        if self.shard_dir.exists():
+            shutil.rmtree(self.shard_dir)
+        if self.with_dataset:
+            self.close_dataset()
+            if self.dataset_dir.exists():
+                shutil.rmtree(self.dataset_dir)
+            self.dataset = DatasetWriter(self.dataset_name,
+                                         work_dir=self.dataset_dir)
+
+    # close the raw files of the dataset, the values written are kept in the
+    # dataset dir
+    def close_dataset(self):
+        if self.dataset is not None:
+            for temp_file in self.dataset.temp_files.values():
+                temp_file.close()
+            self.dataset = None
+
+    # add a processed group, its athena record is written to a shard until
+    # the next write
+    def add_group(self, xafs_group):
+        shard_name = self.shard_dir / (str(self.count) + '.gz')
+        write_athena_shard(shard_name, [xafs_group], self.count)
+        self.shards.append(shard_name)
+        if self.dataset is not None:
+            self.dataset.add_group(xafs_group)
+        self.count += 1
+
+    # write the new groups and the merge to the project and dataset
+    def write(self, merged_group):
+        self.offset = append_athena_project(self.project_name, self.offset,
+                                            self.shards, [merged_group],
+                                            self.count)
+        self.shards = []
+        if self.dataset is not None:
+            self.dataset.write([merged_group])
+        temp_path = self.state_path.with_suffix('.tmp')
+        with open(temp_path, 'w') as state_file:
+            json.dump({'count': self.count, 'offset': self.offset}, state_file)
+        os.replace(temp_path, self.state_path)
+
+class WatchSession:
+    # input:
+    #  - the directory with the data files
+    #  - the string which is used to filter the files to process
+    #  - True if the files are grouped by common patterns
+    #  - the data columns map
+    #  - the results cache (optional)
+    #  - the module with the processing functions (xas_read_files), passed
+    #    by xas_read_files so it is not imported again when run as a script
+    #  - the options given to xas_read_files
+    def __init__(self, file_dir, name_pattern, group_files, data_columns,
+                 cache=None, processing=None, options=None):
+        if processing is None:
+            import xas_read_files as processing
+        self.processing = processing
+        self.file_dir = file_dir
+        self.name_pattern = name_pattern
+        self.group_files = group_files
+        self.data_columns = data_columns
+        self.cache = cache
+        self.options = options or {}
+        self.manifest_path = file_dir / 'result' / MANIFEST_NAME
+        self.manifest = load_manifest(self.manifest_path)
+        # new or changed files not processed yet (eg: a first file which is
+        # not in a group until the next file arrives), they are added to the
+        # manifest once they are processed
+        self.pending = {}
+        # files, running merge and outputs of each pattern
+        self.pattern_files = {}
+        self.merges = {}
+        self.outputs = {}
+
+    def save_dir(self, pattern):
+        return self.file_dir / 'result' / pattern[1:][:-1]
+
+    def merge_state_path(self, pattern):
+        return self.save_dir(pattern) / (pattern[1:][:-1] + '_merge.npz')
+
+    def record_path(self, file_name):
+        return self.file_dir / 'result' / RECORDS_DIR / (file_name + '.npz')
+
+    # find the files which are new or changed since they were processed
+    # output:
+    #  - sorted list of the files ready to process (not being written)
+    #  - set of the file names which are new or changed
+    def scan(self):
+        now = time.time()
+        ready_files = []
+        changed_files = set()
+        for file_path in sorted(self.file_dir.glob(self.name_pattern)):
+            stat = file_path.stat()
+            if now - stat.st_mtime < SETTLE_TIME:
+                continue
+            ready_files.append(file_path.name)
+            entry = self.manifest.get(file_path.name)
+            if entry is not None and entry['mtime'] == stat.st_mtime and \
+                    entry['size'] == stat.st_size:
+                continue
+            pending = self.pending.get(file_path.name)
+            if pending is not None and pending['mtime'] == stat.st_mtime and \
+                    pending['size'] == stat.st_size:
+                changed_files.add(file_path.name)
+                continue
+            # the file was touched, only process it if its content changed
+            hash_value = file_hash(file_path)
+            if entry is not None and entry['sha256'] == hash_value:
+                entry['mtime'] = stat.st_mtime
+                self.pending.pop(file_path.name, None)
+                continue
+            self.pending[file_path.name] = {'mtime': stat.st_mtime,
+                                            'size': stat.st_size,
+                                            'sha256': hash_value}
+            changed_files.add(file_path.name)
+        return ready_files, changed_files
+
+    # save the record of a processed file
+    def save_file(self, file_name, xafsdat):
+        record_path = self.record_path(file_name)
+        if not record_path.parent.exists():
+            record_path.parent.mkdir(parents=True)
+        save_record(as_record(xafsdat), record_path)
+
+    # get a file processed before from its record, to build the merge and
+    # outputs of its pattern again. Files without a record (processed by an
+    # older session) are read and reduced again, the results come from the
+    # cache if one is used
+    def load_file(self, file_name):
+        record_path = self.record_path(file_name)
+        if record_path.exists():
+            return as_group(load_record(record_path))
+        xafsdat = self.processing.read_file(
+            self.file_dir / file_name, self.data_columns,
+            self.options.get('fast_load', False))
+        self.processing.reduce_group(xafsdat, self.cache)
+        xafsdat.label = xafsdat.filename[:-4]
+        self.save_file(file_name, xafsdat)
+        return xafsdat
+
+    # files of a pattern in the last update, from the manifest if the pattern
+    # was processed by a previous session
+    def previous_files(self, pattern):
+        if pattern in self.pattern_files:
+            return self.pattern_files[pattern]
+        return sorted(name for name, entry in self.manifest.items()
+                      if entry.get('pattern') == pattern)
+
+    # remove the plot and csv file of a file which left a pattern, and its
+    # manifest entry and record if the file was deleted
+    def remove_file(self, pattern, file_name):
+        label = file_name[:-4]
+        save_dir = self.save_dir(pattern)
+        for output_name in (label + '_01.jpg', label + '_EvNm.csv'):
+            if (save_dir / output_name).exists():
+                (save_dir / output_name).unlink()
+        if not (self.file_dir / file_name).exists():
+            self.manifest.pop(file_name, None)
+            self.pending.pop(file_name, None)
+            if self.record_path(file_name).exists():
+                self.record_path(file_name).unlink()
+
+    # remove the outputs of a pattern without files
+    def remove_pattern(self, pattern, previous_files):
+        for file_name in previous_files:
+            self.remove_file(pattern, file_name)
+        outputs = self.outputs.pop(pattern, None)
+        if outputs is not None:
+            outputs.close_dataset()
+        self.merges.pop(pattern, None)
+        self.pattern_files.pop(pattern, None)
+        if self.save_dir(pattern).exists():
+            shutil.rmtree(self.save_dir(pattern))
+        log_message = "Removed the outputs of pattern " + pattern[1:][:-1] + \
+            ", its files are no longer in it"
+        logging.info(log_message)
+
+    # get the running merge of a pattern, continuing the merge saved by a
+    # previous session if it has the same files
+    def get_merge(self, pattern, previous_files):
+        if pattern in self.merges:
+            return self.merges[pattern]
+        state_path = self.merge_state_path(pattern)
+        if previous_files and state_path.exists():
+            merge = RunningMerge.load(state_path)
+            if merge.count == len(previous_files):
+                return merge
+        return None
+
+    # get the outputs of a pattern, continuing the outputs saved by a
+    # previous session if they have the same files
+    def get_outputs(self, pattern, previous_files):
+        if pattern in self.outputs:
+            return self.outputs[pattern]
+        outputs = WatchOutputs(pattern, self.save_dir(pattern),
+                               self.processing.saves_dataset(self.options))
+        if previous_files and outputs.resume(len(previous_files)):
+            return outputs
+        return None
+
+    # check the directory once and process new or changed files
+    # output:
+    #  - number of files processed
+    def poll(self):
+        ready_files, changed_files = self.scan()
+        if len(ready_files) == 0:
+            return 0
+        if self.group_files:
+            file_groups = group_file_names(ready_files)
+        else:
+            file_groups = {'unique': ready_files}
+
+        # files of each pattern before this update, taken before the
+        # manifest is updated with the files which moved to another pattern
+        patterns = set(self.pattern_files).union(
+            entry['pattern'] for entry in self.manifest.values()
+            if 'pattern' in entry).union(file_groups)
+        previous = {pattern: self.previous_files(pattern)
+                    for pattern in patterns}
+        ready = set(ready_files)
+
+        processed = 0
+        updated = False
+        for pattern in sorted(patterns):
+            files = file_groups.get(pattern, [])
+            previous_files = previous[pattern]
+            # files still being written are not left by their pattern, it
+            # is updated once they are ready
+            if any(name not in ready and (self.file_dir / name).exists()
+                   for name in previous_files):
+                continue
+            if len(files) == 0:
+                self.remove_pattern(pattern, previous_files)
+                updated = True
+                continue
+            if files == previous_files and not changed_files.intersection(files):
+                continue
+            processed += self.update_pattern(pattern, files, previous_files,
+                                             changed_files)
+            updated = True
+        if updated:
+            save_manifest(self.manifest_path, self.manifest)
+        return processed
+
+    # process the new files of a pattern and update its merge and outputs
+    # output:
+    #  - number of files processed
+    def update_pattern(self, pattern, files, previous_files, changed_files):
+        save_dir = self.save_dir(pattern)
+        if not save_dir.exists():
+            save_dir.mkdir(parents=True)
+        merge = self.get_merge(pattern, previous_files)
+        outputs = self.get_outputs(pattern, previous_files)
+        # the merge and outputs can only be continued if the files are
+        # appended at the end, otherwise (changed files, new first file, file
+        # which left the pattern) build them again from the records of the
+        # files which did not change
+        appended = files[:len(previous_files)] == previous_files and \
+            not changed_files.intersection(previous_files)
+        if merge is None or outputs is None or not appended:
+            merge = RunningMerge()
+            if outputs is None:
+                outputs = WatchOutputs(pattern, save_dir,
+                                       self.processing.saves_dataset(self.options))
+            outputs.reset()
+            first_index = 0
+        else:
+            first_index = len(previous_files)
+
+        for file_name in set(previous_files).difference(files):
+            self.remove_file(pattern, file_name)
+
+        plots = self.options.get('plots', 'all')
+        new_files = 0
+        for index in range(first_index, len(files)):
+            file_name = files[index]
+            if file_name in changed_files:
+                xafsdat = self.processing.process_file(
+                    self.file_dir / file_name, self.data_columns, save_dir,
+                    self.cache, self.options, plot_selection(plots, index))
+                self.save_file(file_name, xafsdat)
+                entry = self.pending.pop(file_name)
+                entry['pattern'] = pattern
+                self.manifest[file_name] = entry
+                new_files += 1
+            else:
+                xafsdat = self.load_file(file_name)
+                # a file which moved from another pattern, its plot and csv
+                # file are written in the dir of this pattern
+                if self.manifest[file_name].get('pattern') != pattern:
+                    if plot_selection(plots, index):
+                        self.processing.plot_group(xafsdat, save_dir)
+                    if self.processing.saves_csv(self.options):
+                        self.processing.save_e_nmu(xafsdat, save_dir)
+                    self.manifest[file_name]['pattern'] = pattern
+            merge.add(xafsdat)
+            outputs.add_group(xafsdat)
+        self.merges[pattern] = merge
+        self.outputs[pattern] = outputs
+        self.pattern_files[pattern] = list(files)
+
+        merge.save(self.merge_state_path(pattern))
+        merged_group = self.processing.process_merge(merge.result(), pattern,
+                                                     save_dir, self.cache,
+                                                     self.options)
+        outputs.write(merged_group)
+
+        log_message = "Updated pattern " + pattern[1:][:-1] + " with " + \
+            str(new_files) + " new files, " + str(len(files)) + \
+            " files in merge"
+        logging.info(log_message)
+        return new_files
+
+# watch_directory
+# process new files in a directory until stopped (Ctrl+C)
+# input:
+#  - the directory with the data files
+#  - the string which is used to filter the files to process
+#  - True if the files are grouped by common patterns
+#  - the data columns map
+#  - seconds between checks of the directory
+#  - the results cache (optional)
+#  - the module with the processing functions
+#  - the options given to xas_read_files
+def watch_directory(file_dir, name_pattern, group_files, data_columns,
+                    interval, cache=None, processing=None, options=None):
+    session = WatchSession(file_dir, name_pattern, group_files, data_columns,
+                           cache, processing, options)
+    log_message = "Watching " + str(file_dir) + " every " + str(interval) + \
+        " seconds, " + str(len(session.manifest)) + " files already processed"
+    logging.info(log_message)
+    try:
+        while True:
+            session.poll()
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        log_message = "Stopped watching " + str(file_dir)
+        logging.info(log_message)
+    return session